@@ -0,0 +1,343 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Minimal in-process ELF reader used by the build targets instead of
+spawning binutils for simple tasks (firmware size, memory usage and
+conversion to raw binary or Intel HEX images).
+"""
+
+import mmap
+import os
+import re
+import struct
+import threading
+from collections import namedtuple
+
+PT_LOAD = 1
+
+SHT_NOBITS = 8
+
+SHF_ALLOC = 0x2
+
+Section = namedtuple(
+    "Section", ["name", "type", "flags", "addr", "offset", "size"])
+Segment = namedtuple(
+    "Segment", ["type", "offset", "vaddr", "paddr", "filesz", "memsz", "flags"])
+MemoryRegion = namedtuple("MemoryRegion", ["name", "origin", "length"])
+
+
+class ElfError(Exception):
+    pass
+
+
+class ElfFile:
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as exc:  # empty file
+            self._fp.close()
+            raise ElfError("%s is not an ELF file" % path) from exc
+        try:
+            self._parse()
+        except (ElfError, struct.error) as exc:
+            self.close()
+            if isinstance(exc, ElfError):
+                raise
+            raise ElfError("%s is a malformed ELF file" % path) from exc
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if not self.data.closed:
+            self.data.close()
+        self._fp.close()
+
+    def _parse(self):
+        data = self.data
+        if data[:4] != b"\x7fELF" or data[4] not in (1, 2) or data[5] not in (1, 2):
+            raise ElfError("%s is not an ELF file" % self.path)
+        is64 = data[4] == 2
+        endian = "<" if data[5] == 1 else ">"
+
+        (_, _, _, self.entry, phoff, shoff, _, _, phentsize, phnum, shentsize,
+         shnum, shstrndx) = struct.unpack_from(
+             endian + ("HHIQQQIHHHHHH" if is64 else "HHIIIIIHHHHHH"), data, 16)
+
+        self.segments = []
+        for index in range(phnum):
+            offset = phoff + index * phentsize
+            if is64:
+                (p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz,
+                 p_memsz, _) = struct.unpack_from(endian + "IIQQQQQQ", data, offset)
+            else:
+                (p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz,
+                 p_flags, _) = struct.unpack_from(endian + "IIIIIIII", data, offset)
+            self.segments.append(Segment(
+                p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags))
+
+        headers = []
+        for index in range(shnum):
+            offset = shoff + index * shentsize
+            if is64:
+                headers.append(struct.unpack_from(endian + "IIQQQQ", data, offset))
+            else:
+                headers.append(struct.unpack_from(endian + "IIIIII", data, offset))
+
+        strtab_offset = headers[shstrndx][4] if shstrndx < len(headers) else 0
+        self.sections = []
+        for sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size in headers[1:]:
+            name_start = strtab_offset + sh_name
+            name_end = data.find(b"\0", name_start)
+            self.sections.append(Section(
+                data[name_start:name_end].decode("latin-1"),
+                sh_type, sh_flags, sh_addr, sh_offset, sh_size))
+
+    def get_size(self, pattern):
+        """Returns the total size of sections matched by a pattern for lines
+        of the `size -A -d` output, e.g. $SIZEPROGREGEXP or $SIZEDATAREGEXP.
+        The reported sizes stay the same as with the size tool"""
+
+        regexp = re.compile(pattern)
+        size = 0
+        for section in self.sections:
+            # "<name> <size> <address>" as printed by `size -A -d`
+            match = regexp.search(
+                "%s %d %d" % (section.name, section.size, section.addr))
+            if match:
+                size += sum(int(value) for value in match.groups())
+        return size
+
+    def get_load_sections(self, exclude=None):
+        """Returns `(lma, name, data)` of sections stored in the firmware
+        image sorted by load address. The selection and load addresses
+        follow the rules of `objcopy` for the binary and Intel HEX output"""
+
+        load_segments = [s for s in self.segments if s.type == PT_LOAD]
+        # Load addresses are ignored if the linker didn't set them
+        use_paddr = any(s.paddr for s in self.segments) or len(
+            [s for s in load_segments if s.memsz]) < 2
+
+        result = []
+        for section in self.sections:
+            if (
+                not section.flags & SHF_ALLOC
+                or section.type == SHT_NOBITS
+                or not section.size
+                or section.name in (exclude or [])
+            ):
+                continue
+            lma = section.addr
+            for segment in load_segments if use_paddr else []:
+                if (
+                    segment.offset <= section.offset
+                    and section.offset + section.size
+                    <= segment.offset + segment.filesz
+                    and segment.vaddr <= section.addr
+                    and section.addr + section.size
+                    <= segment.vaddr + segment.memsz
+                ):
+                    lma = segment.paddr + section.offset - segment.offset
+                    break
+            result.append((
+                lma,
+                section.name,
+                memoryview(self.data)[
+                    section.offset:section.offset + section.size],
+            ))
+        return sorted(result, key=lambda item: item[0])
+
+    def get_image(self, exclude=None):
+        """Returns `(start_address, data)` of the raw firmware image, gaps
+        between sections are filled with zeros"""
+        sections = self.get_load_sections(exclude)
+        if not sections:
+            return 0, bytearray()
+        start = sections[0][0]
+        image = bytearray(max(lma + len(data) for lma, _, data in sections) - start)
+        for lma, _, data in sections:
+            image[lma - start:lma - start + len(data)] = data
+        return start, image
+
+    def write_bin(self, path, exclude=None):
+        with open(path, "wb") as fp:
+            fp.write(self.get_image(exclude)[1])
+
+    def write_hex(self, path, exclude=None):
+        write_ihex(
+            path,
+            [(lma, data) for lma, _, data in self.get_load_sections(exclude)],
+            self.entry,
+        )
+
+    def get_memory_usage(self, regions):
+        """Returns used bytes per memory region calculated from the loadable
+        segments. The load image of initialized data is accounted to the
+        region it is copied from at startup (usually FLASH)"""
+
+        def _find_region(address):
+            for region in regions:
+                if region.origin <= address < region.origin + (region.length or 0):
+                    return region.name
+            return None
+
+        usage = {region.name: 0 for region in regions}
+        for segment in self.segments:
+            if segment.type != PT_LOAD or not segment.memsz:
+                continue
+            vregion = _find_region(segment.vaddr)
+            if vregion:
+                usage[vregion] += segment.memsz
+            pregion = _find_region(segment.paddr)
+            if pregion and pregion != vregion:
+                usage[pregion] += segment.filesz
+        return usage
+
+
+def _ihex_record(record_type, address, data):
+    record = bytes((len(data), address >> 8, address & 0xFF, record_type)) + data
+    return ":%s%02X\r\n" % (record.hex().upper(), -sum(record) & 0xFF)
+
+
+def write_ihex(path, chunks, entry=0):
+    """Writes `(address, data)` chunks sorted by address to an Intel HEX
+    file using the same records as `objcopy -O ihex`"""
+
+    lines = []
+    segment_base = linear_base = 0
+    for address, data in chunks:
+        pos = 0
+        while pos < len(data):
+            if address > segment_base + linear_base + 0xFFFF:
+                if not linear_base and address <= 0xFFFFF:
+                    segment_base = address & 0xF0000
+                    lines.append(
+                        _ihex_record(2, 0, struct.pack(">H", segment_base >> 4)))
+                else:
+                    if segment_base:
+                        lines.append(_ihex_record(2, 0, b"\0\0"))
+                        segment_base = 0
+                    linear_base = address & 0xFFFF0000
+                    lines.append(
+                        _ihex_record(4, 0, struct.pack(">H", linear_base >> 16)))
+            offset = address - linear_base - segment_base
+            size = min(16, len(data) - pos, 0x10000 - offset)
+            lines.append(_ihex_record(0, offset, data[pos:pos + size]))
+            address += size
+            pos += size
+
+    if entry:
+        if entry <= 0xFFFFF:
+            lines.append(_ihex_record(3, 0, struct.pack(
+                ">BBH", (entry & 0xF0000) >> 12, 0, entry & 0xFFFF)))
+        else:
+            lines.append(_ihex_record(5, 0, struct.pack(">I", entry)))
+    lines.append(_ihex_record(1, 0, b""))
+
+    with open(path, "w", newline="") as fp:
+        fp.write("".join(lines))
+
+
+def convert(elf_path, bin_path=None, hex_path=None, bin_exclude=None,
+            hex_exclude=None):
+    """Writes the raw binary and/or Intel HEX image of an ELF file
+    reading it only once"""
+
+    with ElfFile(elf_path) as elf:
+        if bin_path:
+            elf.write_bin(bin_path, bin_exclude)
+        if hex_path:
+            elf.write_hex(hex_path, hex_exclude)
+
+
+class ElfFileCache:
+    """Keeps ELF files open for several conversions, so the raw binary and
+    Intel HEX images of a program are written from a single parse. A file
+    is parsed again when it changes on disk"""
+
+    def __init__(self):
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def _get(self, path):
+        stat = os.stat(path)
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached = self._files.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        if cached:
+            cached[1].close()
+        elf = ElfFile(path)
+        self._files[path] = (key, elf)
+        return elf
+
+    def convert(self, elf_path, bin_path=None, hex_path=None, bin_exclude=None,
+                hex_exclude=None):
+        """The same as `convert`, the ELF file is parsed only on first use"""
+
+        # builders may run in parallel jobs
+        with self._lock:
+            elf = self._get(os.path.abspath(elf_path))
+            if bin_path:
+                elf.write_bin(bin_path, bin_exclude)
+            if hex_path:
+                elf.write_hex(hex_path, hex_exclude)
+
+    def close(self):
+        with self._lock:
+            for _, elf in self._files.values():
+                elf.close()
+            self._files.clear()
+
+
+def parse_memory_regions(ldscript_path):
+    """Returns memory regions declared in the MEMORY command of a GNU
+    linker script. Regions with computed lengths have `length` set to None"""
+
+    with open(ldscript_path) as fp:
+        content = re.sub(r"/\*.*?\*/", "", fp.read(), flags=re.S)
+
+    match = re.search(r"\bMEMORY\s*{([^}]*)}", content)
+    if not match:
+        return []
+
+    def _to_int(value):
+        value = value.strip()
+        multiplier = {"K": 1024, "M": 1024 * 1024}.get(value[-1:].upper(), 1)
+        if multiplier > 1:
+            value = value[:-1]
+        try:
+            return int(value, 0) * multiplier
+        except ValueError:
+            return None
+
+    regions = []
+    for item in re.finditer(
+        r"(\w+)\s*(?:\([^)]*\))?\s*:\s*(?:ORIGIN|org|o)\s*=\s*([^,]+),\s*"
+        r"(?:LENGTH|len|l)\s*=\s*([^\n;]+)",
+        match.group(1),
+    ):
+        origin = _to_int(item.group(2))
+        if origin is None:
+            continue
+        regions.append(
+            MemoryRegion(item.group(1), origin, _to_int(item.group(3))))
+    return regions
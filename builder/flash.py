@@ -0,0 +1,171 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Standalone flasher for prebuilt firmware. It uses only the board manifest
+and the installed tool packages, the SCons environment and framework
+scripts are not loaded. Run it with the Python interpreter of PlatformIO:
+
+    python builder/flash.py -b nucleo_f401re -p stlink firmware.elf
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from platform import system
+
+from platformio.platform.exception import UnknownBoard
+from platformio.platform.factory import PlatformFactory
+
+from elf import ElfError, convert
+from uploadcmds import (ARDUINO_DFU_BOARD_PREFIXES, DEFAULT_OFFSET,
+                        get_blackmagic_flags, get_dfu_flags, get_jlink_commands,
+                        get_jlink_flags, get_openocd_flags,
+                        get_openocd_program_cmd, get_stm32flash_flags)
+
+PLATFORM_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+class FlashError(Exception):
+    pass
+
+
+def _get_tool(platform, package, *path):
+    package_dir = platform.get_package_dir(package)
+    if not package_dir:
+        raise FlashError(
+            "%s is not installed, run a regular upload once to install it"
+            % package)
+    return os.path.join(package_dir, *path)
+
+
+def _is_elf(path):
+    with open(path, "rb") as fp:
+        return fp.read(4) == b"\x7fELF"
+
+
+def _get_binary(firmware, tmp_dir):
+    if not _is_elf(firmware):
+        return firmware
+    bin_path = os.path.join(tmp_dir, "firmware.bin")
+    try:
+        convert(firmware, bin_path=bin_path)
+    except ElfError as exc:
+        raise FlashError(str(exc)) from exc
+    return bin_path
+
+
+def get_upload_command(platform, board, args, tmp_dir):
+    protocol = args.protocol or board.get("upload.protocol", "")
+    debug_tools = board.get("debug.tools", {})
+    offset = board.get("upload.offset_address", "")
+    firmware = os.path.abspath(args.firmware)
+
+    if protocol.startswith("blackmagic"):
+        if not args.port:
+            raise FlashError("BlackMagic probe port is not specified")
+        if not _is_elf(firmware):
+            raise FlashError("BlackMagic probe requires an ELF firmware")
+        return [
+            _get_tool(platform, "toolchain-gccarmnoneeabi", "bin",
+                      "arm-none-eabi-gdb")
+        ] + get_blackmagic_flags(protocol, args.port) + [firmware]
+
+    if protocol.startswith("jlink"):
+        script_path = os.path.join(tmp_dir, "upload.jlink")
+        with open(script_path, "w") as fp:
+            fp.write("\n".join(get_jlink_commands(
+                _get_binary(firmware, tmp_dir), offset or DEFAULT_OFFSET)))
+        return [
+            _get_tool(platform, "tool-jlink",
+                      "JLink.exe" if system() == "Windows" else "JLinkExe")
+        ] + get_jlink_flags(board, protocol, args.debug_speed) + [
+            "-CommanderScript", script_path]
+
+    if protocol == "dfu":
+        if board.id.startswith(ARDUINO_DFU_BOARD_PREFIXES):
+            tool = _get_tool(platform, "tool-dfuutil-arduino", "dfu-util")
+        else:
+            tool = _get_tool(platform, "tool-dfuutil", "bin", "dfu-util")
+        return [tool] + get_dfu_flags(
+            board.get("build.hwids", [["0x0483", "0xDF11"]]),
+            offset or DEFAULT_OFFSET
+        ) + [_get_binary(firmware, tmp_dir)]
+
+    if protocol == "serial":
+        if not args.port:
+            raise FlashError("Serial port is not specified")
+        return [_get_tool(platform, "tool-stm32flash", "stm32flash")] + (
+            get_stm32flash_flags(offset or DEFAULT_OFFSET, args.speed)
+        ) + [_get_binary(firmware, tmp_dir), args.port]
+
+    if protocol in debug_tools:
+        if _is_elf(firmware) or firmware.lower().endswith(".hex"):
+            # Load addresses are taken from the firmware file
+            offset = ""
+        else:
+            offset = offset or DEFAULT_OFFSET
+        return [_get_tool(platform, "tool-openocd", "bin", "openocd")] + (
+            get_openocd_flags(
+                debug_tools.get(protocol),
+                platform.get_package_dir("tool-openocd"),
+                get_openocd_program_cmd(
+                    firmware.replace("\\", "/"), offset),
+                args.debug_speed,
+                args.verbose
+            ))
+
+    raise FlashError("Upload protocol %s is not supported" % protocol)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Flash a prebuilt firmware without running the build")
+    parser.add_argument("firmware", help="ELF, HEX or raw binary firmware")
+    parser.add_argument("-b", "--board", required=True, help="board ID")
+    parser.add_argument("-p", "--protocol",
+                        help="upload protocol (default from the board manifest)")
+    parser.add_argument("--port", help="serial port or GDB server address")
+    parser.add_argument("--speed", default="", help="serial upload speed")
+    parser.add_argument("--debug-speed", default="",
+                        help="adapter speed of debug probes, kHz")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    if not os.path.isfile(args.firmware):
+        sys.stderr.write("Error: %s does not exist\n" % args.firmware)
+        return 1
+
+    platform = PlatformFactory.new(PLATFORM_DIR)
+    try:
+        board = platform.board_config(args.board)
+    except UnknownBoard as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        return 1
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            cmd = get_upload_command(platform, board, args, tmp_dir)
+        except (OSError, FlashError) as exc:
+            sys.stderr.write("Error: %s\n" % exc)
+            return 1
+        if args.verbose:
+            print(subprocess.list2cmdline(cmd))
+        return subprocess.call(cmd)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Incremental (delta) flashing helpers. The firmware image is compared
+with the image flashed by the previous upload sector by sector, only
+sectors with changed contents are erased and programmed again.
+"""
+
+import json
+import os
+import re
+import shutil
+
+from elf import ElfError, ElfFile, write_ihex
+
+FLASH_BASE = 0x08000000
+
+K = 1024
+
+# MCU prefix -> flash sectors as [(count, size), ...] starting at FLASH_BASE
+FLASH_SECTORS = (
+    ("stm32f72", [(4, 16 * K), (1, 64 * K), (3, 128 * K)]),
+    ("stm32f73", [(4, 16 * K), (1, 64 * K), (3, 128 * K)]),
+    ("stm32f7", [(4, 32 * K), (1, 128 * K), (7, 256 * K)]),
+    ("stm32f2", [(4, 16 * K), (1, 64 * K), (7, 128 * K)]),
+    # the second bank of 2MB devices repeats the layout of the first one
+    ("stm32f4", [(4, 16 * K), (1, 64 * K), (7, 128 * K)] * 2),
+)
+
+# MCU prefix -> size of uniform flash pages
+FLASH_PAGE_SIZES = (
+    ("stm32c0", 2 * K),
+    ("stm32f07", 2 * K),
+    ("stm32f09", 2 * K),
+    ("stm32f0", 1 * K),
+    ("stm32f105", 2 * K),
+    ("stm32f107", 2 * K),
+    ("stm32f3", 2 * K),
+    ("stm32g0", 2 * K),
+    ("stm32g4", 2 * K),
+    ("stm32h7a", 8 * K),
+    ("stm32h7b", 8 * K),
+    ("stm32h7", 128 * K),
+    ("stm32l0", 128),
+    ("stm32l1", 256),
+    ("stm32l4r", 4 * K),
+    ("stm32l4s", 4 * K),
+    ("stm32l4", 2 * K),
+    ("stm32l5", 2 * K),
+    ("stm32u5", 8 * K),
+    ("stm32wb", 4 * K),
+    ("stm32wl", 2 * K),
+)
+
+
+def get_flash_sectors(board_config):
+    """Returns `[(address, size), ...]` of flash sectors or None if the
+    flash geometry of the MCU is unknown"""
+
+    mcu = board_config.get("build.mcu", "").lower()
+    flash_size = int(board_config.get("upload.maximum_size", 0))
+    sector_size = int(board_config.get("upload.sector_size", 0))
+
+    layout = None
+    if sector_size:
+        layout = [(max(flash_size // sector_size, 1), sector_size)]
+    if not layout:
+        layout = next(
+            (layout for prefix, layout in FLASH_SECTORS if mcu.startswith(prefix)),
+            None)
+    if not layout and mcu.startswith("stm32f1"):
+        # High-density lines (256KB of flash and more) use 2KB pages
+        page_size = 2 * K if mcu[10:11] in ("c", "d", "e", "f", "g") else K
+        layout = [(max(flash_size // page_size, 1), page_size)]
+    if not layout:
+        page_size = next(
+            (size for prefix, size in FLASH_PAGE_SIZES if mcu.startswith(prefix)),
+            None)
+        if page_size:
+            layout = [(max(flash_size // page_size, 1), page_size)]
+    if not layout:
+        return None
+
+    sectors = []
+    address = FLASH_BASE
+    for count, size in layout:
+        for _ in range(count):
+            sectors.append((address, size))
+            address += size
+    return sectors
+
+
+def read_image(path, offset):
+    """Returns `(start_address, data)` of a raw binary or ELF firmware"""
+    try:
+        with ElfFile(path) as elf:
+            start, data = elf.get_image()
+            return start, bytes(data)
+    except ElfError:
+        pass
+    with open(path, "rb") as fp:
+        return offset, fp.read()
+
+
+def get_changed_chunks(sectors, image, last_image):
+    """Returns `[(address, data), ...]` of image parts which reside in
+    sectors with changed contents. Adjacent sectors are merged. None is
+    returned if the image doesn't fit the known flash sectors"""
+
+    start, data = image
+    last_start, last_data = last_image
+    end = start + len(data)
+    if not sectors or start < sectors[0][0] or end > sum(sectors[-1]):
+        return None
+
+    def _slice(image_start, image_data, address, size):
+        lo = max(address, image_start) - image_start
+        hi = min(address + size, image_start + len(image_data)) - image_start
+        if hi <= lo:
+            return b"", None
+        return image_data[lo:hi], lo + image_start
+
+    chunks = []
+    for address, size in sectors:
+        if address + size <= start or address >= end:
+            continue
+        if _slice(start, data, address, size) == _slice(
+                last_start, last_data, address, size):
+            continue
+        chunk, chunk_start = _slice(start, data, address, size)
+        if chunks and chunks[-1][0] + len(chunks[-1][1]) == chunk_start:
+            chunks[-1] = (chunks[-1][0], chunks[-1][1] + chunk)
+        else:
+            chunks.append((chunk_start, chunk))
+    return chunks
+
+
+class DeltaUpload:
+    """Keeps the image flashed by the last upload for each probe and
+    prepares a HEX file with the changed sectors of a new image"""
+
+    def __init__(self, state_dir, sectors):
+        self.state_dir = state_dir
+        self.sectors = sectors
+        # True if only changed sectors are programmed by the next upload
+        self.partial = False
+        self._name = None
+        self._pending = None
+
+    def _get_path(self, suffix):
+        return os.path.join(self.state_dir, self._name + suffix)
+
+    def _load_last_image(self):
+        try:
+            with open(self._get_path(".json")) as fp:
+                meta = json.load(fp)
+            with open(self._get_path(".bin"), "rb") as fp:
+                return meta["start"], fp.read()
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def prepare(self, key, firmware_path, offset):
+        """Returns a path to the HEX file with changed sectors, an empty
+        string if nothing has changed or None when a full upload is needed"""
+
+        self._name = re.sub(r"[^\w.-]+", "_", key).strip("_") or "default"
+        self.partial = False
+        try:
+            image = read_image(firmware_path, offset)
+        except OSError:
+            self._pending = None
+            return None
+        self._pending = image
+        last_image = self._load_last_image()
+        if not last_image or not self.sectors:
+            return None
+        chunks = get_changed_chunks(self.sectors, image, last_image)
+        if chunks is None:
+            return None
+        self.partial = True
+        if not chunks:
+            return ""
+        delta_path = self._get_path(".delta.hex")
+        os.makedirs(os.path.dirname(delta_path), exist_ok=True)
+        write_ihex(delta_path, chunks)
+        return delta_path
+
+    def discard(self):
+        """Removes the record, the next upload programs the whole image"""
+        if self._name is None:
+            return
+        for suffix in (".bin", ".json"):
+            try:
+                os.remove(self._get_path(suffix))
+            except OSError:
+                pass
+
+    def commit(self):
+        """Records the image of a successful upload"""
+        if self._pending is None:
+            return
+        start, data = self._pending
+        state_path = self._get_path(".bin")
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        with open(state_path + ".tmp", "wb") as fp:
+            fp.write(data)
+        shutil.move(state_path + ".tmp", state_path)
+        with open(self._get_path(".json"), "w") as fp:
+            json.dump({"start": start}, fp)
+        self._pending = None
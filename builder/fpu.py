@@ -0,0 +1,90 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Floating-point unit flags derived from the CPU and MCU of a board. Without
+them GCC uses the soft-float ABI and every floating-point operation is a
+call to a library routine.
+"""
+
+import sys
+
+FLOAT_ABIS = ("hard", "softfp", "soft")
+
+# MCU prefix -> FPU, the first match wins
+MCU_FPUS = (
+    ("stm32wl", None),
+    ("stm32f76", "fpv5-d16"),
+    ("stm32f77", "fpv5-d16"),
+    ("stm32h7", "fpv5-d16"),
+)
+
+CPU_FPUS = {
+    "cortex-m4": "fpv4-sp-d16",
+    "cortex-m7": "fpv5-sp-d16",
+    "cortex-m33": "fpv5-sp-d16",
+}
+
+
+def get_fpu(board):
+    if board.get("build.fpu", ""):
+        return board.get("build.fpu")
+    mcu = board.get("build.mcu", "").lower()
+    for prefix, fpu in MCU_FPUS:
+        if mcu.startswith(prefix):
+            return fpu
+    return CPU_FPUS.get(board.get("build.cpu", ""))
+
+
+def _get_user_flags(env):
+    # Build flags are not always processed at this point
+    return " ".join(
+        env.subst(str(flag))
+        for name in ("BUILD_FLAGS", "CCFLAGS", "LINKFLAGS")
+        for flag in env.get(name, [])
+    ).split()
+
+
+def get_fpu_flags(env):
+    """Returns `-mfpu` and `-mfloat-abi` flags for compiling and linking.
+    Nothing is returned with the `soft` ABI or if the project already
+    specifies one of these flags in `build_flags`"""
+
+    if any(
+        flag.startswith(("-mfpu", "-mfloat-abi")) for flag in _get_user_flags(env)
+    ):
+        return []
+
+    board = env.BoardConfig()
+    float_abi = board.get("build.float_abi", "hard")
+    if float_abi not in FLOAT_ABIS:
+        sys.stderr.write(
+            "Error: Unknown float ABI `%s`, please use one of: %s\n"
+            % (float_abi, ", ".join(FLOAT_ABIS)))
+        env.Exit(1)
+    fpu = get_fpu(board)
+    if not fpu or float_abi == "soft":
+        return []
+    return ["-mfpu=%s" % fpu, "-mfloat-abi=%s" % float_abi]
+
+
+def get_float_abi(env):
+    """Returns the float ABI and FPU used by the flags of `env`"""
+    float_abi, fpu = "soft", None
+    for flag in _get_user_flags(env):
+        if flag.startswith("-mfloat-abi="):
+            float_abi = flag.split("=", 1)[1]
+        elif flag.startswith("-mfpu="):
+            fpu = flag.split("=", 1)[1]
+    return float_abi, fpu if float_abi != "soft" else None
@@ -18,8 +18,14 @@
 
 from SCons.Script import DefaultEnvironment
 
+from fpu import get_fpu_flags
+from profiles import get_profile_flags
+
 env = DefaultEnvironment()
 
+# Optimize for size unless another build profile is selected
+optimization_flags = get_profile_flags(env) if "BOARD" in env else ["-Os"]
+
 env.Append(
     ASFLAGS=[
         "-mthumb",
@@ -28,8 +34,7 @@ env.Append(
         "-x", "assembler-with-cpp",
     ],
 
-    CCFLAGS=[
-        "-Os",  # optimize for size
+    CCFLAGS=optimization_flags + [
         "-ffunction-sections",  # place each function in its own section
         "-fdata-sections",
         "-Wall",
@@ -45,8 +50,7 @@ env.Append(
         ("F_CPU", "$BOARD_F_CPU")
     ],
 
-    LINKFLAGS=[
-        "-Os",
+    LINKFLAGS=optimization_flags + [
         "-Wl,--gc-sections,--relax",
         "-mthumb"
     ],
@@ -55,14 +59,13 @@ env.Append(
 )
 
 if "BOARD" in env:
+    machine_flags = ["-mcpu=%s" % env.BoardConfig().get("build.cpu")]
+    # Arduino cores select the float ABI of their precompiled libraries
+    if "arduino" not in env.get("PIOFRAMEWORK", []):
+        machine_flags.extend(get_fpu_flags(env))
+
     env.Append(
-        ASFLAGS=[
-            "-mcpu=%s" % env.BoardConfig().get("build.cpu")
-        ],
-        CCFLAGS=[
-            "-mcpu=%s" % env.BoardConfig().get("build.cpu")
-        ],
-        LINKFLAGS=[
-            "-mcpu=%s" % env.BoardConfig().get("build.cpu")
-        ]
+        ASFLAGS=machine_flags,
+        CCFLAGS=machine_flags,
+        LINKFLAGS=machine_flags
     )
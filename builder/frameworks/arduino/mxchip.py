@@ -21,11 +21,15 @@ kinds of creative coding, interactive objects, spaces or physical experiences.
 https://github.com/microsoft/devkit-sdk
 """
 
-from os import walk
-from os.path import isdir, join
+import json
+import tempfile
+from os import fdopen, makedirs, replace, stat, walk
+from os.path import dirname, isdir, join
 
 from SCons.Script import DefaultEnvironment
 
+from objcache import get_key
+
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 board = env.BoardConfig()
@@ -125,19 +129,74 @@ env.Append(
     LIBSOURCE_DIRS=[join(FRAMEWORK_DIR, "libraries")])
 
 
-inc_dirs = []
-for d in ("system", join("cores", env.BoardConfig().get("build.core"))):
-    for root, _, files in sorted(walk(join(FRAMEWORK_DIR, d))):
-        if any(f.endswith(".h") for f in files) or "inc" in root:
-            if root not in inc_dirs:
-                inc_dirs.append(root)
-
-inc_dirs.extend([
+def find_include_dirs():
+    """Returns directories with headers and modification times of all
+    walked directories, they change when files are added or removed"""
+    inc_dirs = []
+    dir_mtimes = []
+    for d in ("system", join("cores", board.get("build.core"))):
+        walked = sorted(walk(join(FRAMEWORK_DIR, d)))
+        dir_mtimes.extend(
+            [root, stat(root).st_mtime_ns] for root, _, _ in walked)
+        header_dirs = set(
+            root for root, _, files in walked
+            if any(f.endswith(".h") for f in files))
+        # Directories like "include" are searched for headers in
+        # subdirectories, those without any headers would be searched for
+        # nothing
+        parent_dirs = set()
+        for root in header_dirs:
+            while root.startswith(FRAMEWORK_DIR) and root not in parent_dirs:
+                parent_dirs.add(root)
+                root = dirname(root)
+        for root, _, _ in walked:
+            if root in header_dirs or ("inc" in root and root in parent_dirs):
+                if root not in inc_dirs:
+                    inc_dirs.append(root)
+    return inc_dirs, dir_mtimes
+
+
+def get_include_dirs():
+    # Walking thousands of files of the package takes seconds
+    cache_path = join(
+        env.GetProjectConfig().get("platformio", "cache_dir"),
+        "mxchip-includes",
+        get_key(FRAMEWORK_VERSION, FRAMEWORK_DIR, board.get("build.core"))
+        + ".json",
+    )
+    try:
+        with open(cache_path) as fp:
+            data = json.load(fp)
+        if all(
+            stat(path).st_mtime_ns == mtime
+            for path, mtime in data["dir_mtimes"]
+        ):
+            return data["include_dirs"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    inc_dirs, dir_mtimes = find_include_dirs()
+    try:
+        makedirs(dirname(cache_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname(cache_path), prefix=".tmp-")
+        with fdopen(fd, "w") as fp:
+            json.dump({"include_dirs": inc_dirs, "dir_mtimes": dir_mtimes}, fp)
+        replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return inc_dirs
+
+
+inc_dirs = get_include_dirs()
+for d in (
     join(FRAMEWORK_DIR, "system"),
     join(FRAMEWORK_DIR, "system", "mbed-os", "features"),
     join(FRAMEWORK_DIR, "system", "mbed-os", "features", "mbedtls"),
     join(FRAMEWORK_DIR, "system", "az3166-driver", "mico", "platform")
-])
+):
+    # GCC ignores duplicate directories, but SCons searches them again
+    if d not in inc_dirs:
+        inc_dirs.append(d)
 
 env.Append(CPPPATH=inc_dirs)
 
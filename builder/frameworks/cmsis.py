@@ -26,12 +26,13 @@ and cutting the time-to-market for devices.
 http://www.arm.com/products/processors/cortex-m/cortex-microcontroller-software-interface-standard.php
 """
 
-import glob
 import os
-import string
 
 from SCons.Script import DefaultEnvironment
 
+from ldscriptgen import add_generated_linker_script
+from ldscripts import find_linker_script
+
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 board = env.BoardConfig()
@@ -47,52 +48,37 @@ LDSCRIPTS_DIR = platform.get_package_dir("tool-ldscripts-ststm32")
 assert all(os.path.isdir(d) for d in (CMSIS_DIR, CMSIS_DEVICE_DIR, LDSCRIPTS_DIR))
 
 
-def generate_ldscript(default_ldscript_path):
-    ram = board.get("upload.maximum_ram_size", 0)
-    flash = board.get("upload.maximum_size", 0)
-    template_file = os.path.join(LDSCRIPTS_DIR, "tpl", "linker.tpl")
-    content = ""
-    with open(template_file) as fp:
-        data = string.Template(fp.read())
-        content = data.substitute(
-            stack=hex(0x20000000 + ram),  # 0x20000000 - start address for RAM
-            ram=str(int(ram / 1024)) + "K",
-            flash=str(int(flash / 1024)) + "K")
-
-    with open(default_ldscript_path, "w") as fp:
-        fp.write(content)
-
-
 def get_linker_script():
-    ldscript_match = glob.glob(os.path.join(
-        LDSCRIPTS_DIR, mcu[0:7], mcu[0:11].upper() + "*_FLASH.ld"))
-
-    if ldscript_match and os.path.isfile(ldscript_match[0]):
-        return ldscript_match[0]
+    if board.get("build.generate_ldscript", "no") != "yes":
+        ldscript = find_linker_script(
+            env, "tool-ldscripts-ststm32", LDSCRIPTS_DIR, mcu[0:7], mcu[0:11],
+            board.get("build.cpu", ""))
+        if ldscript:
+            return ldscript
 
-    default_ldscript = os.path.join(
-        LDSCRIPTS_DIR, mcu[0:7], mcu[0:11].upper() + "_DEFAULT.ld")
+        print("Warning! Cannot find a linker script for the required board! "
+              "An auto-generated script will be used to link firmware!")
 
-    print("Warning! Cannot find a linker script for the required board! "
-          "An auto-generated script will be used to link firmware!")
+    # Packages stay intact, they might be used by several builds at once
+    return add_generated_linker_script(env, os.path.join(
+        env.subst("$BUILD_DIR"), mcu[0:11].upper() + "_DEFAULT.ld"))
 
-    if not os.path.isfile(default_ldscript):
-        generate_ldscript(default_ldscript)
 
-    return default_ldscript
+def prepare_startup_file(src_path, startup_name):
+    """Returns a node of the startup file copied to the build directory
+    if the package provides it only with the lowercase `.s` extension"""
 
+    startup_file = os.path.join(src_path, "gcc", startup_name)
+    if os.path.isfile(startup_file):
+        return None
+    if startup_file.endswith(".S") and os.path.isfile(startup_file[:-2] + ".s"):
+        return env.InstallAs(
+            os.path.join("$BUILD_DIR", "FrameworkStartup", startup_name),
+            startup_file[:-2] + ".s")
 
-def prepare_startup_file(src_path):
-    startup_file = os.path.join(src_path, "gcc", "startup_%s.S" % product_line.lower())
-    # Change file extension to uppercase:
-    if not os.path.isfile(startup_file) and os.path.isfile(startup_file[:-2] + ".s"):
-        try:
-            os.replace(startup_file[:-2] + ".s", startup_file)
-        except (FileNotFoundError, FileExistsError):
-            print("Startup file was already renamed by another process.")
-    if not os.path.isfile(startup_file):
-        print("Warning! Cannot find the default startup file for %s. "
-              "Ignore this warning if the startup code is part of your project." % mcu)
+    print("Warning! Cannot find the default startup file for %s. "
+          "Ignore this warning if the startup code is part of your project." % mcu)
+    return None
 
 
 #
@@ -127,17 +113,18 @@ env.Append(
 #
 
 sources_path = os.path.join(CMSIS_DEVICE_DIR, "Source", "Templates")
-prepare_startup_file(sources_path)
+startup_name = board.get(
+    "build.cmsis.startup_file", "startup_%s.S" % product_line.lower())
+startup_node = prepare_startup_file(sources_path, startup_name)
 
 env.BuildSources(
     os.path.join("$BUILD_DIR", "FrameworkCMSIS"), sources_path,
     src_filter=[
         "-<*>",
         "+<%s>" % board.get("build.cmsis.system_file", "system_%sxx.c" % mcu[0:7]),
-        "+<gcc/%s>"
-        % board.get(
-            "build.cmsis.startup_file",
-            "startup_%s.S" % product_line.lower()
-        )
+        "+<gcc/%s>" % startup_name
     ]
 )
+
+if startup_node:
+    env.Append(PIOBUILDFILES=[env.Object(startup_node)])
@@ -23,11 +23,19 @@ directly with the registers.
 http://www.st.com/web/en/catalog/tools/FM147/CL1794/SC961/SS1743?sc=stm32embeddedsoftware
 """
 
-from os.path import isdir, isfile, join
-from string import Template
+from os import listdir
+from os.path import isdir, isfile, join, splitext
 
 from SCons.Script import DefaultEnvironment
 
+from ldscriptgen import add_generated_linker_script
+from ldscripts import find_linker_script
+from libindex import IncludeCache, get_project_source_dirs, scan_headers
+from pch import add_precompiled_header
+from profiles import clone_library_env
+from scancache import clone_framework_env
+from unitybuild import build_unity_objects
+
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 board = env.BoardConfig()
@@ -37,12 +45,26 @@ env.SConscript("_bare.py")
 FRAMEWORK_DIR = platform.get_package_dir("framework-spl")
 assert isdir(FRAMEWORK_DIR)
 
+# Drivers of peripherals which are missing in some devices of a family,
+# `(define in build.extra_flags, source file)`
+SPL_EXCLUDED_SOURCES = (
+    ("STM32F40_41xxx", "stm32f4xx_fmc.c"),
+    ("STM32F427_437xx", "stm32f4xx_fsmc.c"),
+    ("STM32F303xC", "stm32f30x_hrtim.c"),
+    ("STM32L1XX_MD", "stm32l1xx_flash_ramfunc.c"),
+)
+
 
 def get_linker_script(mcu):
-    ldscript = join(FRAMEWORK_DIR, "platformio",
-                    "ldscripts", mcu[0:11].upper() + "_FLASH.ld")
+    if board.get("build.generate_ldscript", "no") == "yes":
+        return add_generated_linker_script(
+            env, join(env.subst("$BUILD_DIR"), mcu[0:11].upper() + "_DEFAULT.ld"))
+
+    ldscript = find_linker_script(
+        env, "framework-spl", join(FRAMEWORK_DIR, "platformio", "ldscripts"),
+        "", mcu[0:11] + "_FLASH.ld")
 
-    if isfile(ldscript):
+    if ldscript:
         return ldscript
 
     default_ldscript = join(FRAMEWORK_DIR, "platformio",
@@ -54,23 +76,9 @@ def get_linker_script(mcu):
     if isfile(default_ldscript):
         return default_ldscript
 
-    ram = board.get("upload.maximum_ram_size", 0)
-    flash = board.get("upload.maximum_size", 0)
-    template_file = join(FRAMEWORK_DIR, "platformio",
-                         "ldscripts", "tpl", "linker.tpl")
-    content = ""
-    with open(template_file) as fp:
-        data = Template(fp.read())
-        content = data.substitute(
-            stack=hex(0x20000000 + ram),  # 0x20000000 - start address for RAM
-            ram=str(int(ram / 1024)) + "K",
-            flash=str(int(flash / 1024)) + "K"
-        )
-
-    with open(default_ldscript, "w") as fp:
-        fp.write(content)
-
-    return default_ldscript
+    # The package stays intact, it might be used by several builds at once
+    return add_generated_linker_script(
+        env, join(env.subst("$BUILD_DIR"), mcu[0:11].upper() + "_DEFAULT.ld"))
 
 
 env.Append(
@@ -80,43 +88,93 @@ env.Append(
         join(FRAMEWORK_DIR, board.get("build.core"), "cmsis",
              "variants", board.get("build.mcu")[0:7]),
         join(FRAMEWORK_DIR, board.get("build.core"), "spl",
-             "variants", board.get("build.mcu")[0:7], "inc"),
-        join(FRAMEWORK_DIR, board.get("build.core"), "spl",
-             "variants", board.get("build.mcu")[0:7], "src")
+             "variants", board.get("build.mcu")[0:7], "inc")
     ],
     LINKFLAGS=[
         "-nostartfiles"
     ]
 )
 
+# Every include directory is searched for each header on every build
+spl_src_dir = join(FRAMEWORK_DIR, board.get("build.core"),
+                   "spl", "variants",
+                   board.get("build.mcu")[0:7], "src")
+if isdir(spl_src_dir) and any(f.endswith(".h") for f in listdir(spl_src_dir)):
+    env.Append(CPPPATH=[spl_src_dir])
+
 env.Append(
     CPPDEFINES=[
         "USE_STDPERIPH_DRIVER"
     ]
 )
 
+def get_spl_src_filter(src_dir, inc_dirs):
+    """Includes drivers of peripherals whose headers are included by the
+    project, directly or through other headers such as stm32f4xx.h, and
+    drivers which they use in turn"""
+
+    extra_flags = board.get("build.extra_flags", "")
+    exclude_filter = [
+        "-<%s>" % name
+        for define, name in SPL_EXCLUDED_SOURCES
+        if define in extra_flags
+    ]
+    if board.get("build.spl.modules_filter", "yes") != "yes":
+        return ["+<*>"] + exclude_filter
+
+    include_cache = IncludeCache(
+        join(env.subst("$BUILD_DIR"), "spl-includes.json"))
+    provided, included = scan_headers(
+        get_project_source_dirs(env), include_cache)
+    sources = []
+    pending = list(included)
+    seen = set(pending)
+    while pending:
+        name = pending.pop()
+        paths = []
+        # Project headers, e.g. stm32f4xx_conf.h, are already scanned
+        if name not in provided:
+            paths.extend(
+                [join(d, name) for d in inc_dirs if isfile(join(d, name))][:1])
+        source_name = splitext(name)[0] + ".c"
+        if name.endswith(".h") and isfile(join(src_dir, source_name)):
+            sources.append(source_name)
+            paths.append(join(src_dir, source_name))
+        for path in paths:
+            for include in include_cache.get_includes(path):
+                if include not in seen:
+                    seen.add(include)
+                    pending.append(include)
+    include_cache.save()
+
+    return ["-<*>"] + ["+<%s>" % name for name in sorted(sources)] + exclude_filter
+
+
 if not board.get("build.ldscript", ""):
     env.Replace(
         LDSCRIPT_PATH=get_linker_script(board.get("build.mcu")))
 
+if board.get("build.precompiled_header", "no") == "yes":
+    # Device header of the family, e.g. stm32f4xx.h or stm32f10x.h
+    cmsis_variant_dir = join(FRAMEWORK_DIR, board.get("build.core"), "cmsis",
+                             "variants", board.get("build.mcu")[0:7])
+    for device_header in (board.get("build.mcu")[0:7] + "xx.h",
+                          board.get("build.mcu")[0:9] + "x.h"):
+        if isfile(join(cmsis_variant_dir, device_header)):
+            add_precompiled_header(
+                env, join(cmsis_variant_dir, device_header),
+                join("$BUILD_DIR", "FrameworkPCH"))
+            break
+
 #
 # Target: Build SPL Library
 #
 
-extra_flags = board.get("build.extra_flags", "")
-src_filter_patterns = ["+<*>"]
-if "STM32F40_41xxx" in extra_flags:
-    src_filter_patterns += ["-<stm32f4xx_fmc.c>"]
-if "STM32F427_437xx" in extra_flags:
-    src_filter_patterns += ["-<stm32f4xx_fsmc.c>"]
-elif "STM32F303xC" in extra_flags:
-    src_filter_patterns += ["-<stm32f30x_hrtim.c>"]
-elif "STM32L1XX_MD" in extra_flags:
-    src_filter_patterns += ["-<stm32l1xx_flash_ramfunc.c>"]
-
 libs = []
 
-libs.append(env.BuildLibrary(
+libs.append(clone_framework_env(
+    env, clone_library_env(env, "cmsis"), "FrameworkCMSIS"
+).BuildLibrary(
     join("$BUILD_DIR", "FrameworkCMSISVariant"),
     join(
         FRAMEWORK_DIR, board.get("build.core"), "cmsis",
@@ -124,12 +182,29 @@ libs.append(env.BuildLibrary(
     )
 ))
 
-libs.append(env.BuildLibrary(
-    join("$BUILD_DIR", "FrameworkSPL"),
-    join(FRAMEWORK_DIR, board.get("build.core"),
-         "spl", "variants",
-         board.get("build.mcu")[0:7], "src"),
-    src_filter=" ".join(src_filter_patterns)
-))
+spl_src_filter = get_spl_src_filter(spl_src_dir, [
+    join(FRAMEWORK_DIR, board.get("build.core"), "spl",
+         "variants", board.get("build.mcu")[0:7], "inc"),
+    join(FRAMEWORK_DIR, board.get("build.core"), "cmsis",
+         "variants", board.get("build.mcu")[0:7]),
+])
+
+# The project might not use any peripheral driver
+if any(pattern.startswith("+") for pattern in spl_src_filter):
+    spl_env = clone_framework_env(
+        env, clone_library_env(env, "spl"), "FrameworkSPL")
+    spl_build_dir = join("$BUILD_DIR", "FrameworkSPL")
+    spl_nodes = None
+    if int(board.get("build.unity_batches", 0)):
+        spl_nodes = build_unity_objects(
+            spl_env, spl_build_dir, spl_src_dir, " ".join(spl_src_filter),
+            int(board.get("build.unity_batches")))
+
+    libs.append(spl_env.BuildLibrary(
+        spl_build_dir,
+        spl_src_dir,
+        src_filter=" ".join(spl_src_filter),
+        nodes=spl_nodes
+    ))
 
 env.Append(LIBS=libs)
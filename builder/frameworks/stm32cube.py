@@ -22,16 +22,27 @@ The Low-Layer (LL) APIs, a light-weight, optimized, expert oriented set of APIs
 http://www.st.com/en/embedded-software/stm32cube-embedded-software.html?querycriteria=productId=LN1897
 """
 
+import hashlib
 import os
-import shutil
-import string
 import sys
 import re
 
-from SCons.Script import ARGUMENTS, DefaultEnvironment
+from SCons.Node import FS
+from SCons.Script import DefaultEnvironment, Flatten
 
 from platformio.builder.tools.piolib import PlatformIOLibBuilder
 
+from fpu import get_float_abi, get_fpu_flags
+from ldscriptgen import add_generated_linker_script
+from ldscripts import find_linker_script
+from libindex import (IncludeCache, get_project_source_dirs, load_lib_index,
+                      scan_headers, select_libs)
+from objcache import ObjectCache, get_dir_signature, get_key
+from pch import add_precompiled_header
+from profiles import clone_library_env, get_profile_flags
+from scancache import clone_framework_env
+from unitybuild import build_unity_objects
+
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 board = env.BoardConfig()
@@ -42,10 +53,39 @@ MCU_FAMILY = MCU[0:7]
 PRODUCT_LINE = board.get("build.product_line", "")
 assert PRODUCT_LINE, "Missing MCU or Product Line field"
 
-FRAMEWORK_DIR = platform.get_package_dir("framework-stm32cube%s" % MCU[5:7])
+FRAMEWORK_NAME = "framework-stm32cube%s" % MCU[5:7]
+FRAMEWORK_DIR = platform.get_package_dir(FRAMEWORK_NAME)
 LDSCRIPTS_DIR = platform.get_package_dir("tool-ldscripts-ststm32")
 assert all(os.path.isdir(d) for d in (FRAMEWORK_DIR, LDSCRIPTS_DIR))
 
+# Generated files are kept in the build directory, so packages stay intact
+# and can be used by several builds at the same time
+CONFIG_DIR = os.path.join(env.subst("$BUILD_DIR"), "FrameworkConfig")
+
+# "hal" builds the HAL with the low-layer drivers it uses, "ll" builds only
+# the low-layer drivers without HAL
+DRIVERS = board.get("build.stm32cube.drivers", "hal")
+if DRIVERS not in ("hal", "ll"):
+    sys.stderr.write(
+        "Error: Unknown STM32Cube drivers `%s`, please use `hal` or `ll`\n"
+        % DRIVERS
+    )
+    env.Exit(1)
+
+
+# Low-layer drivers -> HAL modules which use them
+HAL_LL_DEPENDENCIES = (
+    ("usb", ("PCD", "HCD")),
+    ("fmc", ("SRAM", "NOR", "NAND", "SDRAM", "PCCARD")),
+    ("fsmc", ("SRAM", "NOR", "NAND", "PCCARD")),
+    ("sdmmc", ("SD", "MMC", "SDIO")),
+    ("delayblock", ("SD", "MMC", "QSPI", "OSPI", "XSPI")),
+    ("dlyb", ("SD", "MMC", "OSPI", "XSPI")),
+)
+
+# Libraries embedded in the framework, `(path, manifest)`
+EMBEDDED_LIBS = []
+
 
 class CustomLibBuilder(PlatformIOLibBuilder):
 
@@ -55,88 +95,59 @@ class CustomLibBuilder(PlatformIOLibBuilder):
         return PlatformIOLibBuilder.build(self)
 
 
-def generate_ldscript(default_ldscript_path):
-    ram = board.get("upload.maximum_ram_size", 0)
-    flash = board.get("upload.maximum_size", 0)
-    template_file = os.path.join(LDSCRIPTS_DIR, "tpl", "linker.tpl")
-    content = ""
-    with open(template_file) as fp:
-        data = string.Template(fp.read())
-        content = data.substitute(
-            stack=hex(0x20000000 + ram),  # 0x20000000 - start address for RAM
-            ram=str(int(ram / 1024)) + "K",
-            flash=str(int(flash / 1024)) + "K",
-        )
-
-    with open(default_ldscript_path, "w") as fp:
+def write_file(path, content):
+    # Unchanged files are not rewritten to keep the targets up to date
+    if os.path.isfile(path):
+        with open(path) as fp:
+            if fp.read() == content:
+                return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fp:
         fp.write(content)
 
 
 def get_linker_script(board_mcu, board_cpu):
-    def _glob_re(pattern, ldscripts):
-        re_c = re.compile(pattern)
-        return list(filter(re_c.match, ldscripts))
-
     if len(board_mcu) > 12:
         board_mcu = board_mcu[:12] + "X" + board_mcu[13:]
 
-    family_ldscripts_dir = os.path.join(LDSCRIPTS_DIR, board_mcu[0:7])
-
-    ldscript_matches = _glob_re(
-        "^%s.*_FLASH\\.ld$" % board_mcu.upper(),
-        os.listdir(family_ldscripts_dir),
-    )
+    if board.get("build.generate_ldscript", "no") != "yes":
+        ldscript = find_linker_script(
+            env, "tool-ldscripts-ststm32", LDSCRIPTS_DIR, board_mcu[0:7],
+            board_mcu, board_cpu)
+        if ldscript:
+            return ldscript
 
-    if ldscript_matches:
-        ldscript_file = ldscript_matches[0]
-        if len(ldscript_matches) > 1:
-            # Precise match with the CPU in filename has the highest priority
-            board_cpu = board_cpu.replace("cortex-", "").upper()
-            for match in ldscript_matches:
-                if board_cpu in match:
-                    ldscript_file = match
-                    break
-
-            if int(ARGUMENTS.get("PIOVERBOSE", 0)):
-                print(
-                    "Found suitable linker scripts: ["
-                    + ", ".join(ldscript_matches)
-                    + "], %s will be used!" % ldscript_file
-                )
-
-        return os.path.join(family_ldscripts_dir, ldscript_file)
-
-    # Fall back to an auto-generated linker script
-    print(
-        "Warning! Cannot find a linker script for the required board! "
-        "An auto-generated script will be used to link firmware!"
-    )
+        # Fall back to an auto-generated linker script
+        print(
+            "Warning! Cannot find a linker script for the required board! "
+            "An auto-generated script will be used to link firmware!"
+        )
 
-    default_ldscript = os.path.join(
-        LDSCRIPTS_DIR, board_mcu[0:7], board_mcu[0:11].upper() + "_DEFAULT.ld"
+    return add_generated_linker_script(
+        env, os.path.join(CONFIG_DIR, board_mcu[0:11].upper() + "_DEFAULT.ld")
     )
 
-    if not os.path.isfile(default_ldscript):
-        generate_ldscript(default_ldscript)
-
-    return default_ldscript
 
+def prepare_startup_file(src_path, startup_name):
+    """Returns a node of the startup file copied to the build directory
+    if the framework provides it only with the lowercase `.s` extension,
+    such files are not preprocessed"""
 
-def prepare_startup_file(src_path):
-    startup_file = os.path.join(src_path, "gcc", "startup_%s.S" % PRODUCT_LINE.lower())
-    # Change file extension to uppercase
-    if not os.path.isfile(startup_file) and os.path.isfile(startup_file[:-2] + ".s"):
-        try:
-            os.replace(startup_file[:-2] + ".s", startup_file)
-        except (FileNotFoundError, FileExistsError):
-            print("Startup file was already renamed by another process.")
-
-    if not os.path.isfile(startup_file):
-        print(
-            "Warning! Cannot find the default startup file for `%s`. "
-            "Ignore this warning if the startup code is part of your project." % MCU
+    startup_file = os.path.join(src_path, "gcc", startup_name)
+    if os.path.isfile(startup_file):
+        return None
+    if startup_file.endswith(".S") and os.path.isfile(startup_file[:-2] + ".s"):
+        return env.InstallAs(
+            os.path.join("$BUILD_DIR", "FrameworkStartup", startup_name),
+            startup_file[:-2] + ".s",
         )
 
+    print(
+        "Warning! Cannot find the default startup file for `%s`. "
+        "Ignore this warning if the startup code is part of your project." % MCU
+    )
+    return None
+
 
 def generate_hal_config_file():
     config_path = os.path.join(
@@ -146,23 +157,209 @@ def generate_hal_config_file():
         "Inc",
     )
 
-    conf_h_path = os.path.join(config_path, MCU_FAMILY + "xx_hal_conf.h")
+    conf_h_path = os.path.join(CONFIG_DIR, MCU_FAMILY + "xx_hal_conf.h")
     template_h_path = os.path.join(config_path, MCU_FAMILY + "xx_hal_conf_template.h")
 
     if board.get("build.stm32cube.custom_config_header", "no") == "yes":
         if os.path.isfile(conf_h_path):
             os.remove(conf_h_path)
-    else:
-        if os.path.isfile(conf_h_path):
-            return
+        # Older versions of the platform generated the file in the package,
+        # it would be used instead of the project one
+        try:
+            os.remove(os.path.join(config_path, MCU_FAMILY + "xx_hal_conf.h"))
+        except FileNotFoundError:
+            pass
+        return
 
-        if not os.path.isfile(template_h_path):
-            sys.stderr.write(
-                "Error: Cannot find peripheral template file to configure framework!\n"
+    if not os.path.isfile(template_h_path):
+        sys.stderr.write(
+            "Error: Cannot find peripheral template file to configure framework!\n"
+        )
+        env.Exit(1)
+
+    with open(template_h_path) as fp:
+        write_file(conf_h_path, fp.read())
+    # The generated file takes precedence over project files as before
+    env.Prepend(CPPPATH=[CONFIG_DIR])
+
+
+def find_header(name, extra_dirs=None):
+    # The same order as the compiler uses for "stm32xxxx_hal.h" includes
+    for d in (extra_dirs or []) + [
+        os.path.join(
+            FRAMEWORK_DIR, "Drivers", MCU_FAMILY.upper() + "xx_HAL_Driver", "Inc"),
+        CONFIG_DIR,
+        env.subst("$PROJECT_SRC_DIR"),
+        env.subst("$PROJECT_INCLUDE_DIR"),
+    ]:
+        if os.path.isfile(os.path.join(d, name)):
+            return os.path.join(d, name)
+    return None
+
+
+def get_hal_config_digest():
+    digest = hashlib.sha1()
+    conf_h_path = find_header(MCU_FAMILY + "xx_hal_conf.h")
+    if not conf_h_path:
+        return None
+    with open(conf_h_path, "rb") as fp:
+        content = fp.read()
+    digest.update(content)
+    # Project headers included by the configuration file, e.g. "main.h"
+    for name in re.findall(rb'#\s*include\s+"([^"]+)"', content):
+        header_path = find_header(
+            name.decode(), [os.path.dirname(conf_h_path)])
+        if header_path and header_path.startswith(env.subst("$PROJECT_DIR")):
+            with open(header_path, "rb") as fp:
+                digest.update(fp.read())
+    return digest.hexdigest()
+
+
+def get_cppdefine_names():
+    return [
+        d[0] if isinstance(d, (list, tuple)) else str(d).split("=")[0]
+        for d in env.get("CPPDEFINES", [])
+    ]
+
+
+def get_hal_src_filter(hal_dir, default_filter):
+    """Excludes sources of HAL modules disabled in hal_conf.h. The driver
+    files are guarded by HAL_<MODULE>_MODULE_ENABLED, so they would be
+    compiled to empty objects anyway"""
+
+    if board.get("build.stm32cube.hal_modules_filter", "yes") != "yes":
+        return default_filter
+
+    conf_h_path = find_header(MCU_FAMILY + "xx_hal_conf.h")
+    src_dir = os.path.join(hal_dir, "Src")
+    if not conf_h_path or not os.path.isdir(src_dir):
+        return default_filter
+
+    with open(conf_h_path) as fp:
+        content = fp.read()
+    # Modules which can be configured, some of them only in the template
+    known_modules = set(re.findall(r"\bHAL_(\w+?)_MODULE_ENABLED\b", content))
+    template_path = os.path.join(
+        hal_dir, "Inc", MCU_FAMILY + "xx_hal_conf_template.h")
+    if os.path.isfile(template_path):
+        with open(template_path) as fp:
+            known_modules.update(
+                re.findall(r"\bHAL_(\w+?)_MODULE_ENABLED\b", fp.read()))
+
+    content = re.sub(r"/\*.*?\*/|//[^\n]*", "", content, flags=re.S)
+    enabled_modules = set(
+        re.findall(r"^\s*#\s*define\s+HAL_(\w+?)_MODULE_ENABLED\b", content, re.M))
+    cppdefines = get_cppdefine_names()
+    for name in cppdefines:
+        match = re.match(r"^HAL_(\w+?)_MODULE_ENABLED$", name)
+        if match:
+            enabled_modules.add(match.group(1))
+    full_ll_driver = "USE_FULL_LL_DRIVER" in cppdefines or re.search(
+        r"^\s*#\s*define\s+USE_FULL_LL_DRIVER\b", content, re.M)
+
+    src_filter = [default_filter]
+    prefix = MCU_FAMILY + "xx_"
+    for filename in sorted(os.listdir(src_dir)):
+        if not filename.startswith(prefix) or not filename.endswith(".c"):
+            continue
+        name = filename[len(prefix):-2]
+        if name.startswith("hal_"):
+            module = name[4:].split("_")[0].upper()
+            if module not in known_modules or module in enabled_modules:
+                continue
+        elif name.startswith("ll_"):
+            if full_ll_driver:
+                continue
+            # Low-layer drivers used by HAL modules, others are built only
+            # with USE_FULL_LL_DRIVER
+            ll_modules = next(
+                (
+                    modules
+                    for ll_name, modules in HAL_LL_DEPENDENCIES
+                    if name[3:] == ll_name
+                ),
+                (),
             )
-            env.Exit(1)
+            if enabled_modules.intersection(ll_modules):
+                continue
+        else:
+            continue
+        src_filter.append("-<Src/%s>" % filename)
+
+    return src_filter
+
+
+def get_ll_src_filter(hal_dir):
+    """Includes only low-layer drivers, except for those which are built
+    on top of HAL, e.g. USB or FMC"""
+
+    src_filter = ["-<*>"]
+    src_dir = os.path.join(hal_dir, "Src")
+    if not os.path.isdir(src_dir):
+        return src_filter
+    prefix = MCU_FAMILY + "xx_ll_"
+    hal_based = [ll_name for ll_name, _ in HAL_LL_DEPENDENCIES]
+    for filename in sorted(os.listdir(src_dir)):
+        if (
+            filename.startswith(prefix)
+            and filename.endswith(".c")
+            and "_template" not in filename
+            and filename[len(prefix):-2] not in hal_based
+        ):
+            src_filter.append("+<Src/%s>" % filename)
+    return src_filter
+
+
+def get_objects_cache():
+    if board.get("build.stm32cube.shared_cache", "no") != "yes":
+        return None
+    return ObjectCache(
+        os.path.join(
+            env.GetProjectConfig().get("platformio", "cache_dir"),
+            "stm32cube-objects",
+        ),
+        int(board.get("build.stm32cube.shared_cache_size", 512)) * 1024 * 1024,
+    )
+
+
+def get_objects_cache_key(build_env, src_dir, *extra):
+    # Project paths differ between projects and don't affect the objects
+    project_dirs = (env.subst("$PROJECT_DIR"), env.subst("$BUILD_DIR"))
+    include_dirs = [
+        env.subst(d) for d in build_env.get("CPPPATH", [])
+        if not env.subst(d).startswith(project_dirs)
+    ]
+    return get_key(
+        FRAMEWORK_NAME,
+        platform.get_package_version(FRAMEWORK_NAME),
+        FRAMEWORK_DIR,
+        MCU_FAMILY,
+        PRODUCT_LINE,
+        platform.get_package_version("toolchain-gccarmnoneeabi"),
+        build_env.subst(
+            "$CC $AS $CCFLAGS $CFLAGS $ASFLAGS $ASPPFLAGS $_CPPDEFFLAGS"),
+        include_dirs,
+        # Flags changed by PlatformIO after framework scripts
+        env.GetBuildType(),
+        env.get("BUILD_UNFLAGS"),
+        env.GetProjectOption("debug_build_flags"),
+        get_hal_config_digest() if DRIVERS == "hal" else None,
+        get_dir_signature(src_dir),
+        *extra
+    )
+
 
-        shutil.copy(template_h_path, conf_h_path)
+def store_in_cache(objects_cache, key, base_dir, files_func):
+    def _store(target, source, env):  # pylint: disable=W0613,W0621
+        try:
+            objects_cache.store(key, env.subst(base_dir), files_func())
+        except OSError as exc:
+            print("Warning! Could not store objects in the shared cache: %s" % exc)
+
+    env.AddPostAction(
+        os.path.join("$BUILD_DIR", "${PROGNAME}.elf"),
+        env.VerboseAction(_store, "Storing framework objects in the shared cache"),
+    )
 
 
 def build_custom_lib(lib_path, lib_manifest=None):
@@ -172,11 +369,43 @@ def build_custom_lib(lib_path, lib_manifest=None):
         return
     if lib_path:
         lib_manifest = lib_manifest or {"name": os.path.basename(lib_path)}
-        env.Append(
-            EXTRA_LIB_BUILDERS=[
-                CustomLibBuilder(env, lib_path, lib_manifest.copy())
-            ]
+        EMBEDDED_LIBS.append((lib_path, lib_manifest.copy()))
+
+
+def register_embedded_libs():
+    """Passes embedded libraries to the Library Dependency Finder. Only
+    libraries which provide headers included by the project are passed,
+    scanning all of them would slow down every build"""
+
+    lib_dirs = [path for path, _ in EMBEDDED_LIBS]
+    if lib_dirs and board.get("build.stm32cube.libs_on_demand", "yes") == "yes":
+        index = load_lib_index(
+            os.path.join(
+                env.GetProjectConfig().get("platformio", "cache_dir"),
+                "stm32cube-libs",
+                get_key(
+                    FRAMEWORK_NAME,
+                    platform.get_package_version(FRAMEWORK_NAME),
+                    FRAMEWORK_DIR,
+                ) + ".json",
+            ),
+            lib_dirs,
         )
+        include_cache = IncludeCache(
+            os.path.join(env.subst("$BUILD_DIR"), "stm32cube-includes.json"))
+        provided, included = scan_headers(
+            get_project_source_dirs(env), include_cache)
+        include_cache.save()
+        # Project headers take precedence over headers of the libraries
+        lib_dirs = select_libs(index, included - provided)
+
+    env.Append(
+        EXTRA_LIB_BUILDERS=[
+            CustomLibBuilder(env, path, manifest)
+            for path, manifest in EMBEDDED_LIBS
+            if path in lib_dirs
+        ]
+    )
 
 
 def build_usb_libs(usb_libs_root):
@@ -204,8 +433,99 @@ def build_usb_libs(usb_libs_root):
             build_custom_lib(os.path.join(usb_class_dir, device_class), manifest)
 
 
+def get_dsp_library_variants():
+    """Returns names of prebuilt DSP libraries which match the core and
+    the float ABI in the order of preference, and the core define"""
+
+    cpu = board.get("build.cpu", "")
+    float_abi, fpu = get_float_abi(env)
+    # Prebuilt libraries with FPU support use the hard-float ABI
+    hard_float = float_abi == "hard"
+    if cpu == "cortex-m7":
+        if not hard_float:
+            variants = ["arm_cortexM7l_math"]
+        elif fpu and "sp" not in fpu:
+            variants = ["arm_cortexM7lfdp_math", "arm_cortexM7lfsp_math"]
+        else:
+            variants = ["arm_cortexM7lfsp_math"]
+        return variants, "ARM_MATH_CM7"
+    if cpu == "cortex-m4":
+        return (
+            ["arm_cortexM4lf_math"] if hard_float else ["arm_cortexM4l_math"],
+            "ARM_MATH_CM4",
+        )
+    if cpu == "cortex-m33":
+        return (
+            ["arm_ARMv8MMLldfsp_math", "arm_ARMv8MMLlfsp_math"]
+            if hard_float
+            else ["arm_ARMv8MMLld_math", "arm_ARMv8MMLl_math"],
+            "ARM_MATH_ARMV8MML",
+        )
+    if cpu == "cortex-m3":
+        return ["arm_cortexM3l_math"], "ARM_MATH_CM3"
+    if cpu == "cortex-m0plus":
+        return ["arm_cortexM0l_math"], "ARM_MATH_CM0PLUS"
+    if cpu == "cortex-m0":
+        return ["arm_cortexM0l_math"], "ARM_MATH_CM0"
+    return [], None
+
+
+def build_dsp_lib(dsp_dir):
+    src_dir = os.path.join(dsp_dir, "Source")
+    if not os.path.isdir(src_dir):
+        sys.stderr.write("Error: Cannot find CMSIS-DSP sources in %s\n" % dsp_dir)
+        env.Exit(1)
+
+    # Recent versions also contain files which include all sources of a group
+    src_filter = ["-<*>"]
+    for group in sorted(os.listdir(src_dir)):
+        group_dir = os.path.join(src_dir, group)
+        if not os.path.isdir(group_dir):
+            continue
+        if os.path.isfile(os.path.join(group_dir, group + ".c")):
+            src_filter.extend(
+                "+<%s/%s>" % (group, f)
+                for f in (group + ".c", group + "F16.c")
+                if os.path.isfile(os.path.join(group_dir, f))
+            )
+        else:
+            src_filter.append("+<%s/*.c>" % group)
+
+    # Debug builds keep the debug flags set by PlatformIO, the profile
+    # is selected with `board_build.dsp_profile`
+    flags = []
+    if "debug" not in env.GetBuildType():
+        flags = list(get_profile_flags(env, "dsp"))
+    if os.path.isdir(os.path.join(dsp_dir, "PrivateInclude")):
+        flags.append("-I %s" % os.path.join(dsp_dir, "PrivateInclude"))
+    # The library is built only if the project includes arm_math.h
+    env.Append(
+        EXTRA_LIB_BUILDERS=[
+            CustomLibBuilder(
+                env,
+                dsp_dir,
+                {
+                    "name": "CMSIS-DSP",
+                    "build": {
+                        "flags": flags,
+                        "includeDir": "Include",
+                        "srcDir": "Source",
+                        "srcFilter": src_filter,
+                    },
+                },
+            )
+        ],
+    )
+    if "-flto" in flags and "-flto" not in env.get("LINKFLAGS", []):
+        # Objects with intermediate code are optimized when linked
+        env.Append(LINKFLAGS=["-flto"])
+
+
 def process_dsp_lib():
-    dsp_lib_path = os.path.join(FRAMEWORK_DIR, "Drivers", "CMSIS", "DSP", "Lib", "GCC")
+    dsp_dir = os.path.join(FRAMEWORK_DIR, "Drivers", "CMSIS", "DSP")
+    if not os.path.isdir(dsp_dir):
+        dsp_dir = os.path.join(FRAMEWORK_DIR, "Drivers", "CMSIS", "DSP_Lib")
+    dsp_lib_path = os.path.join(dsp_dir, "Lib", "GCC")
     if not os.path.isdir(dsp_lib_path):
         dsp_lib_path = os.path.join(FRAMEWORK_DIR, "Drivers", "CMSIS", "Lib", "GCC")
 
@@ -218,11 +538,47 @@ def process_dsp_lib():
         ]
     )
 
+    variants, core_define = get_dsp_library_variants()
+    if core_define and not any(
+        name.startswith(("ARM_MATH_CM", "ARM_MATH_ARMV8M"))
+        for name in get_cppdefine_names()
+    ):
+        env.Append(CPPDEFINES=[core_define])
+
+    dsp_library = board.get("build.stm32cube.dsp_library", "prebuilt")
+    if dsp_library not in ("prebuilt", "source"):
+        sys.stderr.write(
+            "Error: Unknown DSP library type `%s`, please use `prebuilt` or "
+            "`source`\n" % dsp_library
+        )
+        env.Exit(1)
+
+    if dsp_library == "prebuilt":
+        variant = next(
+            (
+                name
+                for name in variants
+                if os.path.isfile(os.path.join(dsp_lib_path, "lib%s.a" % name))
+            ),
+            None,
+        )
+        if variant:
+            # Linked before the standard libraries it depends on, objects
+            # of the archive are linked only if they are used
+            env.Prepend(LIBS=[variant])
+            return
+        print(
+            "Warning! Cannot find a prebuilt DSP library for `%s`, "
+            "the library will be built from source" % board.get("build.cpu", "")
+        )
+
+    build_dsp_lib(dsp_dir)
+
 
 machine_flags = [
     "-mthumb",
     "-mcpu=%s" % board.get("build.cpu"),
-]
+] + get_fpu_flags(env)
 
 env.Append(
     ASFLAGS=machine_flags,
@@ -230,8 +586,7 @@ env.Append(
         "-x", "assembler-with-cpp",
     ],
 
-    CCFLAGS=machine_flags + [
-        "-Os",  # optimize for size
+    CCFLAGS=machine_flags + get_profile_flags(env) + [
         "-ffunction-sections",  # place each function in its own section
         "-fdata-sections",
         "-Wall",
@@ -239,7 +594,7 @@ env.Append(
     ],
 
     CPPDEFINES=[
-        "USE_HAL_DRIVER",
+        "USE_FULL_LL_DRIVER" if DRIVERS == "ll" else "USE_HAL_DRIVER",
         ("F_CPU", "$BOARD_F_CPU")
     ],
 
@@ -262,12 +617,6 @@ env.Append(
             MCU_FAMILY.upper() + "xx_HAL_Driver",
             "Inc",
         ),
-        os.path.join(
-            FRAMEWORK_DIR,
-            "Drivers",
-            MCU_FAMILY.upper() + "xx_HAL_Driver",
-            "Src",
-        ),
     ],
 
     CXXFLAGS=[
@@ -275,8 +624,7 @@ env.Append(
         "-fno-exceptions"
     ],
 
-    LINKFLAGS=machine_flags + [
-        "-Os",
+    LINKFLAGS=machine_flags + get_profile_flags(env) + [
         "-Wl,--gc-sections,--relax",
         "--specs=nano.specs",
         "--specs=nosys.specs",
@@ -289,10 +637,44 @@ env.Append(
     LIBS=["c", "gcc", "m", "stdc++", "nosys"],
 )
 
+# Every include directory is searched for each header on every build,
+# sources of drivers usually don't contain headers
+hal_src_dir = os.path.join(
+    FRAMEWORK_DIR, "Drivers", MCU_FAMILY.upper() + "xx_HAL_Driver", "Src")
+if os.path.isdir(hal_src_dir) and any(
+    f.endswith(".h") for f in os.listdir(hal_src_dir)
+):
+    env.Append(CPPPATH=[hal_src_dir])
+
 if not board.get("build.ldscript", ""):
     env.Replace(LDSCRIPT_PATH=get_linker_script(
         board.get("build.mcu", ""), board.get("build.cpu", "")))
 
+if board.get("build.precompiled_header", "no") == "yes":
+    add_precompiled_header(
+        env,
+        # Low-layer drivers include only the device header
+        os.path.join(
+            FRAMEWORK_DIR,
+            "Drivers",
+            "CMSIS",
+            "Device",
+            "ST",
+            MCU_FAMILY.upper() + "xx",
+            "Include",
+            MCU_FAMILY + "xx.h",
+        )
+        if DRIVERS == "ll"
+        else os.path.join(
+            FRAMEWORK_DIR,
+            "Drivers",
+            MCU_FAMILY.upper() + "xx_HAL_Driver",
+            "Inc",
+            MCU_FAMILY + "xx_hal.h",
+        ),
+        os.path.join("$BUILD_DIR", "FrameworkPCH"),
+    )
+
 #
 # Process BSP components
 #
@@ -303,7 +685,8 @@ if os.path.isdir(components_dir):
     for component in os.listdir(components_dir):
         build_custom_lib(os.path.join(components_dir, component))
 
-if os.path.isdir(os.path.join(bsp_dir, "Adafruit_Shield")):
+# Board drivers, utilities and USB libraries are built on top of HAL
+if DRIVERS == "hal" and os.path.isdir(os.path.join(bsp_dir, "Adafruit_Shield")):
     build_custom_lib(os.path.join(bsp_dir, "Adafruit_Shield"))
 
 #
@@ -311,7 +694,7 @@ if os.path.isdir(os.path.join(bsp_dir, "Adafruit_Shield")):
 #
 
 utils_dir = os.path.join(FRAMEWORK_DIR, "Utilities")
-if os.path.isdir(utils_dir):
+if DRIVERS == "hal" and os.path.isdir(utils_dir):
     for util in os.listdir(utils_dir):
         util_dir = os.path.join(utils_dir, util)
         # Some of utilities is not meant to be built
@@ -336,8 +719,9 @@ if os.path.isdir(utils_dir):
 #
 
 middleware_dir = os.path.join(FRAMEWORK_DIR, "Middlewares", "ST")
-for usb_lib in ("STM32_USB_Device_Library", "STM32_USB_Host_Library"):
-    build_usb_libs(os.path.join(middleware_dir, usb_lib))
+if DRIVERS == "hal":
+    for usb_lib in ("STM32_USB_Device_Library", "STM32_USB_Host_Library"):
+        build_usb_libs(os.path.join(middleware_dir, usb_lib))
 
 #
 # Target: Build HAL Library
@@ -349,13 +733,15 @@ libs = []
 # BSP libraries
 #
 
-if "build.stm32cube.variant" in board:
+if DRIVERS == "hal" and "build.stm32cube.variant" in board:
     bsp_variant_dir = os.path.join(
         FRAMEWORK_DIR, "Drivers", "BSP", board.get("build.stm32cube.variant")
     )
     if os.path.isdir(bsp_variant_dir):
         build_custom_lib(os.path.join(bsp_variant_dir), {"name": "FrameworkVariantBSP"})
 
+register_embedded_libs()
+
 #
 # DSP Library processing
 #
@@ -367,18 +753,51 @@ if board.get("build.stm32cube.custom_dsp_library", "no") == "no":
 # HAL libraries
 #
 
-# Generate a default stm32xxx_hal_conf.h
-generate_hal_config_file()
-
-env.BuildSources(
-    os.path.join("$BUILD_DIR", "FrameworkHALDriver"),
-    os.path.join(
-        FRAMEWORK_DIR,
-        "Drivers",
-        MCU_FAMILY.upper() + "xx_HAL_Driver",
-    ),
-    src_filter="+<*> -<Src/*_template.c> -<Src/Legacy>",
-)
+objects_cache = get_objects_cache()
+
+# Low-layer drivers don't use the HAL configuration file
+if DRIVERS == "hal":
+    # Generate a default stm32xxx_hal_conf.h, its directory must be added
+    # to CPPPATH before the HAL environment is cloned
+    generate_hal_config_file()
+
+hal_env = clone_framework_env(env, clone_library_env(env, "hal"), "FrameworkHAL")
+hal_dir = os.path.join(FRAMEWORK_DIR, "Drivers", MCU_FAMILY.upper() + "xx_HAL_Driver")
+if DRIVERS == "ll":
+    hal_build_dir = os.path.join("$BUILD_DIR", "FrameworkLLDriver")
+    hal_src_filter = get_ll_src_filter(hal_dir)
+else:
+    hal_build_dir = os.path.join("$BUILD_DIR", "FrameworkHALDriver")
+    hal_src_filter = get_hal_src_filter(
+        hal_dir, "+<*> -<Src/*_template.c> -<Src/Legacy>")
+hal_cached_objects = None
+if objects_cache:
+    hal_cache_key = get_objects_cache_key(hal_env, hal_dir, hal_src_filter)
+    hal_cached_objects = objects_cache.lookup(hal_cache_key)
+
+if hal_cached_objects:
+    env.Append(PIOBUILDFILES=[env.File(obj) for obj in hal_cached_objects])
+else:
+    if int(board.get("build.unity_batches", 0)):
+        hal_objects = build_unity_objects(
+            hal_env, hal_build_dir, hal_dir, hal_src_filter,
+            int(board.get("build.unity_batches")))
+    else:
+        # The same as `hal_env.BuildSources()`, but the objects are known
+        hal_objects = [
+            hal_env.Object(node) if isinstance(node, FS.File) else node
+            for node in hal_env.CollectBuildFiles(
+                hal_build_dir, hal_dir, hal_src_filter)
+        ]
+    env.Append(PIOBUILDFILES=hal_objects)
+    if objects_cache:
+        # Objects of other modules might be left in the build directory
+        store_in_cache(
+            objects_cache,
+            hal_cache_key,
+            hal_build_dir,
+            lambda: [node.get_abspath() for node in Flatten(hal_objects)],
+        )
 
 #
 # CMSIS library
@@ -396,24 +815,47 @@ if board.get("build.stm32cube.custom_system_setup", "no") == "no":
         "Templates",
     )
 
-    prepare_startup_file(sources_path)
-    libs.append(
-        env.BuildLibrary(
-            os.path.join("$BUILD_DIR", "FrameworkCMSISDevice"),
+    startup_name = board.get(
+        "build.stm32cube.startup_file", "startup_%s.S" % PRODUCT_LINE.lower()
+    )
+    startup_node = prepare_startup_file(sources_path, startup_name)
+    cmsis_src_filter = [
+        "-<*>",
+        "+<%s>"
+        % board.get(
+            "build.stm32cube.system_file", "system_%sxx.c" % MCU_FAMILY
+        ),
+        "+<gcc/%s>" % startup_name,
+    ]
+    cmsis_env = clone_framework_env(
+        env, clone_library_env(env, "cmsis"), "FrameworkCMSIS")
+    cmsis_cached_objects = None
+    if objects_cache:
+        cmsis_cache_key = get_objects_cache_key(
+            cmsis_env, sources_path, cmsis_src_filter)
+        cmsis_cached_objects = objects_cache.lookup(cmsis_cache_key)
+
+    if cmsis_cached_objects:
+        libs.extend(env.File(lib) for lib in cmsis_cached_objects)
+    else:
+        cmsis_build_dir = os.path.join("$BUILD_DIR", "FrameworkCMSISDevice")
+        cmsis_lib = cmsis_env.BuildLibrary(
+            cmsis_build_dir,
             sources_path,
-            src_filter=[
-                "-<*>",
-                "+<%s>"
-                % board.get(
-                    "build.stm32cube.system_file", "system_%sxx.c" % MCU_FAMILY
-                ),
-                "+<gcc/%s>"
-                % board.get(
-                    "build.stm32cube.startup_file",
-                    "startup_%s.S" % PRODUCT_LINE.lower(),
-                ),
-            ],
+            src_filter=cmsis_src_filter,
+            nodes=(
+                env.CollectBuildFiles(
+                    cmsis_build_dir, sources_path, cmsis_src_filter)
+                + startup_node
+            ) if startup_node else None,
         )
-    )
+        libs.append(cmsis_lib)
+        if objects_cache:
+            store_in_cache(
+                objects_cache,
+                cmsis_cache_key,
+                "$BUILD_DIR",
+                lambda: [cmsis_lib[0].get_abspath()],
+            )
 
 env.Append(LIBS=libs)
@@ -0,0 +1,402 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Generator of linker scripts for MCUs without a script in packages. Besides
+FLASH and RAM, the scripts describe tightly coupled and core coupled
+memories of a family, so code and data can be placed there with section
+attributes:
+
+    __attribute__((section(".fastcode"))) void handler(void);
+    __attribute__((section(".ccmram"))) int table[64];
+    __attribute__((section(".dma_buffers"))) uint8_t rx_buffer[256];
+
+Sections outside of RAM are initialized before constructors are called,
+using copy and zero tables stored in FLASH.
+"""
+
+import os
+import re
+
+K = 1024
+
+DEFAULT_RAM_ORIGIN = 0x20000000
+DEFAULT_FLASH_ORIGIN = 0x08000000
+
+# Product line, required CPU, (RAM origin, RAM size limit) and extra
+# regions as (name, attributes, origin, length). Regions at the RAM origin
+# are carved off the RAM reported by boards
+MEMORY_MAPS = (
+    (r"^STM32F3(03|58)X[BC]", "", None, (
+        ("CCMRAM", "xrw", 0x10000000, 8 * K),
+    )),
+    (r"^STM32F3(03|98)X[DE]", "", None, (
+        ("CCMRAM", "xrw", 0x10000000, 16 * K),
+    )),
+    (r"^STM32F3(03|28|34)X[68]", "", None, (
+        ("CCMRAM", "xrw", 0x10000000, 4 * K),
+    )),
+    # Only the data bus is connected to CCM RAM of F4 devices
+    (r"^STM32F4(05|07|15|17|27|29|37|39|69|79)", "", None, (
+        ("CCMRAM", "rw", 0x10000000, 64 * K),
+    )),
+    (r"^STM32L4(12|22)", "", (DEFAULT_RAM_ORIGIN, 32 * K), (
+        ("SRAM2", "xrw", 0x10000000, 8 * K),
+    )),
+    (r"^STM32L4(31|32|33|42|43)", "", (DEFAULT_RAM_ORIGIN, 48 * K), (
+        ("SRAM2", "xrw", 0x10000000, 16 * K),
+    )),
+    (r"^STM32L4(51|52|62)", "", (DEFAULT_RAM_ORIGIN, 128 * K), (
+        ("SRAM2", "xrw", 0x10000000, 32 * K),
+    )),
+    (r"^STM32L4(71|75|76|85|86)", "", (DEFAULT_RAM_ORIGIN, 96 * K), (
+        ("SRAM2", "xrw", 0x10000000, 32 * K),
+    )),
+    (r"^STM32L4(96|A6)", "", (DEFAULT_RAM_ORIGIN, 256 * K), (
+        ("SRAM2", "xrw", 0x10000000, 64 * K),
+    )),
+    (r"^STM32F7(22|23|30|32|33|45|46|50|56)", "", None, (
+        ("ITCM", "xrw", 0x00000000, 16 * K),
+        ("DTCM", "rw", DEFAULT_RAM_ORIGIN, 64 * K),
+    )),
+    (r"^STM32F7(65|67|68|69|77|78|79)", "", None, (
+        ("ITCM", "xrw", 0x00000000, 16 * K),
+        ("DTCM", "rw", DEFAULT_RAM_ORIGIN, 128 * K),
+    )),
+    (r"^STM32H7(42|43|45|47|50|53|55|57)", "cortex-m7", (0x24000000, 512 * K), (
+        ("ITCM", "xrw", 0x00000000, 64 * K),
+        ("DTCM", "rw", DEFAULT_RAM_ORIGIN, 128 * K),
+        ("RAM_D2", "rw", 0x30000000, 288 * K),
+    )),
+    (r"^STM32H7(23|25|30|33|35)", "cortex-m7", (0x24000000, 320 * K), (
+        ("ITCM", "xrw", 0x00000000, 64 * K),
+        ("DTCM", "rw", DEFAULT_RAM_ORIGIN, 128 * K),
+        ("RAM_D2", "rw", 0x30000000, 32 * K),
+    )),
+)
+
+# Output section, input sections and regions in the order of preference.
+# DMA controllers of H7 devices can't access the DTCM
+FASTCODE_REGIONS = ("ITCM", "CCMRAM", "SRAM2")
+FASTDATA_REGIONS = ("DTCM", "CCMRAM", "SRAM2")
+DMA_REGIONS = ("RAM_D2", "DTCM")
+
+INIT_SOURCE = """/* Generated by PlatformIO, do not edit */
+
+#include <stdint.h>
+
+extern const uint32_t __copy_table_start__[], __copy_table_end__[];
+extern const uint32_t __zero_table_start__[], __zero_table_end__[];
+
+static void __pio_init_memory_sections(void)
+{
+    const uint32_t *entry;
+    uint32_t i;
+
+    for (entry = __copy_table_start__; entry < __copy_table_end__; entry += 3) {
+        const uint32_t *src = (const uint32_t *)(uintptr_t)entry[0];
+        uint32_t *dst = (uint32_t *)(uintptr_t)entry[1];
+        for (i = 0; i < entry[2]; i++) {
+            dst[i] = src[i];
+        }
+    }
+    for (entry = __zero_table_start__; entry < __zero_table_end__; entry += 2) {
+        uint32_t *dst = (uint32_t *)(uintptr_t)entry[0];
+        for (i = 0; i < entry[1]; i++) {
+            dst[i] = 0;
+        }
+    }
+}
+
+/* Called by __libc_init_array() before constructors */
+__attribute__((used, section(".preinit_array")))
+static void (*const __pio_init_memory_sections_ptr)(void) =
+    __pio_init_memory_sections;
+"""
+
+
+def get_memory_regions(board):
+    """Returns `[(name, attributes, origin, length), ...]` for a board,
+    FLASH and RAM are always the first regions"""
+
+    flash_origin = int(
+        board.get("upload.offset_address", hex(DEFAULT_FLASH_ORIGIN)), 0)
+    ram_origin, ram_length = DEFAULT_RAM_ORIGIN, board.get(
+        "upload.maximum_ram_size", 0)
+    extra_regions = ()
+    product_line = (
+        board.get("build.product_line", "") or board.get("build.mcu", "")
+    ).upper()
+    for pattern, cpu, ram, regions in MEMORY_MAPS:
+        if not re.match(pattern, product_line):
+            continue
+        if cpu and board.get("build.cpu", "") != cpu:
+            continue
+        if ram:
+            ram_origin = ram[0]
+            ram_length = min(ram_length, ram[1])
+        for _, _, origin, length in regions:
+            if origin == ram_origin:
+                ram_origin += length
+                ram_length -= length
+        extra_regions = regions
+        break
+
+    return [
+        ("FLASH", "rx", flash_origin, board.get("upload.maximum_size", 0)),
+        ("RAM", "xrw", ram_origin, max(ram_length, 0)),
+    ] + list(extra_regions)
+
+
+def _select_region(regions, preferred, executable=False):
+    for name in preferred:
+        for region, attrs, _, _ in regions:
+            if region == name and (not executable or "x" in attrs):
+                return name
+    return "RAM"
+
+
+def _format_size(value):
+    return "%dK" % (value // K) if value % K == 0 else "%d" % value
+
+
+def generate_linker_script(board, min_heap_size=0x200, min_stack_size=0x400):
+    regions = get_memory_regions(board)
+    fastcode_region = _select_region(regions, FASTCODE_REGIONS, executable=True)
+    fastdata_region = _select_region(regions, FASTDATA_REGIONS)
+    dma_region = _select_region(regions, DMA_REGIONS)
+
+    lines = [
+        "/* Generated by PlatformIO, do not edit */",
+        "",
+        "ENTRY(Reset_Handler)",
+        "",
+        "_estack = ORIGIN(RAM) + LENGTH(RAM);",
+        "_Min_Heap_Size = 0x%X;" % min_heap_size,
+        "_Min_Stack_Size = 0x%X;" % min_stack_size,
+        "",
+        "MEMORY",
+        "{",
+    ]
+    lines.extend(
+        "  %-8s (%s) : ORIGIN = 0x%08X, LENGTH = %s"
+        % (name, attrs, origin, _format_size(length))
+        for name, attrs, origin, length in regions
+    )
+    lines.extend(["}", ""])
+
+    lines.append(
+        """SECTIONS
+{
+  .isr_vector :
+  {
+    . = ALIGN(4);
+    KEEP(*(.isr_vector))
+    . = ALIGN(4);
+  } >FLASH
+
+  .text :
+  {
+    . = ALIGN(4);
+    *(.text)
+    *(.text*)
+    *(.glue_7)
+    *(.glue_7t)
+    *(.eh_frame)
+
+    KEEP (*(.init))
+    KEEP (*(.fini))
+
+    . = ALIGN(4);
+    _etext = .;
+  } >FLASH
+
+  .rodata :
+  {
+    . = ALIGN(4);
+    *(.rodata)
+    *(.rodata*)
+    . = ALIGN(4);
+  } >FLASH
+
+  .ARM.extab : { *(.ARM.extab* .gnu.linkonce.armextab.*) } >FLASH
+  .ARM :
+  {
+    __exidx_start = .;
+    *(.ARM.exidx*)
+    __exidx_end = .;
+  } >FLASH
+
+  .preinit_array :
+  {
+    PROVIDE_HIDDEN (__preinit_array_start = .);
+    KEEP (*(.preinit_array*))
+    PROVIDE_HIDDEN (__preinit_array_end = .);
+  } >FLASH
+  .init_array :
+  {
+    PROVIDE_HIDDEN (__init_array_start = .);
+    KEEP (*(SORT(.init_array.*)))
+    KEEP (*(.init_array*))
+    PROVIDE_HIDDEN (__init_array_end = .);
+  } >FLASH
+  .fini_array :
+  {
+    PROVIDE_HIDDEN (__fini_array_start = .);
+    KEEP (*(SORT(.fini_array.*)))
+    KEEP (*(.fini_array*))
+    PROVIDE_HIDDEN (__fini_array_end = .);
+  } >FLASH
+
+  .copy_table :
+  {
+    . = ALIGN(4);
+    __copy_table_start__ = .;
+    LONG (LOADADDR(.fastcode))
+    LONG (ADDR(.fastcode))
+    LONG (SIZEOF(.fastcode) / 4)
+    LONG (LOADADDR(.ccmram))
+    LONG (ADDR(.ccmram))
+    LONG (SIZEOF(.ccmram) / 4)
+    __copy_table_end__ = .;
+    __zero_table_start__ = .;
+    LONG (ADDR(.ccmram_bss))
+    LONG (SIZEOF(.ccmram_bss) / 4)
+    LONG (ADDR(.dma_buffers))
+    LONG (SIZEOF(.dma_buffers) / 4)
+    __zero_table_end__ = .;
+  } >FLASH
+
+  /* Code executed from zero-wait-state memory */
+  .fastcode :
+  {
+    . = ALIGN(4);
+    __fastcode_start__ = .;
+    *(.fastcode)
+    *(.fastcode.*)
+    *(.ramfunc)
+    *(.ramfunc.*)
+    *(.itcm)
+    *(.itcm.*)
+    . = ALIGN(4);
+    __fastcode_end__ = .;
+  } >%(fastcode)s AT> FLASH
+
+  .ccmram :
+  {
+    . = ALIGN(4);
+    __ccmram_start__ = .;
+    *(.ccmram)
+    *(.ccmram.*)
+    *(.dtcm)
+    *(.dtcm.*)
+    . = ALIGN(4);
+    __ccmram_end__ = .;
+  } >%(fastdata)s AT> FLASH
+
+  .ccmram_bss (NOLOAD) :
+  {
+    . = ALIGN(4);
+    *(.ccmram_bss)
+    *(.ccmram_bss.*)
+    *(.dtcm_bss)
+    *(.dtcm_bss.*)
+    . = ALIGN(4);
+  } >%(fastdata)s
+
+  .dma_buffers (NOLOAD) :
+  {
+    . = ALIGN(32);
+    *(.dma_buffers)
+    *(.dma_buffers.*)
+    . = ALIGN(32);
+  } >%(dma)s
+
+  _sidata = LOADADDR(.data);
+
+  .data :
+  {
+    . = ALIGN(4);
+    _sdata = .;
+    *(.data)
+    *(.data*)
+    *(.RamFunc)
+    *(.RamFunc*)
+
+    . = ALIGN(4);
+    _edata = .;
+  } >RAM AT> FLASH
+
+  . = ALIGN(4);
+  .bss :
+  {
+    _sbss = .;
+    __bss_start__ = _sbss;
+    *(.bss)
+    *(.bss*)
+    *(COMMON)
+
+    . = ALIGN(4);
+    _ebss = .;
+    __bss_end__ = _ebss;
+  } >RAM
+
+  PROVIDE ( end = _ebss );
+  PROVIDE ( _end = _ebss );
+
+  ._user_heap_stack (NOLOAD) :
+  {
+    . = ALIGN(8);
+    . = . + _Min_Heap_Size;
+    . = . + _Min_Stack_Size;
+    . = ALIGN(8);
+  } >RAM
+
+  /DISCARD/ :
+  {
+    libc.a ( * )
+    libm.a ( * )
+    libgcc.a ( * )
+  }
+
+  .ARM.attributes 0 : { *(.ARM.attributes) }
+}
+
+ASSERT(_ebss + _Min_Heap_Size + _Min_Stack_Size <= _estack,
+       "Error: RAM is too small for the heap and stack")"""
+        % dict(fastcode=fastcode_region, fastdata=fastdata_region, dma=dma_region)
+    )
+    return "\n".join(lines) + "\n"
+
+
+def _write_file(path, content):
+    # Unchanged files are not rewritten to keep the firmware up to date
+    if os.path.isfile(path):
+        with open(path) as fp:
+            if fp.read() == content:
+                return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fp:
+        fp.write(content)
+
+
+def add_generated_linker_script(env, ldscript_path):
+    """Generates a linker script for the board of `env` and adds the code
+    which initializes the extra memory sections to the build"""
+
+    _write_file(ldscript_path, generate_linker_script(env.BoardConfig()))
+    init_source = os.path.splitext(ldscript_path)[0] + "_init.c"
+    _write_file(init_source, INIT_SOURCE)
+    env.Append(PIOBUILDFILES=[env.Object(init_source)])
+    return ldscript_path
@@ -0,0 +1,110 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Lookup of linker scripts shipped with packages. Names of the available
+scripts are indexed once per package version and stored in the PlatformIO
+cache directory, so builds don't list and filter package directories.
+"""
+
+import hashlib
+import json
+import os
+
+from SCons.Script import ARGUMENTS
+
+INDEX_VERSION = 1
+
+_indexes = {}
+
+
+def _build_index(ldscripts_dir):
+    """Returns `{subdir: [script, ...]}` of linker scripts for flash memory"""
+    index = {}
+    for root, _, files in os.walk(ldscripts_dir):
+        names = sorted(f for f in files if f.endswith("_FLASH.ld"))
+        if names:
+            subdir = os.path.relpath(root, ldscripts_dir).replace(os.sep, "/")
+            index["" if subdir == "." else subdir] = names
+    return index
+
+
+def load_index(ldscripts_dir, version, cache_dir):
+    if ldscripts_dir in _indexes:
+        return _indexes[ldscripts_dir]
+
+    index_path = os.path.join(
+        cache_dir,
+        "ldscripts-%s.json" % hashlib.sha1(ldscripts_dir.encode()).hexdigest()[:10],
+    )
+    index = None
+    try:
+        with open(index_path) as fp:
+            data = json.load(fp)
+        if (
+            data["index_version"] == INDEX_VERSION
+            and data["version"] == version
+            and data["dir"] == ldscripts_dir
+        ):
+            index = data["scripts"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    if index is None:
+        index = _build_index(ldscripts_dir)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(index_path + ".tmp", "w") as fp:
+                json.dump(
+                    {
+                        "index_version": INDEX_VERSION,
+                        "version": version,
+                        "dir": ldscripts_dir,
+                        "scripts": index,
+                    },
+                    fp,
+                )
+            os.replace(index_path + ".tmp", index_path)
+        except OSError:
+            pass
+
+    _indexes[ldscripts_dir] = index
+    return index
+
+
+def find_linker_script(env, package, ldscripts_dir, subdir, prefix, cpu=""):
+    """Returns a path to the linker script with a name starting with
+    `prefix` or None. Scripts with the CPU core in the name are preferred,
+    then the shortest name and the name order decide"""
+
+    index = load_index(
+        ldscripts_dir,
+        env.PioPlatform().get_package_version(package),
+        env.GetProjectConfig().get("platformio", "cache_dir"),
+    )
+    prefix = prefix.upper()
+    candidates = [name for name in index.get(subdir, []) if name.startswith(prefix)]
+    if not candidates:
+        return None
+
+    cpu = cpu.replace("cortex-", "").upper()
+    candidates.sort(key=lambda name: (bool(cpu) and cpu not in name, len(name), name))
+    if int(ARGUMENTS.get("PIOVERBOSE", 0)):
+        print(
+            "Found suitable linker scripts: ["
+            + ", ".join(candidates)
+            + "], %s will be used!" % candidates[0]
+        )
+
+    return os.path.join(ldscripts_dir, subdir, candidates[0])
@@ -0,0 +1,174 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Index of headers provided by libraries embedded in framework packages.
+A library is passed to the Library Dependency Finder only if the project
+includes one of its headers, directly or through other libraries. The
+index is stored once per framework package.
+"""
+
+import json
+import os
+import re
+import tempfile
+
+INCLUDE_RE = re.compile(rb'^[ \t]*#[ \t]*include[ \t]*[<"]([^>"]+)[>"]', re.M)
+
+HEADER_EXTS = (".h", ".hh", ".hpp", ".hxx")
+SOURCE_EXTS = HEADER_EXTS + (".c", ".cc", ".cpp", ".cxx", ".ino", ".S", ".s")
+
+
+def read_includes(path):
+    """Returns names of headers included by a file without directories"""
+    try:
+        with open(path, "rb") as fp:
+            content = fp.read()
+    except OSError:
+        return set()
+    return set(
+        os.path.basename(m.decode("utf-8", "ignore").strip())
+        for m in INCLUDE_RE.findall(content)
+    )
+
+
+class IncludeCache:
+    """Includes of files stored between builds, a file is read again when
+    its modification time or size changes"""
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.entries = {}
+        self.changed = False
+        try:
+            with open(cache_path) as fp:
+                self.entries = json.load(fp)
+        except (OSError, ValueError):
+            pass
+        if not isinstance(self.entries, dict):
+            self.entries = {}
+
+    def get_includes(self, path):
+        """The same as `read_includes`"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return set()
+        signature = [st.st_mtime_ns, st.st_size]
+        entry = self.entries.get(path)
+        if not entry or entry[0] != signature:
+            entry = [signature, sorted(read_includes(path))]
+            self.entries[path] = entry
+            self.changed = True
+        return set(entry[1])
+
+    def save(self):
+        if not self.changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.cache_path), prefix=".tmp-")
+            with os.fdopen(fd, "w") as fp:
+                json.dump(self.entries, fp)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            pass
+        self.changed = False
+
+
+def scan_headers(paths, cache=None):
+    """Returns names of headers which are provided and names of headers
+    which are included by files in the directories. Includes of unchanged
+    files are taken from `cache` if it is given"""
+    get_includes = cache.get_includes if cache else read_includes
+    provided, included = set(), set()
+    for path in paths:
+        for root, _, files in os.walk(path):
+            for name in files:
+                if not name.endswith(SOURCE_EXTS):
+                    continue
+                if name.endswith(HEADER_EXTS):
+                    provided.add(name)
+                included.update(get_includes(os.path.join(root, name)))
+    return provided, included
+
+
+def get_project_source_dirs(env):
+    """Returns directories of sources which might include framework
+    headers: the project, its tests and all library storages"""
+
+    dirs = [env.subst("$PROJECT_SRC_DIR"), env.subst("$PROJECT_INCLUDE_DIR")]
+    if "test" in env.GetBuildType():
+        dirs.append(env.subst("$PROJECT_TEST_DIR"))
+    # The project library directory, installed dependencies of the
+    # environment and `lib_extra_dirs`
+    return dirs + env.GetLibSourceDirs()
+
+
+def load_lib_index(index_path, lib_dirs):
+    """Returns `{lib_dir: {"headers": [...], "includes": [...]}}`, libraries
+    missing in the stored index are scanned and added to it"""
+    index = {}
+    try:
+        with open(index_path) as fp:
+            index = json.load(fp)
+    except (OSError, ValueError):
+        pass
+    if not isinstance(index, dict):
+        index = {}
+
+    missing = [d for d in lib_dirs if d not in index]
+    for lib_dir in missing:
+        provided, included = scan_headers([lib_dir])
+        index[lib_dir] = {
+            "headers": sorted(provided),
+            "includes": sorted(included - provided),
+        }
+    if missing:
+        try:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(index_path), prefix=".tmp-")
+            with os.fdopen(fd, "w") as fp:
+                json.dump(index, fp, indent=1, sort_keys=True)
+            # Other builds might be reading the index at the same time
+            os.replace(tmp_path, index_path)
+        except OSError:
+            pass
+
+    return {d: index[d] for d in lib_dirs}
+
+
+def select_libs(index, includes):
+    """Returns directories of libraries which provide the included headers
+    and of libraries which they include in turn"""
+    providers = {}
+    for lib_dir, info in index.items():
+        for name in info["headers"]:
+            providers.setdefault(name, []).append(lib_dir)
+
+    selected = set()
+    pending = list(includes)
+    seen = set(pending)
+    while pending:
+        for lib_dir in providers.get(pending.pop(), []):
+            if lib_dir in selected:
+                continue
+            selected.add(lib_dir)
+            for name in index[lib_dir]["includes"]:
+                if name not in seen:
+                    seen.add(name)
+                    pending.append(name)
+    return [d for d in index if d in selected]
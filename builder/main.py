@@ -12,16 +12,41 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import os
+import re
+import subprocess
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from platform import system
 from os import makedirs
-from os.path import basename, isdir, join
+from os.path import basename, isabs, isdir, isfile, join
 
 from SCons.Script import (ARGUMENTS, COMMAND_LINE_TARGETS, AlwaysBuild,
                           Builder, Default, DefaultEnvironment)
+from serial import Serial, SerialException
 
 from platformio.public import list_serial_ports
 
+from elf import ElfError, ElfFile, ElfFileCache, parse_memory_regions
+from flashdelta import DeltaUpload, get_flash_sectors
+from portwatch import PortWatcher, wait_for_new_port
+from profiles import (DEFAULT_PROFILE, get_profile, get_sources_signature,
+                      update_profile_sizes)
+from uploadcmds import (ARDUINO_DFU_BOARD_PREFIXES, get_blackmagic_flags,
+                        get_dfu_flags, get_gdb_load_cmd, get_jlink_commands,
+                        get_jlink_flags, get_openocd_delta_cmd,
+                        get_openocd_flags, get_openocd_program_cmd,
+                        get_stm32flash_flags, get_upload_device_flags)
+
+# Frameworks built with optimization flags of build profiles
+PROFILE_FRAMEWORKS = ("cmsis", "spl", "stm32cube")
+
+# USB vendor IDs of debug probes: ST-LINK, SEGGER J-Link, Black Magic
+# Probe and CMSIS-DAP (Arm Mbed)
+DEBUG_PROBE_VIDS = ("0483", "1366", "1D50", "0D28")
+
 
 def BeforeUpload(target, source, env):  # pylint: disable=W0613,W0621
     env.AutodetectUploadPort()
@@ -35,11 +60,285 @@ def BeforeUpload(target, source, env):  # pylint: disable=W0613,W0621
 
     before_ports = list_serial_ports()
 
+    # The watcher is started before the touch, the port may appear quickly
+    watcher = None
+    if bool(upload_options.get("wait_for_upload_port", False)):
+        try:
+            watcher = PortWatcher()
+        except OSError:
+            pass
+
     if bool(upload_options.get("use_1200bps_touch", False)):
         env.TouchSerialPort("$UPLOAD_PORT", 1200)
 
     if bool(upload_options.get("wait_for_upload_port", False)):
-        env.Replace(UPLOAD_PORT=env.WaitForNewSerialPort(before_ports))
+        env.Replace(UPLOAD_PORT=_wait_for_new_serial_port(env, before_ports, watcher))
+
+
+def _wait_for_new_serial_port(env, before_ports, watcher):
+    if not watcher:
+        # Polling is used if inotify isn't available (not Linux)
+        return env.WaitForNewSerialPort(before_ports)
+
+    print("Waiting for the new upload port...")
+    new_port = wait_for_new_port(
+        watcher, 5, env.subst("$UPLOAD_PORT"),
+        lambda: [p["port"] for p in list_serial_ports()])
+
+    if not new_port:
+        sys.stderr.write(
+            "Error: Couldn't find a board on the selected port. "
+            "Check that you have the correct port selected. "
+            "If it is correct, try pressing the board's reset "
+            "button after initiating the upload.\n"
+        )
+        env.Exit(1)
+
+    # udev may still be setting up permissions of a new device node
+    for _ in range(20):
+        try:
+            Serial(new_port).close()
+            break
+        except SerialException:
+            time.sleep(0.05)
+    return new_port
+
+
+def CheckUploadSize(_, target, source, env):  # pylint: disable=W0613,W0621
+    if "BOARD" not in env:
+        return None
+    program_max_size = int(board.get("upload.maximum_size", 0))
+    data_max_size = int(board.get("upload.maximum_ram_size", 0))
+    if program_max_size == 0:
+        return None
+
+    try:
+        with ElfFile(source[0].get_abspath()) as elf:
+            program_size = elf.get_size(env["SIZEPROGREGEXP"])
+            data_size = elf.get_size(env["SIZEDATAREGEXP"])
+            regions = _get_memory_regions(env)
+            memory_usage = elf.get_memory_usage(regions)
+    except (OSError, ElfError):
+        # Fall back to the default checker based on $SIZECHECKCMD
+        return _check_upload_size_with_sizetool(target, source, env)
+
+    def _format_available_bytes(value, total):
+        percent_raw = float(value) / float(total)
+        blocks_per_progress = 10
+        used_blocks = min(
+            int(round(blocks_per_progress * percent_raw)), blocks_per_progress
+        )
+        return "[{:{}}] {: 6.1%} (used {:d} bytes from {:d} bytes)".format(
+            "=" * used_blocks, blocks_per_progress, percent_raw, value, total
+        )
+
+    print('Advanced Memory Usage is available via "PlatformIO Home > Project Inspect"')
+    if data_max_size:
+        print("RAM:   %s" % _format_available_bytes(data_size, data_max_size))
+    print("Flash: %s" % _format_available_bytes(program_size, program_max_size))
+    if set(env.get("PIOFRAMEWORK", [])) <= set(PROFILE_FRAMEWORKS):
+        _print_profile_sizes(env, source[0], program_size, data_size)
+    if int(ARGUMENTS.get("PIOVERBOSE", 0)):
+        for region in regions:
+            used = memory_usage[region.name]
+            if region.length:
+                print("%-14s %s" % (
+                    region.name + ":",
+                    _format_available_bytes(used, region.length)))
+            else:
+                print("%-14s used %d bytes" % (region.name + ":", used))
+
+    if data_max_size and data_size > data_max_size:
+        sys.stderr.write(
+            "Warning! The data size (%d bytes) is greater "
+            "than maximum allowed (%s bytes)\n" % (data_size, data_max_size)
+        )
+    if program_size > program_max_size:
+        sys.stderr.write(
+            "Error: The program size (%d bytes) is greater "
+            "than maximum allowed (%s bytes)\n" % (program_size, program_max_size)
+        )
+        env.Exit(1)
+    return None
+
+
+def _print_profile_sizes(env, program, program_size, data_size):
+    profile = get_profile(env)
+    signature = get_sources_signature(env, program)
+    sizes = update_profile_sizes(
+        env, profile, program_size, data_size, signature)
+    print("Build profile: %s" % profile)
+    if len(sizes) < 2:
+        return
+    # Sizes of other profiles are known once they were built, sizes of
+    # builds from other sources are not compared
+    base_size = sizes.get(DEFAULT_PROFILE)
+    if base_size and base_size[2:] != [signature]:
+        base_size = None
+    for name in sorted(sizes):
+        line = "  %-10s Flash: %d bytes, RAM: %d bytes" % (
+            name + ":", sizes[name][0], sizes[name][1])
+        if sizes[name][2:] != [signature]:
+            line += " (outdated, the sources have changed since)"
+        elif base_size and name != DEFAULT_PROFILE:
+            line += " (%+d / %+d bytes compared to `%s`)" % (
+                sizes[name][0] - base_size[0], sizes[name][1] - base_size[1],
+                DEFAULT_PROFILE)
+        print(line)
+
+
+def _get_upload_cmd(env, target, source):
+    escape = env.get("ESCAPE", lambda x: x)
+    return " ".join(
+        arg.escape(escape) if hasattr(arg, "escape") else str(arg)
+        for arg in env.subst_list("$UPLOADCMD", target=target, source=source)[0]
+    )
+
+
+def _get_upload_sysenv(env):
+    sysenv = os.environ.copy()
+    sysenv["PATH"] = str(env["ENV"]["PATH"])
+    return sysenv
+
+
+def UploadToDevices(target, source, env):  # pylint: disable=W0613,W0621
+    sysenv = _get_upload_sysenv(env)
+
+    def _upload(device, cmd):
+        start = time.time()
+        result = subprocess.run(
+            cmd,
+            shell=True,
+            env=sysenv,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            check=False
+        )
+        return device, result.returncode, time.time() - start, result.stdout
+
+    # Commands are prepared sequentially, some of them generate files
+    commands = [
+        (device, _get_upload_cmd(
+            _get_upload_device_env(env, device), target, source))
+        for device in upload_devices
+    ]
+    jobs = int(board.get("upload.jobs", 0)) or min(len(commands), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(lambda item: _upload(*item), commands))
+
+    failed = 0
+    for device, returncode, elapsed, output in results:
+        if returncode != 0 or int(ARGUMENTS.get("PIOVERBOSE", 0)):
+            print(output)
+        if returncode != 0:
+            failed += 1
+        print("%-32s %s (took %.2f seconds)" % (
+            device, "SUCCESS" if returncode == 0 else "FAILED", elapsed))
+
+    if failed:
+        sys.stderr.write(
+            "Error: Failed to upload firmware to %d of %d devices\n"
+            % (failed, len(results)))
+        return 1
+    return 0
+
+
+def UploadDelta(target, source, env):  # pylint: disable=W0613,W0621
+    status = _run_upload_cmd(env, target, source)
+    if status != 0 and delta_upload.partial:
+        # Another board might be connected to the probe
+        sys.stderr.write(
+            "Warning! Flash contents don't match the firmware after "
+            "the delta upload, programming the whole image\n")
+        delta_upload.discard()
+        status = _run_upload_cmd(env, target, source)
+    if status == 0:
+        delta_upload.commit()
+    return status
+
+
+def _run_upload_cmd(env, target, source):
+    cmd = _get_upload_cmd(env, target, source)
+    if int(ARGUMENTS.get("PIOVERBOSE", 0)):
+        print(cmd)
+    proc = subprocess.Popen(
+        cmd,
+        shell=True,
+        env=_get_upload_sysenv(env),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True
+    )
+    mismatched = False
+    for line in proc.stdout:
+        sys.stdout.write(line)
+        # compare-sections of GDB doesn't fail on a mismatch
+        mismatched = mismatched or "MIS-MATCHED" in line
+    return proc.wait() or int(mismatched)
+
+
+def _get_delta_upload_key(env):
+    # The record belongs to a probe, it's identified by the serial number
+    # of its USB device, e.g. "USB VID:PID=0483:374B SER=0670FF..."
+    port = env.subst("$UPLOAD_PORT")
+    serials = set()
+    for item in list_serial_ports():
+        match = re.search(
+            r"VID:PID=([0-9A-F]{4}):[0-9A-F]{4}.*?\bSER=(\S+)", item["hwid"], re.I)
+        if not match:
+            continue
+        if port and item["port"] == port:
+            serials = {match.group(2)}
+            break
+        if not port and match.group(1).upper() in DEBUG_PROBE_VIDS:
+            serials.add(match.group(2))
+    if len(serials) == 1:
+        return "%s-%s" % (upload_protocol, serials.pop())
+    # Records of unknown probes are verified as well
+    return "%s-%s" % (upload_protocol, port)
+
+
+def _get_upload_device_env(env, device):
+    # Each device is selected by its port or the serial number of a probe
+    flags = get_upload_device_flags(
+        upload_protocol, env.subst("$UPLOADER"), env.get("UPLOADERFLAGS", []),
+        device, openocd=upload_protocol in debug_tools)
+    return env.Override({"UPLOAD_PORT": device, "UPLOADERFLAGS": flags})
+
+
+def ElfToBinNative(target, source, env):  # pylint: disable=W0613,W0621
+    return _convert_elf(source[0], bin_path=target[0].get_abspath())
+
+
+def ElfToHexNative(target, source, env):  # pylint: disable=W0613,W0621
+    return _convert_elf(
+        source[0], hex_path=target[0].get_abspath(), hex_exclude=[".eeprom"])
+
+
+def _convert_elf(source, **kwargs):
+    try:
+        elf_files.convert(source.get_abspath(), **kwargs)
+    except (OSError, ElfError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        return 1
+    return 0
+
+
+def _get_memory_regions(env):
+    ldscript = env.subst("$LDSCRIPT_PATH")
+    if ldscript and not isabs(ldscript):
+        ldscript = next(
+            (
+                join(env.subst(d), ldscript)
+                for d in env.get("LIBPATH", [])
+                if isfile(join(env.subst(d), ldscript))
+            ),
+            ldscript,
+        )
+    if not ldscript or not isfile(ldscript):
+        return []
+    return parse_memory_regions(ldscript)
 
 
 env = DefaultEnvironment()
@@ -70,28 +369,43 @@ env.Replace(
 if env.get("PROGNAME", "program") == "program":
     env.Replace(PROGNAME="firmware")
 
+# Program and data sizes are read directly from the ELF file
+_check_upload_size_with_sizetool = env.CheckUploadSize
+env.AddMethod(CheckUploadSize)
+
+if board.get("build.native_objcopy", "no") == "yes":
+    # Firmware images are generated in-process without objcopy, ElfToBin
+    # and ElfToHex targets of a program share a single parse of the ELF file
+    elf_files = ElfFileCache()
+    atexit.register(elf_files.close)
+    elf_to_bin_action = env.VerboseAction(ElfToBinNative, "Building $TARGET")
+    elf_to_hex_action = env.VerboseAction(ElfToHexNative, "Building $TARGET")
+else:
+    elf_to_bin_action = env.VerboseAction(" ".join([
+        "$OBJCOPY",
+        "-O",
+        "binary",
+        "$SOURCES",
+        "$TARGET"
+    ]), "Building $TARGET")
+    elf_to_hex_action = env.VerboseAction(" ".join([
+        "$OBJCOPY",
+        "-O",
+        "ihex",
+        "-R",
+        ".eeprom",
+        "$SOURCES",
+        "$TARGET"
+    ]), "Building $TARGET")
+
 env.Append(
     BUILDERS=dict(
         ElfToBin=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJCOPY",
-                "-O",
-                "binary",
-                "$SOURCES",
-                "$TARGET"
-            ]), "Building $TARGET"),
+            action=elf_to_bin_action,
             suffix=".bin"
         ),
         ElfToHex=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJCOPY",
-                "-O",
-                "ihex",
-                "-R",
-                ".eeprom",
-                "$SOURCES",
-                "$TARGET"
-            ]), "Building $TARGET"),
+            action=elf_to_hex_action,
             suffix=".hex"
         )
     )
@@ -147,6 +461,22 @@ debug_tools = board.get("debug.tools", {})
 upload_source = target_firm
 upload_actions = []
 
+# Upload the same firmware to several devices in parallel
+upload_devices = board.get("upload.devices", "")
+if not isinstance(upload_devices, list):
+    upload_devices = [d for d in re.split(r"[\s,]+", upload_devices) if d]
+
+# Incremental uploads over debug probes, only changed flash sectors
+# are erased and programmed
+delta_upload = None
+if not upload_devices and board.get("upload.delta", "no") == "yes" and (
+    upload_protocol.startswith(("blackmagic", "jlink"))
+    or upload_protocol in debug_tools
+):
+    delta_upload = DeltaUpload(
+        join(env.subst("$BUILD_DIR"), "upload-state"), get_flash_sectors(board))
+
+
 if upload_protocol == "mbed":
     upload_actions = [
         env.VerboseAction(env.AutodetectUploadPort, "Looking for upload disk..."),
@@ -154,19 +484,17 @@ if upload_protocol == "mbed":
     ]
 
 elif upload_protocol.startswith("blackmagic"):
+    def _gdb_load_cmd(env, source):
+        # A list is substituted as a single argument, a string would be
+        # split by whitespace
+        return [get_gdb_load_cmd(delta_upload.prepare(
+            _get_delta_upload_key(env), str(source), 0) if delta_upload else None)]
+
     env.Replace(
+        __gdb_load_cmd=_gdb_load_cmd,
         UPLOADER="$GDB",
-        UPLOADERFLAGS=[
-            "-nx",
-            "--batch",
-            "-ex", "target extended-remote $UPLOAD_PORT",
-            "-ex", "monitor %s_scan" %
-            ("jtag" if upload_protocol == "blackmagic-jtag" else "swdp"),
-            "-ex", "attach 1",
-            "-ex", "load",
-            "-ex", "compare-sections",
-            "-ex", "kill"
-        ],
+        UPLOADERFLAGS=get_blackmagic_flags(
+            upload_protocol, "$UPLOAD_PORT", "${__gdb_load_cmd(__env__, SOURCE)}"),
         UPLOADCMD="$UPLOADER $UPLOADERFLAGS $SOURCE"
     )
     upload_source = target_elf
@@ -182,13 +510,14 @@ elif upload_protocol.startswith("jlink"):
         if not isdir(build_dir):
             makedirs(build_dir)
         script_path = join(build_dir, "upload.jlink")
-        commands = [
-            "h",
-            "loadbin \"%s\", %s" % (source, board.get(
-                "upload.offset_address", "0x08000000")),
-            "r",
-            "q"
-        ]
+        offset = board.get("upload.offset_address", "0x08000000")
+        commands = get_jlink_commands(source, offset)
+        delta = delta_upload.prepare(
+            _get_delta_upload_key(env), str(source),
+            int(offset, 0)) if delta_upload else None
+        if delta is not None:
+            commands[1:2] = (["loadfile \"%s\"" % delta] if delta else []) + [
+                "verifybin \"%s\", %s" % (source, offset)]
         with open(script_path, "w") as fp:
             fp.write("\n".join(commands))
         return script_path
@@ -196,13 +525,10 @@ elif upload_protocol.startswith("jlink"):
     env.Replace(
         __jlink_cmd_script=_jlink_cmd_script,
         UPLOADER="JLink.exe" if system() == "Windows" else "JLinkExe",
-        UPLOADERFLAGS=[
-            "-device", board.get("debug", {}).get("jlink_device"),
-            "-speed", env.GetProjectOption("debug_speed", "4000"),
-            "-if", ("jtag" if upload_protocol == "jlink-jtag" else "swd"),
-            "-autoconnect", "1",
-            "-NoGui", "1"
-        ],
+        UPLOADERFLAGS=get_jlink_flags(
+            board, upload_protocol, env.GetProjectOption("debug_speed", "4000"))
+        # A failed `verifybin` ends the delta upload with an error
+        + (["-ExitOnError", "1"] if delta_upload else []),
         UPLOADCMD='$UPLOADER $UPLOADERFLAGS -CommanderScript "${__jlink_cmd_script(__env__, SOURCE)}"'
     )
     upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
@@ -213,7 +539,7 @@ elif upload_protocol == "dfu":
     vid = hwids[0][0]
     pid = hwids[0][1]
 
-    if env.subst("$BOARD").startswith(("portenta", "opta", "nicla", "giga")):
+    if env.subst("$BOARD").startswith(ARDUINO_DFU_BOARD_PREFIXES):
         _upload_tool = '"%s"' % join(platform.get_package_dir(
             "tool-dfuutil-arduino") or "", "dfu-util")
     else:
@@ -221,16 +547,13 @@ elif upload_protocol == "dfu":
         _upload_tool = '"%s"' % join(platform.get_package_dir(
             "tool-dfuutil") or "", "bin", "dfu-util")
 
-    _upload_flags = [
-        "-d", ",".join(["%s:%s" % (hwid[0], hwid[1]) for hwid in hwids]),
-        "-a", "0", "-s",
-        "%s:leave" % board.get("upload.offset_address", "0x08000000"), "-D"
-    ]
+    _upload_flags = get_dfu_flags(
+        hwids, board.get("upload.offset_address", "0x08000000"))
 
     upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
 
     if "arduino" in frameworks:
-        if env.subst("$BOARD").startswith(("portenta", "opta", "nicla", "giga")):
+        if env.subst("$BOARD").startswith(ARDUINO_DFU_BOARD_PREFIXES):
             upload_actions.insert(
                 0,
                 env.VerboseAction(BeforeUpload, "Looking for upload port...")
@@ -255,7 +578,7 @@ elif upload_protocol == "dfu":
                                      "Looking for upload port..."))
 
     if "dfu-util" in _upload_tool:
-        if not env.subst("$BOARD").startswith(("portenta", "opta", "nicla", "giga")):
+        if not env.subst("$BOARD").startswith(ARDUINO_DFU_BOARD_PREFIXES):
             # Add special DFU header to the binary image
             env.AddPostAction(
                 join("$BUILD_DIR", "${PROGNAME}.bin"),
@@ -283,10 +606,9 @@ elif upload_protocol == "serial":
         __configure_upload_port=__configure_upload_port,
         UPLOADER='"%s"' % join(
             platform.get_package_dir("tool-stm32flash") or "", "stm32flash"),
-        UPLOADERFLAGS=[
-            "-g", board.get("upload.offset_address", "0x08000000"),
-            "-b", env.subst("$UPLOAD_SPEED") or "115200", "-w"
-        ],
+        UPLOADERFLAGS=get_stm32flash_flags(
+            board.get("upload.offset_address", "0x08000000"),
+            env.subst("$UPLOAD_SPEED")),
         UPLOADCMD='$UPLOADER $UPLOADERFLAGS "$SOURCE" "${__configure_upload_port(__env__)}"'
     )
 
@@ -310,25 +632,25 @@ elif upload_protocol == "hid":
     ]
 
 elif upload_protocol in debug_tools:
-    openocd_args = [
-        "-d%d" % (2 if int(ARGUMENTS.get("PIOVERBOSE", 0)) else 1)
-    ]
-    openocd_args.extend(
-        debug_tools.get(upload_protocol).get("server").get("arguments", []))
-    if env.GetProjectOption("debug_speed", ""):
-        openocd_args.extend(
-            ["-c", "adapter speed %s" % env.GetProjectOption("debug_speed")]
-        )
-    openocd_args.extend([
-        "-c", "program {$SOURCE} %s verify reset; shutdown;" %
-        board.get("upload.offset_address", "")
-    ])
-    openocd_args = [
-        f.replace("$PACKAGE_DIR",
-                  platform.get_package_dir("tool-openocd") or "")
-        for f in openocd_args
-    ]
+    openocd_args = get_openocd_flags(
+        debug_tools.get(upload_protocol),
+        platform.get_package_dir("tool-openocd"),
+        "${__openocd_delta_cmds(__env__, SOURCE)}" if delta_upload else
+        get_openocd_program_cmd("$SOURCE", board.get("upload.offset_address", "")),
+        env.GetProjectOption("debug_speed", ""),
+        int(ARGUMENTS.get("PIOVERBOSE", 0))
+    )
+
+    def _openocd_delta_cmds(env, source):
+        offset = board.get("upload.offset_address", "")
+        delta = delta_upload.prepare(
+            _get_delta_upload_key(env), str(source),
+            int(offset or "0x08000000", 0))
+        # A list is substituted as a single argument
+        return [get_openocd_delta_cmd(source, offset, delta)]
+
     env.Replace(
+        __openocd_delta_cmds=_openocd_delta_cmds,
         UPLOADER="openocd",
         UPLOADERFLAGS=openocd_args,
         UPLOADCMD="$UPLOADER $UPLOADERFLAGS")
@@ -344,6 +666,25 @@ elif upload_protocol == "custom":
 else:
     sys.stderr.write("Warning! Unknown upload protocol %s\n" % upload_protocol)
 
+if upload_devices and (
+    upload_protocol in ("serial", "dfu", "hid", "custom")
+    or upload_protocol.startswith(("blackmagic", "jlink"))
+    or upload_protocol in debug_tools
+):
+    upload_actions = [
+        env.VerboseAction(
+            UploadToDevices,
+            "Uploading $SOURCE to %d devices" % len(upload_devices))
+    ]
+elif upload_devices:
+    sys.stderr.write(
+        "Warning! Uploading to multiple devices is not supported by "
+        "%s protocol\n" % upload_protocol)
+
+if delta_upload and upload_actions:
+    # The whole image is programmed if the verification fails
+    upload_actions[-1] = env.VerboseAction(UploadDelta, "Uploading $SOURCE")
+
 AlwaysBuild(env.Alias("upload", upload_source, upload_actions))
 
 #
@@ -0,0 +1,123 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Machine-wide cache of compiled framework objects shared between projects.
+Each entry is a directory named by a hash of everything that affects the
+compilation. The least recently used entries are removed when the cache
+grows over its size limit.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+MARKER_NAME = ".complete"
+
+# Unfinished entries of interrupted builds are removed after a day
+STALE_TMP_AGE = 24 * 60 * 60
+
+
+def get_key(*items):
+    return hashlib.sha1(
+        json.dumps(items, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def get_dir_signature(path):
+    """Returns `[(relpath, size, mtime_ns), ...]` of files in a directory"""
+    result = []
+    for root, _, files in os.walk(path):
+        for name in files:
+            st = os.stat(os.path.join(root, name))
+            result.append((
+                os.path.relpath(os.path.join(root, name), path),
+                st.st_size,
+                st.st_mtime_ns
+            ))
+    return sorted(result)
+
+
+class ObjectCache:
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def lookup(self, key):
+        """Returns paths of cached files or None if there is no entry"""
+        entry_dir = os.path.join(self.cache_dir, key)
+        marker = os.path.join(entry_dir, MARKER_NAME)
+        if not os.path.isfile(marker):
+            return None
+        try:
+            # The marker time is used to find the least recently used entries
+            os.utime(marker)
+        except OSError:
+            pass
+        result = []
+        for root, _, files in os.walk(entry_dir):
+            result.extend(
+                os.path.join(root, name) for name in files if name != MARKER_NAME)
+        return sorted(result)
+
+    def store(self, key, base_dir, files):
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.isfile(os.path.join(entry_dir, MARKER_NAME)):
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp-")
+        try:
+            for path in files:
+                dst = os.path.join(tmp_dir, os.path.relpath(path, base_dir))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copy2(path, dst)
+            with open(os.path.join(tmp_dir, MARKER_NAME), "w"):
+                pass
+            # Another build might have stored the same entry in the meantime
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.isdir(entry_dir):
+                raise
+        self.prune()
+
+    def prune(self):
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith(".tmp-"):
+                if time.time() - os.path.getmtime(path) > STALE_TMP_AGE:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            marker = os.path.join(path, MARKER_NAME)
+            if not os.path.isfile(marker):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(root, f))
+                for root, _, files in os.walk(path)
+                for f in files
+            )
+            entries.append((os.path.getmtime(marker), size, path))
+            total_size += size
+
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
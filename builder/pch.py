@@ -0,0 +1,77 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Precompiled framework headers. A header with the same name as the original
+one is generated in a directory which is searched first. It includes the
+original header, so GCC either uses the precompiled version or processes
+the original header if the precompiled one doesn't match the flags of a
+translation unit.
+"""
+
+import os
+
+from SCons.Action import Action
+from SCons.Scanner.C import CScanner
+
+# GCC tries every file in a `<header>.gch` directory
+PCH_LANGUAGES = (
+    ("c.gch", "$CC -x c-header -c $CFLAGS $CCFLAGS $_CCCOMCOM -o $TARGET $SOURCE"),
+    ("cxx.gch",
+     "$CXX -x c++-header -c $CXXFLAGS $CCFLAGS $_CCCOMCOM -o $TARGET $SOURCE"),
+)
+
+
+def _build_pch(target, source, env):
+    with open(target[0].get_abspath(), "w") as fp:
+        fp.write(
+            "/* Generated by PlatformIO, do not edit */\n"
+            '#include "%s"\n' % source[0].get_abspath().replace("\\", "/"))
+
+    for node, (_, command) in zip(target[1:], PCH_LANGUAGES):
+        if not os.path.isdir(node.get_dir().get_abspath()):
+            os.makedirs(node.get_dir().get_abspath())
+        if Action(command, "Precompiling $TARGET")([node], target[:1], env):
+            # The original header is used by GCC without a precompiled one
+            print("Warning! Could not precompile %s" % source[0].get_path())
+            if os.path.isfile(node.get_abspath()):
+                os.remove(node.get_abspath())
+    return 0
+
+
+def add_precompiled_header(env, header_path, pch_dir):
+    if "PrecompiledHeader" not in env["BUILDERS"]:
+        env.Append(BUILDERS=dict(PrecompiledHeader=env.Builder(
+            # Function actions depend only on their code by default
+            action=Action(_build_pch, None, varlist=[
+                "CC", "CXX", "CFLAGS", "CCFLAGS", "CXXFLAGS", "CPPFLAGS",
+                "_CPPDEFFLAGS", "_CPPINCFLAGS"
+            ]),
+            source_scanner=CScanner(),
+        )))
+
+    name = os.path.basename(header_path)
+    # Objects depend on the generated header, so they are compiled only
+    # after the precompiled header is ready
+    pch = env.PrecompiledHeader(
+        [os.path.join(pch_dir, name)]
+        + [os.path.join(pch_dir, name + ".gch", f) for f, _ in PCH_LANGUAGES],
+        header_path,
+    )
+    # Precompiled headers are valid only for the same compiler build
+    env.Depends(pch, [
+        path for path in (env.WhereIs(env.subst(cmd)) for cmd in ("$CC", "$CXX"))
+        if path
+    ])
+    env.Prepend(CPPPATH=[pch_dir])
@@ -0,0 +1,113 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Detection of new serial ports through inotify events on Linux. Device
+nodes are created in /dev as soon as the kernel registers a device,
+so the port is found without re-enumerating all ports in a loop.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import sys
+import time
+
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without the trailing name
+_EVENT = struct.Struct("iIII")
+
+PORT_NAME_RE = re.compile(r"^tty(ACM|USB|AMA)\d+$")
+
+
+def _get_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    except OSError:
+        return None
+    return libc if hasattr(libc, "inotify_init1") else None
+
+
+class PortWatcher:
+    """Reports serial ports created in `dev_dir` after the watcher was
+    started. OSError is raised if inotify isn't available"""
+
+    def __init__(self, dev_dir="/dev", name_re=PORT_NAME_RE):
+        self.dev_dir = dev_dir
+        self.name_re = name_re
+        libc = _get_libc()
+        if not libc:
+            raise OSError("inotify is not supported on this system")
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(
+                self.fd, os.fsencode(dev_dir), IN_CREATE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            self.close()
+            raise OSError(errno, "Could not watch %s" % dev_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def wait(self, timeout):
+        """Returns a path to the first new port or None on timeout"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if not select.select([self.fd], [], [], remaining)[0]:
+                return None
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                continue
+            pos = 0
+            while pos + _EVENT.size <= len(data):
+                length = _EVENT.unpack_from(data, pos)[3]
+                name = data[pos + _EVENT.size:pos + _EVENT.size + length]
+                pos += _EVENT.size + length
+                name = name.rstrip(b"\0").decode("latin-1")
+                if self.name_re.match(name):
+                    return os.path.join(self.dev_dir, name)
+
+
+def wait_for_new_port(watcher, timeout, prev_port, list_ports):
+    """Returns the new port, the previous port if it still exists (e.g.
+    the board hasn't re-enumerated) or None"""
+
+    with watcher:
+        new_port = watcher.wait(timeout)
+    if not new_port and prev_port in list_ports():
+        new_port = prev_port
+    return new_port
@@ -0,0 +1,133 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Build profiles select optimization flags of bare-metal, CMSIS, SPL and
+STM32Cube builds. The profile is set with `board_build.profile` and can be
+overridden for framework libraries, e.g. `board_build.hal_profile`. Sizes
+of firmware built with each profile are kept to show the cost of a profile.
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+DEFAULT_PROFILE = "size"
+
+PROFILES = {
+    "size": ["-Os"],
+    "speed": ["-O2"],
+    "speed-lto": ["-O2", "-flto"],
+}
+
+SIZES_FILE = "profile-sizes.json"
+
+
+def get_profile(env, library=None):
+    board = env.BoardConfig()
+    profile = board.get("build.profile", DEFAULT_PROFILE)
+    if library:
+        profile = board.get("build.%s_profile" % library, profile)
+    if profile not in PROFILES:
+        sys.stderr.write(
+            "Error: Unknown build profile `%s`, please use one of: %s\n"
+            % (profile, ", ".join(sorted(PROFILES))))
+        env.Exit(1)
+    return profile
+
+
+def get_profile_flags(env, library=None):
+    """Returns optimization flags for compiling and linking"""
+    flags = PROFILES[get_profile(env, library)]
+    if "debug" in env.GetBuildType():
+        # Optimization flags are replaced with debug flags by PlatformIO,
+        # link-time optimization would make the firmware hard to debug
+        flags = [f for f in flags if f != "-flto"]
+    return flags
+
+
+def clone_library_env(env, library):
+    """Returns an environment with optimization flags of the profile
+    selected for a framework library or `env` if they are the same"""
+
+    flags = get_profile_flags(env, library)
+    global_flags = get_profile_flags(env)
+    # Debug flags are applied by PlatformIO to the main environment only
+    if flags == global_flags or "debug" in env.GetBuildType():
+        return env
+
+    lib_env = env.Clone()
+    lib_env.ProcessUnFlags(lib_env.get("BUILD_UNFLAGS"))
+    lib_env["CCFLAGS"] = [
+        f for f in lib_env.get("CCFLAGS", []) if f not in global_flags
+    ] + flags
+    if "-flto" in flags and "-flto" not in env.get("LINKFLAGS", []):
+        # Objects with intermediate code are optimized when linked
+        env.Append(LINKFLAGS=["-flto"])
+    return lib_env
+
+
+def get_sources_signature(env, program):
+    """Returns a signature of the files which a program is built from.
+    It stays the same for builds of the same sources with other profiles"""
+
+    leaves = set()
+    seen = set()
+    pending = [program]
+    while pending:
+        for node in pending.pop().children():
+            if node in seen:
+                continue
+            seen.add(node)
+            if node.has_builder():
+                pending.append(node)
+            else:
+                leaves.add(node)
+
+    project_dir = env.subst("$PROJECT_DIR")
+    signature = hashlib.sha1()
+    for path, node in sorted(
+        (os.path.relpath(n.get_abspath(), project_dir), n)
+        for n in leaves if hasattr(n, "get_abspath")
+    ):
+        signature.update(("%s:%s\n" % (path, node.get_csig())).encode())
+    return signature.hexdigest()
+
+
+def update_profile_sizes(env, profile, program_size, data_size, signature):
+    """Stores sizes of the firmware and returns sizes for all profiles
+    built in the current environment as `{profile: [program, data,
+    signature]}`, the signature is the one of `get_sources_signature`"""
+
+    # The build directory is removed when the configuration changes
+    path = os.path.join(env.subst("$PROJECT_WORKSPACE_DIR"), SIZES_FILE)
+    data = {}
+    try:
+        with open(path) as fp:
+            data = json.load(fp)
+    except (OSError, ValueError):
+        pass
+    if not isinstance(data, dict):
+        data = {}
+
+    sizes = data.setdefault(env["PIOENV"], {})
+    sizes[profile] = [program_size, data_size, signature]
+    try:
+        with open(path + ".tmp", "w") as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+    return sizes
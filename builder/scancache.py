@@ -0,0 +1,163 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Header dependencies of framework sources stored between builds. SCons
+reads every source and looks up every included header in all include
+directories on each build. A stored result is used while the file and
+the include directories keep their modification times.
+"""
+
+import atexit
+import copy
+import hashlib
+import json
+import os
+import tempfile
+
+from SCons.Builder import CompositeBuilder
+from SCons.Scanner import ScannerBase
+from SCons.Scanner.C import CScanner
+from SCons.Tool import CScanner as DEFAULT_CSCANNER, SourceFileScanner
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class CachedCScanner:
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.scanner = CScanner()
+        self.entries = {}
+        self.changed = False
+        self._path_signatures = {}
+        try:
+            with open(cache_path) as fp:
+                self.entries = json.load(fp)
+        except (OSError, ValueError):
+            pass
+        if not isinstance(self.entries, dict):
+            self.entries = {}
+        # The original function is used as a fallback by `self.scanner`
+        self._scan = self.scanner.scan
+        self.scanner.scan = self.scan
+        atexit.register(self.save)
+
+    def get_path_signature(self, path):
+        # Directory times change when files are added or removed
+        if path not in self._path_signatures:
+            self._path_signatures[path] = hashlib.sha1(json.dumps([
+                [d.get_abspath(), _get_mtime(d.get_abspath())] for d in path
+            ]).encode()).hexdigest()
+        return self._path_signatures[path]
+
+    def scan(self, node, path=()):
+        if callable(path):
+            path = path()
+        src_path = node.srcnode().get_abspath()
+        try:
+            st = os.stat(src_path)
+        except OSError:
+            return self._scan(node, path)
+        signature = [
+            st.st_mtime_ns,
+            st.st_size,
+            _get_mtime(os.path.dirname(src_path)),
+            self.get_path_signature(tuple(path)),
+        ]
+        key = node.get_abspath()
+        entry = self.entries.get(key)
+        if (
+            entry
+            and entry[0] == signature
+            and all(_get_mtime(d) == mtime for d, mtime in entry[2])
+        ):
+            return [node.fs.File(p) for p in entry[1]]
+
+        nodes = self._scan(node, path)
+        # Headers included with a directory, e.g. "sys/types.h", are found
+        # or shadowed when files are added to such directories
+        subdirs = sorted(set(
+            os.path.join(d, os.path.dirname(include[1]))
+            for include in node.includes or []
+            if os.path.dirname(include[1])
+            for d in [os.path.dirname(src_path)] + [p.get_abspath() for p in path]
+        ))
+        self.entries[key] = [
+            signature,
+            [n.get_abspath() for n in nodes],
+            [[d, _get_mtime(d)] for d in subdirs],
+        ]
+        self.changed = True
+        return nodes
+
+    def save(self):
+        if not self.changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.cache_path), prefix=".tmp-")
+            with os.fdopen(fd, "w") as fp:
+                json.dump(self.entries, fp)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            pass
+
+
+def use_scan_cache(env, cache_path):
+    """Makes objects of `env` use header dependencies stored in
+    `cache_path`. `env` must not be shared with project sources"""
+
+    scanner = CachedCScanner(cache_path).scanner
+    source_scanner = ScannerBase({}, name="CachedSourceFileScanner")
+    for suffix, suffix_scanner in SourceFileScanner.function.items():
+        source_scanner.add_scanner(
+            suffix, scanner if suffix_scanner is DEFAULT_CSCANNER else suffix_scanner)
+
+    # Libraries are built from static objects, `Object` is the same
+    # builder by default
+    wrapped = {}
+    for name in ("Object", "StaticObject"):
+        builder = env["BUILDERS"][name]
+        if id(builder) not in wrapped:
+            # Nodes refer to the builder which is wrapped by the composite one
+            obj_builder = copy.copy(builder.builder)
+            obj_builder.source_scanner = source_scanner
+            wrapped[id(builder)] = CompositeBuilder(obj_builder, builder.cmdgen)
+        env["BUILDERS"][name] = wrapped[id(builder)]
+
+
+def clone_framework_env(env, build_env, name):
+    """Returns an environment for framework sources which uses stored
+    header dependencies. Framework sources don't include headers of
+    libraries found later by the Library Dependency Finder, so their
+    include directories are not added to the environment"""
+
+    if build_env is env:
+        build_env = env.Clone()
+        # Flags changed by PlatformIO after framework scripts
+        build_env.ProcessUnFlags(build_env.get("BUILD_UNFLAGS"))
+        if "debug" in env.GetBuildType():
+            build_env.ConfigureDebugFlags()
+    use_scan_cache(
+        build_env,
+        os.path.join(env.subst("$BUILD_DIR"), "%s-headers.json" % name),
+    )
+    return build_env
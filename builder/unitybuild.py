@@ -0,0 +1,195 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Unity (jumbo) builds of framework sources. C files are grouped into a few
+generated translation units which include the original files, so device
+headers are parsed once per group instead of once per file. A group which
+fails to compile is built again file by file.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+
+from SCons.Action import Action
+from SCons.Node import FS
+from SCons.Scanner.C import CScanner
+
+COMMENT_RE = re.compile(r"/\*.*?\*/|//[^\n]*", re.S)
+STATIC_RE = re.compile(r"\bstatic\b[^;={}()]*?\b([A-Za-z_]\w*)\s*[(\[=;]")
+DEFINE_RE = re.compile(r"^\s*#\s*define\s+(\w+)", re.M)
+
+# Matched by STATIC_RE in declarations like `static void (*callback)(void)`
+C_KEYWORDS = (
+    "char", "const", "double", "enum", "float", "int", "long", "short",
+    "signed", "struct", "union", "unsigned", "void", "volatile"
+)
+
+
+def _scan_source(path):
+    """Returns names of file-static symbols and macros defined in a file"""
+    with open(path, errors="ignore") as fp:
+        content = COMMENT_RE.sub("", fp.read())
+    statics = set(STATIC_RE.findall(content)).difference(C_KEYWORDS)
+    return statics, set(DEFINE_RE.findall(content))
+
+
+def split_sources(paths, batches):
+    """Splits sorted paths into `batches` groups of about the same size"""
+    sizes = [os.path.getsize(p) for p in paths]
+    limit = float(sum(sizes)) / max(batches, 1)
+    groups = [[]]
+    group_size = 0
+    for path, size in zip(paths, sizes):
+        if groups[-1] and group_size + size / 2.0 > limit and len(groups) < batches:
+            groups.append([])
+            group_size = 0
+        groups[-1].append(path)
+        group_size += size
+    return groups
+
+
+def generate_unity_source(paths):
+    symbols = {path: _scan_source(path) for path in paths}
+    counts = {}
+    for statics, _ in symbols.values():
+        for name in statics:
+            counts[name] = counts.get(name, 0) + 1
+
+    lines = ["/* Generated by PlatformIO, do not edit */"]
+    for index, path in enumerate(paths):
+        statics, macros = symbols[path]
+        # File-static symbols defined in several files get unique names
+        renamed = sorted(name for name in statics if counts[name] > 1)
+        lines.extend(
+            "#define %s %s__unity%d" % (name, name, index) for name in renamed)
+        lines.append('#include "%s"' % path.replace("\\", "/"))
+        # Macros of a file must not leak into the next files
+        lines.extend("#undef %s" % name for name in renamed + sorted(macros))
+    return "\n".join(lines) + "\n"
+
+
+def _read_file(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path) as fp:
+        return fp.read()
+
+
+def _get_batch_signature(source):
+    signature = hashlib.sha1()
+    for node in source:
+        path = node.get_abspath()
+        signature.update(("%s:%d;" % (path, os.stat(path).st_mtime_ns)).encode())
+    return signature.hexdigest()
+
+
+def _compile_batch(target, source, env):
+    """Builds one object per file of a group. The unity source is compiled
+    into the first object and the remaining ones are left empty, so the
+    objects of a group compiled file by file replace them one to one"""
+
+    compile_action = Action("$CCCOM", "$CCCOMSTR")
+    # Intermediate files are stored next to the generated source
+    work_path = os.path.splitext(source[0].get_abspath())[0]
+    fallback_marker = work_path + ".fallback"
+    signature = _get_batch_signature(source)
+
+    if _read_file(fallback_marker) != signature:
+        if compile_action(target[:1], source[:1], env) == 0:
+            return _build_empty_objects(target[1:], work_path, env)
+        print(
+            "Warning! Could not compile %s, its files will be compiled "
+            "separately" % source[0].get_path())
+        with open(fallback_marker, "w") as fp:
+            fp.write(signature)
+
+    for obj, node in zip(target, source[1:]):
+        status = compile_action([obj], [node], env)
+        if status:
+            return status
+    return 0
+
+
+def _build_empty_objects(target, work_path, env):
+    if not target:
+        return 0
+    empty_path = work_path + ".empty.c"
+    # ISO C forbids an empty translation unit
+    content = "typedef int unity_empty_unit;\n"
+    if _read_file(empty_path) != content:
+        with open(empty_path, "w") as fp:
+            fp.write(content)
+    status = Action("$CCCOM", "$CCCOMSTR")(target[:1], [env.File(empty_path)], env)
+    if status:
+        return status
+    for obj in target[1:]:
+        shutil.copyfile(target[0].get_abspath(), obj.get_abspath())
+    return 0
+
+
+def build_unity_objects(env, variant_dir, src_dir, src_filter, batches):
+    """The same as `env.BuildSources()` but returns object nodes where C
+    files are compiled in `batches` groups"""
+
+    nodes = env.CollectBuildFiles(variant_dir, src_dir, src_filter)
+    c_nodes = [
+        node for node in nodes
+        if isinstance(node, FS.File) and node.get_suffix() == ".c"
+    ]
+    if len(c_nodes) < 2:
+        c_nodes = []
+    objects = [
+        env.Object(node) if isinstance(node, FS.File) else node
+        for node in nodes
+        if node not in c_nodes
+    ]
+    if not c_nodes:
+        return objects
+
+    if "UnityObject" not in env["BUILDERS"]:
+        env.Append(BUILDERS=dict(UnityObject=env.Builder(
+            # Function actions depend only on their code by default
+            action=Action(_compile_batch, None, varlist=[
+                "CC", "CFLAGS", "CCFLAGS", "CPPFLAGS",
+                "_CPPDEFFLAGS", "_CPPINCFLAGS"
+            ]),
+            source_scanner=CScanner(),
+            suffix=".o",
+        )))
+
+    build_dir = env.subst(variant_dir)
+    # Generated sources are kept out of the variant directory, SCons would
+    # look for them in the source directory otherwise
+    unity_dir = build_dir + "Unity"
+    if not os.path.isdir(unity_dir):
+        os.makedirs(unity_dir)
+    c_sources = sorted(node.srcnode().get_abspath() for node in c_nodes)
+    for index, group in enumerate(split_sources(c_sources, batches)):
+        unity_path = os.path.join(unity_dir, "unity_%d.c" % index)
+        content = generate_unity_source(group)
+        # Unchanged files are not rewritten to keep the objects up to date
+        if _read_file(unity_path) != content:
+            with open(unity_path, "w") as fp:
+                fp.write(content)
+        objects.extend(env.UnityObject(
+            [
+                os.path.join(build_dir, "unity_%d.%d.o" % (index, file_index))
+                for file_index in range(len(group))
+            ],
+            [env.File(unity_path)] + [env.File(path) for path in group],
+        ))
+    return objects
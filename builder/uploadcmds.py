@@ -0,0 +1,127 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Arguments of the upload tools shared by the build script and the
+standalone flasher (flash.py). The functions don't depend on SCons,
+a caller passes either SCons variables or real values.
+"""
+
+# Boards flashed with the dfu-util build from the Arduino package
+ARDUINO_DFU_BOARD_PREFIXES = ("portenta", "opta", "nicla", "giga")
+
+DEFAULT_OFFSET = "0x08000000"
+
+
+def get_blackmagic_flags(protocol, port, load_cmd="load"):
+    return [
+        "-nx",
+        "--batch",
+        "-ex", "target extended-remote %s" % port,
+        "-ex", "monitor %s_scan" %
+        ("jtag" if protocol == "blackmagic-jtag" else "swdp"),
+        "-ex", "attach 1",
+        "-ex", load_cmd,
+        "-ex", "compare-sections",
+        "-ex", "kill"
+    ]
+
+
+def get_jlink_flags(board_config, protocol, speed=""):
+    return [
+        "-device", board_config.get("debug", {}).get("jlink_device"),
+        "-speed", speed or "4000",
+        "-if", ("jtag" if protocol == "jlink-jtag" else "swd"),
+        "-autoconnect", "1",
+        "-NoGui", "1"
+    ]
+
+
+def get_jlink_commands(source, offset):
+    return [
+        "h",
+        "loadbin \"%s\", %s" % (source, offset),
+        "r",
+        "q"
+    ]
+
+
+def get_dfu_flags(hwids, offset):
+    return [
+        "-d", ",".join(["%s:%s" % (hwid[0], hwid[1]) for hwid in hwids]),
+        "-a", "0", "-s", "%s:leave" % offset, "-D"
+    ]
+
+
+def get_stm32flash_flags(offset, speed=""):
+    return ["-g", offset, "-b", speed or "115200", "-w"]
+
+
+def get_openocd_program_cmd(source, offset, reset=True):
+    cmd = "program {%s} %s verify" % (source, offset)
+    return "%s reset; shutdown;" % cmd if reset else cmd
+
+
+def get_openocd_delta_cmd(source, offset, delta):
+    """Programs sectors from the `delta` HEX file, nothing if it's an empty
+    string or the whole image if it's None. The whole image is verified in
+    case another board was connected since the last upload"""
+
+    if delta is None:
+        return get_openocd_program_cmd(source, offset)
+    program_cmd = get_openocd_program_cmd(source, offset, reset=False)
+    return " ".join(
+        ["init;", "reset init;"]
+        + (["flash write_image erase {%s};" % delta] if delta else [])
+        + [
+            "if {[catch {verify_image {%s} %s}]} {%s};" % (
+                source, offset, program_cmd),
+            "reset run;",
+            "shutdown;",
+        ]
+    )
+
+
+def get_gdb_load_cmd(delta):
+    if delta is None:
+        return "load"
+    return "load %s" % delta if delta else "echo Firmware is up to date\\n"
+
+
+def get_upload_device_flags(protocol, uploader, flags, device, openocd=False):
+    """Returns uploader flags which select one of several devices by
+    the serial number of a probe, other uploaders use the upload port"""
+
+    flags = list(flags)
+    if protocol.startswith("jlink"):
+        return ["-SelectEmuBySN", device] + flags
+    if protocol == "dfu" and "dfu-util" in uploader:
+        return ["-S", device] + flags
+    if openocd:
+        # The adapter must be selected before programming
+        return flags[:-2] + ["-c", "adapter serial %s" % device] + flags[-2:]
+    return flags
+
+
+def get_openocd_flags(tool_config, package_dir, program_cmd, speed="",
+                      verbose=False):
+    """The program command is always passed last, the multi-device upload
+    inserts the adapter selection right before it"""
+
+    flags = ["-d%d" % (2 if verbose else 1)]
+    flags.extend(tool_config.get("server").get("arguments", []))
+    if speed:
+        flags.extend(["-c", "adapter speed %s" % speed])
+    flags.extend(["-c", program_cmd])
+    return [f.replace("$PACKAGE_DIR", package_dir or "") for f in flags]
@@ -0,0 +1,114 @@
+#include <stdint.h>
+#include "stm32f4xx.h"
+
+#define TAPS 32
+#define SAMPLES 1024
+
+volatile uint32_t benchmark_cycles;
+volatile float benchmark_result;
+
+static volatile uint32_t systick_wraps;
+static float input[SAMPLES];
+static float output[SAMPLES];
+static float coefficients[TAPS];
+
+void SysTick_Handler(void)
+{
+    systick_wraps++;
+}
+
+static uint64_t get_cycles(void)
+{
+    uint32_t wraps, value;
+    do {
+        wraps = systick_wraps;
+        value = SysTick->VAL;
+    } while (wraps != systick_wraps);
+    /* SysTick counts down from the reload value */
+    return ((uint64_t)wraps << 24) + (SysTick_LOAD_RELOAD_Msk - value);
+}
+
+static void fir_filter(void)
+{
+    int i, j;
+    for (i = TAPS; i < SAMPLES; i++) {
+        float acc = 0.0f;
+        for (j = 0; j < TAPS; j++) {
+            acc += coefficients[j] * input[i - j];
+        }
+        output[i] = acc;
+    }
+}
+
+static void biquad_filter(void)
+{
+    const float b0 = 0.2929f, b1 = 0.5858f, b2 = 0.2929f;
+    const float a1 = 0.0f, a2 = 0.1716f;
+    float x1 = 0.0f, x2 = 0.0f, y1 = 0.0f, y2 = 0.0f;
+    int i;
+    for (i = 0; i < SAMPLES; i++) {
+        float y = b0 * output[i] + b1 * x1 + b2 * x2 - a1 * y1 - a2 * y2;
+        x2 = x1;
+        x1 = output[i];
+        y2 = y1;
+        y1 = y;
+        output[i] = y;
+    }
+}
+
+#ifdef SEMIHOSTING
+static void semihosting_write(const char *text)
+{
+    register uint32_t operation __asm__("r0") = 0x04; /* SYS_WRITE0 */
+    register const char *argument __asm__("r1") = text;
+    __asm__ volatile("bkpt 0xAB" : "+r"(operation) : "r"(argument) : "memory");
+}
+
+static void report(uint32_t cycles)
+{
+    char text[48] = "FIR + biquad: ";
+    char digits[11];
+    int pos = 14, count = 0;
+    do {
+        digits[count++] = '0' + cycles % 10;
+        cycles /= 10;
+    } while (cycles);
+    while (count) {
+        text[pos++] = digits[--count];
+    }
+    text[pos] = '\0';
+    semihosting_write(text);
+    semihosting_write(" cycles\n");
+}
+#endif
+
+int main(void)
+{
+    uint64_t start;
+    int i;
+
+    for (i = 0; i < SAMPLES; i++) {
+        input[i] = (float)((i * 7919) % 1000) / 1000.0f - 0.5f;
+    }
+    for (i = 0; i < TAPS; i++) {
+        coefficients[i] = 1.0f / (float)(TAPS + i);
+    }
+
+    SysTick->LOAD = SysTick_LOAD_RELOAD_Msk;
+    SysTick->VAL = 0;
+    SysTick->CTRL = SysTick_CTRL_CLKSOURCE_Msk | SysTick_CTRL_TICKINT_Msk |
+                    SysTick_CTRL_ENABLE_Msk;
+
+    start = get_cycles();
+    fir_filter();
+    biquad_filter();
+    benchmark_cycles = (uint32_t)(get_cycles() - start);
+    benchmark_result = output[SAMPLES - 1];
+
+#ifdef SEMIHOSTING
+    report(benchmark_cycles);
+#endif
+
+    while (1) {
+    }
+}
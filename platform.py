@@ -12,16 +12,216 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
 import os
 import sys
 import subprocess
 
 from platformio.managers.platform import PlatformBase
+from platformio.platform.board import PlatformBoardConfig
 from platformio.project.helpers import get_project_dir
 
 
 IS_WINDOWS = sys.platform.startswith("win")
 
+# Bump when the layout of the cached board index or the synthesized
+# debug tool tables change
+BOARDS_INDEX_VERSION = 1
+
+ARDUINO_MBED_BOARDS = ("portenta", "opta", "nicla_vision", "giga")
+ARDUINO_DFU_BOARDS = ("portenta", "opta", "nicla", "giga")
+
+# Arduino cores maintained in separate framework packages
+ARDUINO_CORE_PACKAGES = {
+    "maple": "framework-arduinoststm32-maple",
+    "stm32l0": "framework-arduinoststm32l0",
+}
+
+# Packages required by the official STM32duino core
+ARDUINO_STM32DUINO_PACKAGES = {
+    "toolchain-gccarmnoneeabi": {"version": "~1.120301.0"},
+    "framework-cmsis": {"version": "~2.60300.0", "optional": False},
+    "framework-cmsis-dsp": {"optional": False},
+}
+
+ZEPHYR_PACKAGES = {
+    "tool-cmake": {"optional": False},
+    "tool-dtc": {"optional": False},
+    "tool-ninja": {"optional": False},
+    "toolchain-gccarmnoneeabi": {"version": "~1.120301.0"},
+}
+if not IS_WINDOWS:
+    ZEPHYR_PACKAGES["tool-gperf"] = {"optional": False}
+
+# DFU upload tool -> packages which are not needed along with it
+DFU_UNUSED_PACKAGES = {
+    "tool-dfuutil": ("tool-stm32duino", "tool-dfuutil-arduino"),
+    "tool-dfuutil-arduino": ("tool-dfuutil", "tool-stm32duino"),
+    "tool-stm32duino": (),
+}
+
+
+# Resolved package changes of build configurations, see resolve_packages()
+_RESOLVED_PACKAGES = {}
+
+
+def resolve_packages(board, build_core, build_mcu, frameworks, upload_protocol,
+                     use_jlink):
+    """Returns the framework and package changes required by a build
+    configuration as a dict with `frameworks`, `packages` and `remove` keys.
+    The result is shared between calls with the same configuration and must
+    not be modified"""
+
+    key = (board, build_core, build_mcu, tuple(frameworks), upload_protocol,
+           use_jlink)
+    if key not in _RESOLVED_PACKAGES:
+        _RESOLVED_PACKAGES[key] = _resolve_packages(*key)
+    return _RESOLVED_PACKAGES[key]
+
+
+def _resolve_packages(board, build_core, build_mcu, frameworks, upload_protocol,
+                      use_jlink):
+    result = {"frameworks": {}, "packages": {}, "remove": []}
+
+    def _update(section, items):
+        for name, options in items.items():
+            result[section].setdefault(name, {}).update(options)
+
+    if "arduino" in frameworks:
+        if board.startswith(ARDUINO_MBED_BOARDS):
+            _update("frameworks", {"arduino": {
+                "package": "framework-arduino-mbed",
+                "script": "builder/frameworks/arduino/mbed-core/arduino-core-mbed.py"
+            }})
+            _update("packages", {"framework-arduinoststm32": {"optional": True}})
+        elif build_core in ARDUINO_CORE_PACKAGES:
+            core_package = ARDUINO_CORE_PACKAGES[build_core]
+            _update("frameworks", {"arduino": {"package": core_package}})
+            _update("packages", {
+                core_package: {"optional": False},
+                "framework-arduinoststm32": {"optional": True}
+            })
+        else:
+            _update("packages", ARDUINO_STM32DUINO_PACKAGES)
+
+    if "mbed" in frameworks:
+        _update("packages", {"toolchain-gccarmnoneeabi": {"version": "~1.90201.0"}})
+
+    if "cmsis" in frameworks:
+        assert build_mcu, ("Missing MCU field for %s" % board)
+        _update("packages", {"framework-cmsis-" + build_mcu[0:7]: {"optional": False}})
+
+    if "stm32cube" in frameworks:
+        assert build_mcu, ("Missing MCU field for %s" % board)
+        _update("frameworks", {"stm32cube": {
+            "package": "framework-stm32cube%s" % build_mcu[5:7]
+        }})
+
+    if any(f in frameworks for f in ("cmsis", "stm32cube")):
+        _update("packages", {"tool-ldscripts-ststm32": {"optional": False}})
+
+    if upload_protocol == "dfu":
+        dfu_package = "tool-dfuutil"
+        if board.startswith(ARDUINO_DFU_BOARDS):
+            dfu_package = "tool-dfuutil-arduino"
+        elif build_mcu.startswith("stm32f103"):
+            dfu_package = "tool-stm32duino"
+        result["remove"].extend(DFU_UNUSED_PACKAGES[dfu_package])
+        _update("packages", {dfu_package: {"optional": False}})
+
+    if board == "mxchip_az3166":
+        _update("frameworks", {"arduino": {
+            "package": "framework-arduinostm32mxchip",
+            "script": "builder/frameworks/arduino/mxchip.py"
+        }})
+        _update("packages", {"toolchain-gccarmnoneeabi": {"version": "~1.60301.0"}})
+
+    if "zephyr" in frameworks:
+        _update("packages", ZEPHYR_PACKAGES)
+
+    if not use_jlink:
+        result["remove"].append("tool-jlink")
+
+    return result
+
+
+class IndexedBoardConfig(PlatformBoardConfig):
+    """Board config restored from the board index without parsing its manifest"""
+
+    def __init__(self, manifest_path, manifest):  # pylint: disable=super-init-not-called
+        self._id = os.path.basename(manifest_path)[:-5]
+        self.manifest_path = manifest_path
+        self._manifest = manifest
+
+
+class LazyDebugConfig(dict):
+    """Board `debug` section which synthesizes the default `tools` on first read"""
+
+    def __init__(self, debug, factory):
+        super().__init__(debug)
+        self._factory = factory
+
+    def resolve(self):
+        if self._factory:
+            factory, self._factory = self._factory, None
+            dict.__setitem__(self, "tools", factory(dict.get(self, "tools", {})))
+        return self
+
+    def __getitem__(self, key):
+        if key == "tools":
+            self.resolve()
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        if key == "tools":
+            self.resolve()
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        return dict.__iter__(self.resolve())
+
+    def __len__(self):
+        return dict.__len__(self.resolve())
+
+    def __eq__(self, other):
+        return dict.__eq__(self.resolve(), other)
+
+    def __repr__(self):
+        return dict.__repr__(self.resolve())
+
+    def __reduce_ex__(self, protocol):
+        return dict, (dict(self.resolve().items()),)
+
+    __hash__ = None
+
+    def get(self, key, default=None):
+        if key == "tools":
+            self.resolve()
+        return dict.get(self, key, default)
+
+    def setdefault(self, key, default=None):
+        if key == "tools":
+            self.resolve()
+        return dict.setdefault(self, key, default)
+
+    def pop(self, key, *args):
+        if key == "tools":
+            self.resolve()
+        return dict.pop(self, key, *args)
+
+    def keys(self):
+        return dict.keys(self.resolve())
+
+    def values(self):
+        return dict.values(self.resolve())
+
+    def items(self):
+        return dict.items(self.resolve())
+
+    def copy(self):
+        return dict(self.items())
+
 
 class Ststm32Platform(PlatformBase):
 
@@ -31,74 +231,7 @@ class Ststm32Platform(PlatformBase):
         build_core = variables.get(
             "board_build.core", board_config.get("build.core", "arduino"))
         build_mcu = variables.get("board_build.mcu", board_config.get("build.mcu", ""))
-
-        frameworks = variables.get("pioframework", [])
-        if "arduino" in frameworks:
-            if board.startswith(("portenta", "opta", "nicla_vision", "giga")):
-                self.frameworks["arduino"]["package"] = "framework-arduino-mbed"
-                self.frameworks["arduino"][
-                    "script"
-                ] = "builder/frameworks/arduino/mbed-core/arduino-core-mbed.py"
-                self.packages["framework-arduinoststm32"]["optional"] = True
-            elif build_core == "maple":
-                self.frameworks["arduino"]["package"] = "framework-arduinoststm32-maple"
-                self.packages["framework-arduinoststm32-maple"]["optional"] = False
-                self.packages["framework-arduinoststm32"]["optional"] = True
-            elif build_core == "stm32l0":
-                self.frameworks["arduino"]["package"] = "framework-arduinoststm32l0"
-                self.packages["framework-arduinoststm32l0"]["optional"] = False
-                self.packages["framework-arduinoststm32"]["optional"] = True
-            else:
-                self.packages["toolchain-gccarmnoneeabi"]["version"] = "~1.120301.0"
-                self.packages["framework-cmsis"]["version"] = "~2.60300.0"
-                self.packages["framework-cmsis"]["optional"] = False
-                self.packages["framework-cmsis-dsp"]["optional"] = False
-
-        if "mbed" in frameworks:
-            self.packages["toolchain-gccarmnoneeabi"]["version"] = "~1.90201.0"
-
-        if "cmsis" in frameworks:
-            assert build_mcu, ("Missing MCU field for %s" % board)
-            device_package = "framework-cmsis-" + build_mcu[0:7]
-            if device_package in self.packages:
-                self.packages[device_package]["optional"] = False
-
-        if "stm32cube" in frameworks:
-            assert build_mcu, ("Missing MCU field for %s" % board)
-            device_package = "framework-stm32cube%s" % build_mcu[5:7]
-            self.frameworks["stm32cube"]["package"] = device_package
-
-        if any(f in frameworks for f in ("cmsis", "stm32cube")):
-            self.packages["tool-ldscripts-ststm32"]["optional"] = False
-
         default_protocol = board_config.get("upload.protocol") or ""
-        if variables.get("upload_protocol", default_protocol) == "dfu":
-            dfu_package = "tool-dfuutil"
-            if board.startswith(("portenta", "opta", "nicla", "giga")):
-                dfu_package = "tool-dfuutil-arduino"
-                self.packages.pop("tool-dfuutil")
-                self.packages.pop("tool-stm32duino")
-            elif build_mcu.startswith("stm32f103"):
-                dfu_package = "tool-stm32duino"
-            else:
-                self.packages.pop("tool-stm32duino")
-                self.packages.pop("tool-dfuutil-arduino")
-            self.packages[dfu_package]["optional"] = False
-
-        if board == "mxchip_az3166":
-            self.frameworks["arduino"][
-                "package"] = "framework-arduinostm32mxchip"
-            self.frameworks["arduino"][
-                "script"] = "builder/frameworks/arduino/mxchip.py"
-            self.packages["toolchain-gccarmnoneeabi"]["version"] = "~1.60301.0"
-
-        if "zephyr" in variables.get("pioframework", []):
-            for p in self.packages:
-                if p in ("tool-cmake", "tool-dtc", "tool-ninja"):
-                    self.packages[p]["optional"] = False
-            self.packages["toolchain-gccarmnoneeabi"]["version"] = "~1.120301.0"
-            if not IS_WINDOWS:
-                self.packages["tool-gperf"]["optional"] = False
 
         # configure J-LINK tool
         jlink_conds = [
@@ -110,72 +243,194 @@ class Ststm32Platform(PlatformBase):
                 "jlink" in board_config.get(key, "")
                 for key in ("debug.default_tools", "upload.protocol")
             ])
-        jlink_pkgname = "tool-jlink"
-        if not any(jlink_conds) and jlink_pkgname in self.packages:
-            del self.packages[jlink_pkgname]
+
+        resolved = resolve_packages(
+            board,
+            build_core,
+            build_mcu,
+            variables.get("pioframework", []),
+            variables.get("upload_protocol", default_protocol),
+            any(jlink_conds),
+        )
+        for name, options in resolved["frameworks"].items():
+            self.frameworks[name].update(options)
+        for name, options in resolved["packages"].items():
+            if name in self.packages:
+                self.packages[name].update(options)
+        for name in resolved["remove"]:
+            self.packages.pop(name, None)
 
         return PlatformBase.configure_default_packages(self, variables,
                                                        targets)
 
     def install_package(self, name, *args, **kwargs):
         pkg = super().install_package(name, *args, **kwargs)
-        if name != "framework-zephyr":
-            return pkg
+        if name == "framework-zephyr":
+            self._install_zephyr_deps(pkg)
+        return pkg
 
+    def _install_zephyr_deps(self, pkg):
         prj_west_manifest = os.path.join(get_project_dir(), "west.yml")
-        try:
-            (
-                subprocess.run(
-                    [
-                        os.path.normpath(sys.executable),
-                        os.path.join(
-                            pkg.path, "scripts", "platformio", "install-deps.py"
-                        ),
-                        "--platform",
-                        self.name,
-                    ] + (
-                        ["--manifest", prj_west_manifest]
-                        if os.path.isfile(prj_west_manifest)
-                        else []
-                    )
-                )
-            )
-        except subprocess.CalledProcessError:
-            self.pm.log.info("Failed to install Zephyr dependencies!")
+        deps_hash = hashlib.sha1()
+        for value in (
+            self.name,
+            pkg.path,
+            pkg.metadata.version if pkg.metadata else "",
+        ):
+            deps_hash.update(("%s\n" % value).encode())
+        if os.path.isfile(prj_west_manifest):
+            with open(prj_west_manifest, "rb") as fp:
+                deps_hash.update(fp.read())
+        deps_hash = deps_hash.hexdigest()
 
-        return pkg
+        # The modules depend on the west manifest of a project, so the hash
+        # of the last install is kept per project instead of in the package
+        deps_hash_path = os.path.join(
+            self.config.get("platformio", "workspace_dir"), "zephyr-deps.sha1")
+        if os.path.isfile(deps_hash_path):
+            with open(deps_hash_path) as fp:
+                if fp.read().strip() == deps_hash:
+                    return
+
+        # Packages are installed by another platform instance than the one
+        # which runs the build, so the script has to finish here
+        result = subprocess.run(
+            [
+                os.path.normpath(sys.executable),
+                os.path.join(
+                    pkg.path, "scripts", "platformio", "install-deps.py"
+                ),
+                "--platform",
+                self.name,
+            ] + (
+                ["--manifest", prj_west_manifest]
+                if os.path.isfile(prj_west_manifest)
+                else []
+            ),
+            check=False,
+        )
+        if result.returncode != 0:
+            self.pm.log.info("Failed to install Zephyr dependencies!")
+            return
+        try:
+            os.makedirs(os.path.dirname(deps_hash_path), exist_ok=True)
+            with open(deps_hash_path, "w") as fp:
+                fp.write(deps_hash)
+        except OSError:
+            pass
 
     def get_boards(self, id_=None):
+        if not id_:
+            return self._get_indexed_boards()
         result = PlatformBase.get_boards(self, id_)
         if not result:
             return result
-        if id_:
-            return self._add_default_debug_tools(result)
-        else:
-            for key, value in result.items():
-                result[key] = self._add_default_debug_tools(result[key])
+        return self._add_default_debug_tools(result)
+
+    def _get_indexed_boards(self):
+        signature = self._get_boards_signature()
+        index_path = self._get_boards_index_path()
+        index = None
+        try:
+            with open(index_path) as fp:
+                index = json.load(fp)
+        except (OSError, ValueError):
+            pass
+
+        if (
+            isinstance(index, dict)
+            and index.get("version") == BOARDS_INDEX_VERSION
+            and index.get("platform_version") == self.version
+            and index.get("signature") == signature
+        ):
+            for board_id, manifest_path, manifest in index["boards"]:
+                if board_id not in self._BOARDS_CACHE:
+                    self._BOARDS_CACHE[board_id] = IndexedBoardConfig(
+                        manifest_path, manifest)
+            return self._BOARDS_CACHE
+
+        result = PlatformBase.get_boards(self)
+        for key, value in result.items():
+            result[key] = self._add_default_debug_tools(value)
+            # the index keeps the synthesized debug tools
+            value.manifest["debug"].resolve()
+
+        index = {
+            "version": BOARDS_INDEX_VERSION,
+            "platform_version": self.version,
+            "signature": signature,
+            "boards": [
+                [key, value.manifest_path, value.manifest]
+                for key, value in result.items()
+            ],
+        }
+        try:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            tmp_path = "%s.%d.tmp" % (index_path, os.getpid())
+            with open(tmp_path, "w") as fp:
+                json.dump(index, fp, separators=(",", ":"))
+            os.replace(tmp_path, index_path)
+        except OSError:
+            pass
+
         return result
 
+    def _get_boards_dirs(self):
+        # the same lookup order as in PlatformBase.get_boards
+        return [
+            self.config.get("platformio", "boards_dir"),
+            os.path.join(self.config.get("platformio", "core_dir"), "boards"),
+            os.path.join(self.get_dir(), "boards"),
+        ]
+
+    def _get_boards_signature(self):
+        signature = []
+        for boards_dir in self._get_boards_dirs():
+            if not os.path.isdir(boards_dir):
+                continue
+            for entry in sorted(os.scandir(boards_dir), key=lambda e: e.name):
+                if not entry.name.endswith(".json"):
+                    continue
+                stat = entry.stat()
+                signature.append([entry.path, stat.st_mtime_ns, stat.st_size])
+        return signature
+
+    def _get_boards_index_path(self):
+        return os.path.join(
+            self.config.get("platformio", "cache_dir"),
+            "%s-boards-%s.json" % (
+                self.name,
+                hashlib.sha1(self.get_dir().encode()).hexdigest()[:10],
+            ),
+        )
+
     def _add_default_debug_tools(self, board):
+        debug = board.manifest.get("debug", {})
+        if not isinstance(debug, LazyDebugConfig):
+            board.manifest["debug"] = LazyDebugConfig(
+                debug,
+                lambda tools: self._get_default_debug_tools(board, tools)
+            )
+        return board
+
+    def _get_default_debug_tools(self, board, tools):
         debug = board.manifest.get("debug", {})
         upload_protocols = board.manifest.get("upload", {}).get(
             "protocols", [])
-        if "tools" not in debug:
-            debug["tools"] = {}
 
         # BlackMagic, J-Link, ST-Link
         for link in ("blackmagic", "jlink", "stlink", "cmsis-dap"):
-            if link not in upload_protocols or link in debug["tools"]:
+            if link not in upload_protocols or link in tools:
                 continue
             if link == "blackmagic":
-                debug["tools"]["blackmagic"] = {
+                tools["blackmagic"] = {
                     "hwids": [["0x1d50", "0x6018"]],
                     "require_debug_port": True
                 }
             elif link == "jlink":
                 assert debug.get("jlink_device"), (
                     "Missed J-Link Device ID for %s" % board.id)
-                debug["tools"][link] = {
+                tools[link] = {
                     "server": {
                         "package": "tool-jlink",
                         "arguments": [
@@ -207,18 +462,17 @@ class Ststm32Platform(PlatformBase):
                     ])
                     server_args.extend(debug.get("openocd_extra_args", []))
 
-                debug["tools"][link] = {
+                tools[link] = {
                     "server": {
                         "package": "tool-openocd",
                         "executable": "bin/openocd",
                         "arguments": server_args
                     }
                 }
-            debug["tools"][link]["onboard"] = link in debug.get("onboard_tools", [])
-            debug["tools"][link]["default"] = link in debug.get("default_tools", [])
+            tools[link]["onboard"] = link in debug.get("onboard_tools", [])
+            tools[link]["default"] = link in debug.get("default_tools", [])
 
-        board.manifest["debug"] = debug
-        return board
+        return tools
 
     def configure_debug_session(self, debug_config):
         if debug_config.speed:
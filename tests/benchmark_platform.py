@@ -0,0 +1,96 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures cold and warm latency of the platform hooks which run for every
+project environment.
+
+    python tests/benchmark_platform.py
+"""
+
+import importlib.util
+import os
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _load_platform_module():
+    spec = importlib.util.spec_from_file_location(
+        "ststm32_platform", os.path.join(ROOT_DIR, "platform.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _measure(title, func, repeat=5):
+    start = time.perf_counter()
+    func()
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    warm = (time.perf_counter() - start) / repeat
+    print("%-32s cold %8.2f ms   warm %8.2f ms" % (title, cold * 1000, warm * 1000))
+
+
+def benchmark_get_boards(platform_module):
+    def _get_boards():
+        platform = platform_module.Ststm32Platform(
+            os.path.join(ROOT_DIR, "platform.json"))
+        return platform.get_boards()
+
+    platform = platform_module.Ststm32Platform(
+        os.path.join(ROOT_DIR, "platform.json"))
+    index_path = platform._get_boards_index_path()  # pylint: disable=protected-access
+    if os.path.isfile(index_path):
+        os.remove(index_path)
+    # A cold run builds the board index, warm runs of new platform
+    # instances restore the boards from it
+    _measure("get_boards (%d boards)" % len(os.listdir(
+        os.path.join(ROOT_DIR, "boards"))), _get_boards)
+
+
+def benchmark_resolve_packages(platform_module, platform):
+    configurations = []
+    for board_id, board in sorted(platform.get_boards().items()):
+        for framework in board.manifest.get("frameworks", []):
+            for protocol in board.manifest.get("upload", {}).get("protocols", []):
+                configurations.append((
+                    board_id,
+                    board.get("build.core", "arduino"),
+                    board.get("build.mcu", ""),
+                    [framework],
+                    protocol,
+                    protocol == "jlink",
+                ))
+
+    def _resolve_all():
+        for configuration in configurations:
+            platform_module.resolve_packages(*configuration)
+
+    platform_module._RESOLVED_PACKAGES.clear()  # pylint: disable=protected-access
+    _measure("resolve_packages (%d configs)" % len(configurations), _resolve_all)
+
+
+def main():
+    platform_module = _load_platform_module()
+    platform = platform_module.Ststm32Platform(
+        os.path.join(ROOT_DIR, "platform.json"))
+    benchmark_get_boards(platform_module)
+    benchmark_resolve_packages(platform_module, platform)
+
+
+if __name__ == "__main__":
+    main()
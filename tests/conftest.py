@@ -0,0 +1,37 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Helper modules of the build scripts are imported as top-level modules
+sys.path.insert(0, os.path.join(ROOT_DIR, "builder"))
+
+
+@pytest.fixture(scope="session")
+def platform_module():
+    """The platform.py module, it is not importable as "platform" without
+    shadowing the standard library module"""
+
+    pytest.importorskip("platformio.managers.platform")
+    spec = importlib.util.spec_from_file_location(
+        "ststm32_platform", os.path.join(ROOT_DIR, "platform.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,126 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BOARDS = ("disco_f407vg", "nucleo_f401re", "bluepill_f103c8")
+
+
+@pytest.fixture
+def get_boards(tmp_path, monkeypatch, platform_module):
+    """Returns the boards of a platform copy with a few boards, along with
+    whether they were restored from the board index"""
+
+    platform_dir = tmp_path / "platform"
+    (platform_dir / "boards").mkdir(parents=True)
+    shutil.copy(os.path.join(ROOT_DIR, "platform.json"), str(platform_dir))
+    for board in BOARDS:
+        shutil.copy(os.path.join(ROOT_DIR, "boards", board + ".json"),
+                    str(platform_dir / "boards"))
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PLATFORMIO_CORE_DIR", str(tmp_path / "core"))
+    monkeypatch.setenv("PLATFORMIO_BOARDS_DIR", str(tmp_path / "boards"))
+
+    def _get_boards():
+        platform = platform_module.Ststm32Platform(
+            str(platform_dir / "platform.json"))
+        boards = platform.get_boards()
+        indexed = {
+            isinstance(board, platform_module.IndexedBoardConfig)
+            for board in boards.values()
+        }
+        assert len(indexed) == 1
+        return boards, indexed.pop()
+
+    return _get_boards
+
+
+def _update_json(path, update):
+    with open(path) as fp:
+        data = json.load(fp)
+    update(data)
+    with open(path, "w") as fp:
+        json.dump(data, fp)
+
+
+def test_index_is_reused(get_boards):
+    boards, indexed = get_boards()
+    assert not indexed
+    expected = {
+        board_id: board.manifest for board_id, board in boards.items()}
+
+    boards, indexed = get_boards()
+    assert indexed
+    assert sorted(boards) == sorted(BOARDS)
+    # The index keeps the synthesized debug tools
+    assert {
+        board_id: board.manifest for board_id, board in boards.items()
+    } == expected
+    assert "stlink" in boards["disco_f407vg"].manifest["debug"]["tools"]
+
+
+def test_manifest_size_change(tmp_path, get_boards):
+    get_boards()
+    _update_json(
+        str(tmp_path / "platform" / "boards" / "disco_f407vg.json"),
+        lambda manifest: manifest.update(name="Custom Discovery"))
+
+    boards, indexed = get_boards()
+    assert not indexed
+    assert boards["disco_f407vg"].get("name") == "Custom Discovery"
+    assert get_boards()[1]
+
+
+def test_manifest_mtime_change(tmp_path, get_boards):
+    get_boards()
+    manifest_path = str(tmp_path / "platform" / "boards" / "disco_f407vg.json")
+    stat = os.stat(manifest_path)
+    with open(manifest_path) as fp:
+        content = fp.read()
+    # the same size as before
+    with open(manifest_path, "w") as fp:
+        fp.write(content.replace('"name": "ST', '"name": "XX', 1))
+    os.utime(manifest_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert os.path.getsize(manifest_path) == stat.st_size
+
+    boards, indexed = get_boards()
+    assert not indexed
+    assert boards["disco_f407vg"].get("name").startswith("XX")
+
+
+def test_new_manifest(tmp_path, get_boards):
+    get_boards()
+    shutil.copy(os.path.join(ROOT_DIR, "boards", "nucleo_f103rb.json"),
+                str(tmp_path / "platform" / "boards"))
+
+    boards, indexed = get_boards()
+    assert not indexed
+    assert "nucleo_f103rb" in boards
+
+
+def test_platform_version_change(tmp_path, get_boards):
+    get_boards()
+    _update_json(
+        str(tmp_path / "platform" / "platform.json"),
+        lambda manifest: manifest.update(version="100.0.0"))
+
+    assert not get_boards()[1]
+    assert get_boards()[1]
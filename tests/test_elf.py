@@ -0,0 +1,171 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import shutil
+import subprocess
+
+import pytest
+
+import elf
+from elf import ElfFile, ElfFileCache, convert
+
+# $SIZEPROGREGEXP and $SIZEDATAREGEXP of the build script
+SIZE_PATTERNS = (
+    r"^(?:\.text|\.data|\.rodata|\.text.align|\.ARM.exidx)\s+(\d+).*",
+    r"^(?:\.data|\.bss|\.noinit)\s+(\d+).*",
+)
+
+# Firmware-like layout: initialized data is loaded from FLASH, the EEPROM
+# section lies far away from FLASH as on STM32L0/L1, heap and stack are
+# reserved as in linker scripts of ST
+FIRMWARE_ASM = """
+    .section .isr_vector,"a"
+    .long 0x20001000, 0x08000101
+    .text
+    .globl _start
+_start:
+    .fill 70, 1, 0x90
+    .section .rodata
+    .ascii "firmware"
+    .data
+    .long 0x11223344, 0x55667788
+    .bss
+    .zero 64
+    .section .noinit,"aw",@nobits
+    .zero 16
+    .section .eeprom,"aw"
+    .byte 1, 2, 3, 4
+"""
+
+FIRMWARE_LDSCRIPT = """
+MEMORY
+{
+  FLASH (rx) : ORIGIN = 0x08000000, LENGTH = 128K
+  RAM (xrw)  : ORIGIN = 0x20000000, LENGTH = 16K
+  EEPROM (rw): ORIGIN = 0x08080000, LENGTH = 1K
+}
+ENTRY(_start)
+SECTIONS
+{
+  .isr_vector : { KEEP(*(.isr_vector)) } > FLASH
+  .text : { *(.text*) } > FLASH
+  .rodata : { *(.rodata*) } > FLASH
+  .data : { *(.data*) } > RAM AT> FLASH
+  .bss (NOLOAD) : { *(.bss*) } > RAM
+  .noinit (NOLOAD) : { *(.noinit) } > RAM
+  ._user_heap_stack (NOLOAD) : { . = . + 0x600; } > RAM
+  .eeprom : { *(.eeprom) } > EEPROM
+  /DISCARD/ : { *(.note*) *(.comment) }
+}
+"""
+
+
+@pytest.fixture(scope="module")
+def firmware_elf(tmp_path_factory):
+    if not all(shutil.which(tool) for tool in ("as", "ld", "objcopy")):
+        pytest.skip("GNU binutils are not installed")
+    tmp_path = tmp_path_factory.mktemp("firmware")
+    (tmp_path / "firmware.s").write_text(FIRMWARE_ASM)
+    (tmp_path / "firmware.ld").write_text(FIRMWARE_LDSCRIPT)
+    try:
+        subprocess.run(
+            ["as", "--32", "-o", "firmware.o", "firmware.s"],
+            cwd=tmp_path, check=True, capture_output=True)
+        subprocess.run(
+            ["ld", "-m", "elf_i386", "-T", "firmware.ld", "-o", "firmware.elf",
+             "firmware.o"],
+            cwd=tmp_path, check=True, capture_output=True)
+    except subprocess.CalledProcessError as exc:
+        pytest.skip("Cannot build a 32-bit ELF file: %s" % exc.stderr.decode())
+    return tmp_path / "firmware.elf"
+
+
+def _objcopy(elf_path, output_format, target, exclude):
+    flags = []
+    for name in exclude:
+        flags.extend(["-R", name])
+    subprocess.run(
+        ["objcopy", "-O", output_format] + flags + [str(elf_path), str(target)],
+        check=True)
+    return target.read_bytes()
+
+
+@pytest.mark.parametrize("exclude", [[], [".eeprom"]])
+def test_bin_matches_objcopy(firmware_elf, tmp_path, exclude):
+    convert(str(firmware_elf), bin_path=str(tmp_path / "native.bin"),
+            bin_exclude=exclude)
+    expected = _objcopy(firmware_elf, "binary", tmp_path / "objcopy.bin", exclude)
+    assert (tmp_path / "native.bin").read_bytes() == expected
+
+
+@pytest.mark.parametrize("exclude", [[], [".eeprom"]])
+def test_hex_matches_objcopy(firmware_elf, tmp_path, exclude):
+    convert(str(firmware_elf), hex_path=str(tmp_path / "native.hex"),
+            hex_exclude=exclude)
+    expected = _objcopy(firmware_elf, "ihex", tmp_path / "objcopy.hex", exclude)
+    assert (tmp_path / "native.hex").read_bytes() == expected
+
+
+def test_cache_parses_once(firmware_elf, tmp_path, monkeypatch):
+    parsed = []
+
+    class _ElfFile(ElfFile):
+        def _parse(self):
+            parsed.append(self.path)
+            super()._parse()
+
+    monkeypatch.setattr(elf, "ElfFile", _ElfFile)
+    elf_path = tmp_path / "firmware.elf"
+    shutil.copy(str(firmware_elf), str(elf_path))
+    cache = ElfFileCache()
+    try:
+        cache.convert(str(elf_path), bin_path=str(tmp_path / "native.bin"))
+        cache.convert(str(elf_path), hex_path=str(tmp_path / "native.hex"),
+                      hex_exclude=[".eeprom"])
+        assert parsed == [str(elf_path)]
+        assert (tmp_path / "native.bin").read_bytes() == _objcopy(
+            elf_path, "binary", tmp_path / "objcopy.bin", [])
+        assert (tmp_path / "native.hex").read_bytes() == _objcopy(
+            elf_path, "ihex", tmp_path / "objcopy.hex", [".eeprom"])
+
+        # a relinked program
+        data = bytearray(elf_path.read_bytes())
+        data[data.index(b"firmware")] = ord("F")
+        elf_path.unlink()
+        elf_path.write_bytes(bytes(data))
+        cache.convert(str(elf_path), bin_path=str(tmp_path / "native.bin"))
+        assert len(parsed) == 2
+        assert b"Firmware" in (tmp_path / "native.bin").read_bytes()
+    finally:
+        cache.close()
+
+
+@pytest.mark.parametrize("pattern", SIZE_PATTERNS)
+def test_size_matches_size_tool(firmware_elf, pattern):
+    if not shutil.which("size"):
+        pytest.skip("GNU size is not installed")
+    output = subprocess.run(
+        ["size", "-A", "-d", str(firmware_elf)],
+        check=True, capture_output=True, text=True).stdout
+    # The same as the size check of PlatformIO
+    expected = 0
+    for line in output.splitlines():
+        match = re.search(pattern, line.strip())
+        if match:
+            expected += sum(int(value) for value in match.groups())
+
+    with ElfFile(str(firmware_elf)) as elf:
+        assert elf.get_size(pattern) == expected
+    assert expected
@@ -0,0 +1,73 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from flashdelta import FLASH_BASE, DeltaUpload
+
+SECTORS = [(FLASH_BASE + i * 1024, 1024) for i in range(4)]
+
+
+def _write_image(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+
+def _read_ihex_range(path):
+    base, start, end = 0, None, None
+    with open(path) as fp:
+        for line in fp:
+            record = bytes.fromhex(line.strip()[1:])
+            if record[3] == 0x04:
+                base = int.from_bytes(record[4:6], "big") << 16
+            elif record[3] == 0x00:
+                address = base + int.from_bytes(record[1:3], "big")
+                start = address if start is None else min(start, address)
+                end = max(end or 0, address + record[0])
+    return start, end
+
+
+def test_delta_upload_records_per_probe(tmp_path):
+    image = bytearray(b"\xaa" * 3000)
+    firmware = _write_image(tmp_path / "firmware.bin", image)
+    delta_upload = DeltaUpload(str(tmp_path / "state"), SECTORS)
+
+    # Nothing is recorded for the probe yet
+    assert delta_upload.prepare("stlink-0670FF", firmware, FLASH_BASE) is None
+    assert not delta_upload.partial
+    delta_upload.commit()
+
+    assert delta_upload.prepare("stlink-0670FF", firmware, FLASH_BASE) == ""
+    assert delta_upload.partial
+
+    image[1500] = 0x55
+    firmware = _write_image(tmp_path / "firmware.bin", image)
+    delta = delta_upload.prepare("stlink-0670FF", firmware, FLASH_BASE)
+    assert delta and delta_upload.partial
+    # Only the second sector is programmed
+    assert _read_ihex_range(delta) == (FLASH_BASE + 1024, FLASH_BASE + 2048)
+
+    # Another probe doesn't use the record
+    assert delta_upload.prepare("stlink-066DFF", firmware, FLASH_BASE) is None
+
+
+def test_delta_upload_discard(tmp_path):
+    firmware = _write_image(tmp_path / "firmware.bin", b"\xaa" * 3000)
+    delta_upload = DeltaUpload(str(tmp_path / "state"), SECTORS)
+    delta_upload.prepare("jlink-", firmware, FLASH_BASE)
+    delta_upload.commit()
+    assert delta_upload.prepare("jlink-", firmware, FLASH_BASE) == ""
+
+    # Verification has failed, the next upload programs the whole image
+    delta_upload.discard()
+    assert delta_upload.prepare("jlink-", firmware, FLASH_BASE) is None
+    assert not delta_upload.partial
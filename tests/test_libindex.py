@@ -0,0 +1,108 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import libindex
+from libindex import (IncludeCache, get_project_source_dirs, load_lib_index,
+                      scan_headers, select_libs)
+
+
+class ProjectEnv:
+    """Variables and methods of a PlatformIO environment used by the index"""
+
+    def __init__(self, project_dir, build_type="release"):
+        self.project_dir = project_dir
+        self.build_type = build_type
+
+    def subst(self, value):
+        for name, subdir in (("$PROJECT_SRC_DIR", "src"),
+                             ("$PROJECT_INCLUDE_DIR", "include"),
+                             ("$PROJECT_TEST_DIR", "test")):
+            value = value.replace(name, str(self.project_dir / subdir))
+        return value
+
+    def GetBuildType(self):  # pylint: disable=invalid-name
+        return self.build_type
+
+    def GetLibSourceDirs(self):  # pylint: disable=invalid-name
+        return [
+            str(self.project_dir / "lib"),
+            str(self.project_dir / ".pio" / "libdeps" / "disco"),
+            str(self.project_dir / "extra_libs"),
+        ]
+
+
+def _write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def test_library_includes_are_found(tmp_path):
+    _write(tmp_path / "src" / "main.c", '#include "app.h"\n')
+    _write(tmp_path / "include" / "app.h", "#include <stdint.h>\n")
+    _write(tmp_path / "test" / "test_fs.c", '#include "ff.h"\n')
+    _write(tmp_path / ".pio" / "libdeps" / "disco" / "Net" / "net.c",
+           '#include "lwip/tcp.h"\n')
+    _write(tmp_path / "extra_libs" / "Log" / "log.c", '#include "cmsis_os.h"\n')
+
+    framework = tmp_path / "framework"
+    for lib, header in (("LwIP", "tcp.h"), ("FreeRTOS", "cmsis_os.h"),
+                        ("FatFs", "ff.h")):
+        _write(framework / lib / header, "")
+    index = load_lib_index(
+        str(tmp_path / "cache" / "index.json"),
+        [str(framework / name) for name in ("LwIP", "FreeRTOS", "FatFs")],
+    )
+
+    provided, included = scan_headers(
+        get_project_source_dirs(ProjectEnv(tmp_path)))
+    assert select_libs(index, included - provided) == [
+        str(framework / "LwIP"), str(framework / "FreeRTOS")]
+
+    provided, included = scan_headers(
+        get_project_source_dirs(ProjectEnv(tmp_path, "test")))
+    assert select_libs(index, included - provided) == [
+        str(framework / name) for name in ("LwIP", "FreeRTOS", "FatFs")]
+
+
+def test_includes_are_cached(tmp_path, monkeypatch):
+    _write(tmp_path / "src" / "main.c", '#include "app.h"\n')
+    _write(tmp_path / "include" / "app.h", '#include "ff.h"\n')
+    source_dirs = get_project_source_dirs(ProjectEnv(tmp_path))
+    cache_path = str(tmp_path / ".pio" / "build" / "includes.json")
+    expected = scan_headers(source_dirs)
+
+    read_paths = []
+    read_includes = libindex.read_includes
+
+    def _read_includes(path):
+        read_paths.append(path)
+        return read_includes(path)
+
+    monkeypatch.setattr(libindex, "read_includes", _read_includes)
+
+    def _scan():
+        cache = IncludeCache(cache_path)
+        result = scan_headers(source_dirs, cache)
+        cache.save()
+        return result
+
+    assert _scan() == expected
+    assert len(read_paths) == 2
+    # a new build
+    assert _scan() == expected
+    assert len(read_paths) == 2
+
+    _write(tmp_path / "src" / "main.c", '#include "app.h"\n#include "tcp.h"\n')
+    assert _scan() == ({"app.h"}, {"app.h", "ff.h", "tcp.h"})
+    assert read_paths[2:] == [str(tmp_path / "src" / "main.c")]
@@ -0,0 +1,179 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _baseline_configure_default_packages(self, variables, targets):
+    """configure_default_packages() before the package tables were added"""
+
+    board = variables.get("board")
+    board_config = self.board_config(board)
+    build_core = variables.get(
+        "board_build.core", board_config.get("build.core", "arduino"))
+    build_mcu = variables.get("board_build.mcu", board_config.get("build.mcu", ""))
+
+    frameworks = variables.get("pioframework", [])
+    if "arduino" in frameworks:
+        if board.startswith(("portenta", "opta", "nicla_vision", "giga")):
+            self.frameworks["arduino"]["package"] = "framework-arduino-mbed"
+            self.frameworks["arduino"][
+                "script"
+            ] = "builder/frameworks/arduino/mbed-core/arduino-core-mbed.py"
+            self.packages["framework-arduinoststm32"]["optional"] = True
+        elif build_core == "maple":
+            self.frameworks["arduino"]["package"] = "framework-arduinoststm32-maple"
+            self.packages["framework-arduinoststm32-maple"]["optional"] = False
+            self.packages["framework-arduinoststm32"]["optional"] = True
+        elif build_core == "stm32l0":
+            self.frameworks["arduino"]["package"] = "framework-arduinoststm32l0"
+            self.packages["framework-arduinoststm32l0"]["optional"] = False
+            self.packages["framework-arduinoststm32"]["optional"] = True
+        else:
+            self.packages["toolchain-gccarmnoneeabi"]["version"] = "~1.120301.0"
+            self.packages["framework-cmsis"]["version"] = "~2.60300.0"
+            self.packages["framework-cmsis"]["optional"] = False
+            self.packages["framework-cmsis-dsp"]["optional"] = False
+
+    if "mbed" in frameworks:
+        self.packages["toolchain-gccarmnoneeabi"]["version"] = "~1.90201.0"
+
+    if "cmsis" in frameworks:
+        assert build_mcu, ("Missing MCU field for %s" % board)
+        device_package = "framework-cmsis-" + build_mcu[0:7]
+        if device_package in self.packages:
+            self.packages[device_package]["optional"] = False
+
+    if "stm32cube" in frameworks:
+        assert build_mcu, ("Missing MCU field for %s" % board)
+        device_package = "framework-stm32cube%s" % build_mcu[5:7]
+        self.frameworks["stm32cube"]["package"] = device_package
+
+    if any(f in frameworks for f in ("cmsis", "stm32cube")):
+        self.packages["tool-ldscripts-ststm32"]["optional"] = False
+
+    default_protocol = board_config.get("upload.protocol") or ""
+    if variables.get("upload_protocol", default_protocol) == "dfu":
+        dfu_package = "tool-dfuutil"
+        if board.startswith(("portenta", "opta", "nicla", "giga")):
+            dfu_package = "tool-dfuutil-arduino"
+            self.packages.pop("tool-dfuutil")
+            self.packages.pop("tool-stm32duino")
+        elif build_mcu.startswith("stm32f103"):
+            dfu_package = "tool-stm32duino"
+        else:
+            self.packages.pop("tool-stm32duino")
+            self.packages.pop("tool-dfuutil-arduino")
+        self.packages[dfu_package]["optional"] = False
+
+    if board == "mxchip_az3166":
+        self.frameworks["arduino"][
+            "package"] = "framework-arduinostm32mxchip"
+        self.frameworks["arduino"][
+            "script"] = "builder/frameworks/arduino/mxchip.py"
+        self.packages["toolchain-gccarmnoneeabi"]["version"] = "~1.60301.0"
+
+    if "zephyr" in variables.get("pioframework", []):
+        for p in self.packages:
+            if p in ("tool-cmake", "tool-dtc", "tool-ninja"):
+                self.packages[p]["optional"] = False
+        self.packages["toolchain-gccarmnoneeabi"]["version"] = "~1.120301.0"
+        if not sys.platform.startswith("win"):
+            self.packages["tool-gperf"]["optional"] = False
+
+    # configure J-LINK tool
+    jlink_conds = [
+        "jlink" in variables.get(option, "")
+        for option in ("upload_protocol", "debug_tool")
+    ]
+    if board:
+        jlink_conds.extend([
+            "jlink" in board_config.get(key, "")
+            for key in ("debug.default_tools", "upload.protocol")
+        ])
+    jlink_pkgname = "tool-jlink"
+    if not any(jlink_conds) and jlink_pkgname in self.packages:
+        del self.packages[jlink_pkgname]
+
+    return super(type(self), self).configure_default_packages(
+        variables, targets)
+
+
+def _get_board_variables():
+    """Yields the project variables of every board, framework and upload
+    protocol combination"""
+
+    for name in sorted(os.listdir(os.path.join(ROOT_DIR, "boards"))):
+        with open(os.path.join(ROOT_DIR, "boards", name)) as fp:
+            manifest = json.load(fp)
+        board = name[:-5]
+        protocols = manifest.get("upload", {}).get("protocols", [])
+        for framework in manifest.get("frameworks", []):
+            # None stands for the default protocol of a board
+            for protocol in [None] + protocols:
+                variables = {"board": board, "pioframework": [framework]}
+                if protocol:
+                    variables["upload_protocol"] = protocol
+                yield variables
+
+
+def _configure_packages(platform_module, configure, variables, targets):
+    platform = platform_module.Ststm32Platform(
+        os.path.join(ROOT_DIR, "platform.json"))
+    configure(platform, variables, targets)
+    return platform.frameworks, platform.packages
+
+
+@pytest.mark.parametrize("targets", [["buildprog"], ["upload"]])
+def test_packages_match_baseline(platform_module, targets):
+    configurations = list(_get_board_variables())
+    assert len(configurations) > 1000
+
+    for variables in configurations:
+        assert _configure_packages(
+            platform_module,
+            platform_module.Ststm32Platform.configure_default_packages,
+            variables, targets,
+        ) == _configure_packages(
+            platform_module, _baseline_configure_default_packages,
+            variables, targets,
+        ), variables
+
+
+@pytest.mark.parametrize("variables", [
+    {"board": "nucleo_f401re", "pioframework": ["arduino", "mbed"],
+     "debug_tool": "jlink"},
+    {"board": "portenta_h7_m7", "pioframework": ["arduino"],
+     "upload_protocol": "dfu"},
+    {"board": "bluepill_f103c8", "pioframework": ["arduino"],
+     "board_build.core": "maple", "upload_protocol": "dfu"},
+    {"board": "mxchip_az3166", "pioframework": ["arduino"]},
+    {"board": "disco_f407vg", "pioframework": ["cmsis", "stm32cube", "zephyr"],
+     "board_build.mcu": "stm32f405rgt6"},
+])
+def test_options_match_baseline(platform_module, variables):
+    assert _configure_packages(
+        platform_module,
+        platform_module.Ststm32Platform.configure_default_packages,
+        variables, ["upload"],
+    ) == _configure_packages(
+        platform_module, _baseline_configure_default_packages,
+        variables, ["upload"],
+    )
@@ -0,0 +1,105 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import time
+
+import pytest
+
+from portwatch import PortWatcher, wait_for_new_port
+
+
+@pytest.fixture
+def watcher(tmp_path):
+    try:
+        port_watcher = PortWatcher(str(tmp_path))
+    except OSError:
+        pytest.skip("inotify is not available")
+    with port_watcher:
+        yield port_watcher
+
+
+def _create_later(path, delay=0.1, rename=False):
+    def _create():
+        time.sleep(delay)
+        if rename:
+            # udev may create a node under a temporary name
+            tmp_path = os.path.join(os.path.dirname(path), ".tmp-port")
+            open(tmp_path, "w").close()
+            os.rename(tmp_path, path)
+        else:
+            open(path, "w").close()
+
+    thread = threading.Thread(target=_create)
+    thread.start()
+    return thread
+
+
+def test_wait_timeout(watcher):
+    start = time.monotonic()
+    assert watcher.wait(0.2) is None
+    assert time.monotonic() - start >= 0.2
+
+
+def test_existing_ports_are_ignored(tmp_path):
+    (tmp_path / "ttyACM0").touch()
+    try:
+        port_watcher = PortWatcher(str(tmp_path))
+    except OSError:
+        pytest.skip("inotify is not available")
+    with port_watcher:
+        assert port_watcher.wait(0.2) is None
+
+
+@pytest.mark.parametrize("rename", [False, True])
+def test_new_port(tmp_path, watcher, rename):
+    thread = _create_later(str(tmp_path / "ttyACM1"), rename=rename)
+    try:
+        assert watcher.wait(5) == str(tmp_path / "ttyACM1")
+    finally:
+        thread.join()
+
+
+def test_other_files_are_skipped(tmp_path, watcher):
+    (tmp_path / "ttyS0").touch()
+    (tmp_path / "video0").touch()
+    thread = _create_later(str(tmp_path / "ttyUSB0"))
+    try:
+        assert watcher.wait(5) == str(tmp_path / "ttyUSB0")
+    finally:
+        thread.join()
+    assert watcher.wait(0.1) is None
+
+
+def test_wait_for_new_port(tmp_path, watcher):
+    thread = _create_later(str(tmp_path / "ttyACM1"))
+    try:
+        assert wait_for_new_port(
+            watcher, 5, "/dev/ttyACM0", lambda: ["/dev/ttyACM0"]
+        ) == str(tmp_path / "ttyACM1")
+    finally:
+        thread.join()
+    # The watcher is closed once a port is found
+    assert watcher.fd == -1
+
+
+@pytest.mark.parametrize("ports, expected", [
+    (["/dev/ttyACM0"], "/dev/ttyACM0"),
+    (["/dev/ttyUSB0"], None),
+])
+def test_wait_for_new_port_timeout(watcher, ports, expected):
+    # The board might keep its port instead of re-enumerating
+    assert wait_for_new_port(
+        watcher, 0.1, "/dev/ttyACM0", lambda: ports) == expected
@@ -0,0 +1,68 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import pytest
+from SCons.Environment import Environment
+
+from profiles import SIZES_FILE, get_sources_signature, update_profile_sizes
+
+
+@pytest.fixture
+def get_signature(tmp_path):
+    """Returns the sources signature of a program built from a project
+    with `main.c`, `app.h` and a library"""
+
+    def _get_signature(project, header, flags):
+        project_dir = tmp_path / project
+        (project_dir / "src").mkdir(parents=True)
+        (project_dir / "src" / "main.c").write_text(
+            '#include "app.h"\nint main(void) { return VALUE; }\n')
+        (project_dir / "src" / "app.h").write_text(header)
+        (project_dir / "lib").mkdir()
+        (project_dir / "lib" / "log.c").write_text("void log(void) {}\n")
+
+        env = Environment(
+            tools=["gcc", "gnulink", "ar"], PROJECT_DIR=str(project_dir),
+            CCFLAGS=flags)
+        lib = env.StaticLibrary(
+            str(project_dir / ".pio" / "build" / "log"),
+            [str(project_dir / "lib" / "log.c")])
+        program = env.Program(
+            str(project_dir / ".pio" / "build" / "firmware.elf"),
+            [str(project_dir / "src" / "main.c")] + lib)
+        return get_sources_signature(env, program[0])
+
+    return _get_signature
+
+
+def test_sources_signature(get_signature):
+    signature = get_signature("size", "#define VALUE 0\n", ["-Os"])
+    # Profiles change only the flags
+    assert get_signature("speed", "#define VALUE 0\n", ["-O2"]) == signature
+    # Included headers are sources of the program
+    assert get_signature("changed", "#define VALUE 1\n", ["-Os"]) != signature
+
+
+def test_sizes_keep_signatures(tmp_path):
+    env = Environment(
+        tools=[], PROJECT_WORKSPACE_DIR=str(tmp_path), PIOENV="disco")
+    update_profile_sizes(env, "size", 2048, 512, "a1")
+    assert update_profile_sizes(env, "speed", 3072, 512, "b2") == {
+        "size": [2048, 512, "a1"],
+        "speed": [3072, 512, "b2"],
+    }
+    with open(str(tmp_path / SIZES_FILE)) as fp:
+        assert json.load(fp)["disco"]["speed"] == [3072, 512, "b2"]
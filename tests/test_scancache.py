@@ -0,0 +1,42 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+from SCons.Environment import Environment
+
+from scancache import use_scan_cache
+
+
+@pytest.mark.parametrize("builder", ["Object", "StaticLibrary"])
+def test_objects_use_scan_cache(tmp_path, builder):
+    (tmp_path / "driver.c").write_text('#include "driver.h"\n')
+    (tmp_path / "driver.h").write_text("")
+    env = Environment(tools=["gcc", "ar"], CPPPATH=[str(tmp_path)])
+    lib_env = env.Clone()
+    use_scan_cache(lib_env, str(tmp_path / "headers.json"))
+
+    # Libraries are built through the StaticObject builder
+    nodes = getattr(lib_env, builder)(
+        str(tmp_path / "driver"), [str(tmp_path / "driver.c")])
+    obj = nodes[0] if builder == "Object" else nodes[0].sources[0]
+    source = obj.sources[0]
+    scanner = obj.builder.source_scanner.select(source)
+    cache = scanner.scan.__self__
+
+    deps = scanner(source, lib_env, scanner.path(lib_env))
+    assert [d.get_abspath() for d in deps] == [str(tmp_path / "driver.h")]
+    assert cache.entries[source.get_abspath()][1] == [str(tmp_path / "driver.h")]
+
+    assert lib_env["BUILDERS"]["Object"] is lib_env["BUILDERS"]["StaticObject"]
+    assert env["BUILDERS"]["StaticObject"] is not lib_env["BUILDERS"]["StaticObject"]
@@ -0,0 +1,166 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import runpy
+
+import pytest
+import SCons.Defaults
+from SCons.Action import Action
+from SCons.Environment import Environment
+
+SCRIPT_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "builder", "frameworks", "stm32cube.py")
+
+BOARD = {
+    "build.mcu": "stm32f407vgt6",
+    "build.cpu": "cortex-m4",
+    "build.product_line": "STM32F407xx",
+    "build.ldscript": "STM32F407VGTX_FLASH.ld",
+    "build.stm32cube.custom_dsp_library": "yes",
+}
+
+FRAMEWORK_FILES = {
+    "Drivers/CMSIS/Include/core_cm4.h": "",
+    "Drivers/CMSIS/Device/ST/STM32F4xx/Include/stm32f4xx.h": "",
+    "Drivers/CMSIS/Device/ST/STM32F4xx/Source/Templates/system_stm32f4xx.c": "",
+    "Drivers/CMSIS/Device/ST/STM32F4xx/Source/Templates/gcc/"
+    "startup_stm32f407xx.S": "",
+    "Drivers/STM32F4xx_HAL_Driver/Inc/stm32f4xx_hal_conf_template.h":
+        "#define HAL_GPIO_MODULE_ENABLED\n/* #define HAL_CAN_MODULE_ENABLED */\n",
+    "Drivers/STM32F4xx_HAL_Driver/Src/stm32f4xx_hal.c": "",
+    "Drivers/STM32F4xx_HAL_Driver/Src/stm32f4xx_hal_gpio.c": "",
+    "Drivers/STM32F4xx_HAL_Driver/Src/stm32f4xx_hal_can.c": "",
+}
+
+
+class Board(dict):
+
+    def get(self, key, default=None):
+        return super().get(key, default)
+
+
+class Platform:
+
+    def __init__(self, package_dirs):
+        self.package_dirs = package_dirs
+
+    def get_package_dir(self, name):
+        return self.package_dirs.get(name)
+
+    def get_package_version(self, name):  # pylint: disable=unused-argument
+        return "1.0.0"
+
+
+class ProjectConfig:
+
+    def __init__(self, project_dir):
+        self.project_dir = project_dir
+
+    def get(self, section, option):  # pylint: disable=unused-argument
+        return os.path.join(self.project_dir, option)
+
+
+def _collect_build_files(env, variant_dir, src_dir, src_filter=None):
+    # Source filters are not applied, all sources are returned
+    del src_filter
+    nodes = []
+    for root, _, files in os.walk(src_dir):
+        for name in sorted(files):
+            if name.endswith((".c", ".S")):
+                rel_path = os.path.relpath(os.path.join(root, name), src_dir)
+                env.VariantDir(variant_dir, src_dir, duplicate=False)
+                nodes.append(env.File(os.path.join(variant_dir, rel_path)))
+    return nodes
+
+
+def _build_library(env, variant_dir, src_dir, src_filter=None, nodes=None):
+    nodes = nodes or env.CollectBuildFiles(variant_dir, src_dir, src_filter)
+    return env.StaticLibrary(
+        os.path.join(variant_dir, "libframework"), nodes)
+
+
+@pytest.fixture
+def run_framework_script(tmp_path):
+    """Runs the framework script with a PlatformIO-like environment and
+    returns its globals"""
+
+    framework_dir = tmp_path / "framework"
+    for path, content in FRAMEWORK_FILES.items():
+        (framework_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        (framework_dir / path).write_text(content)
+    ldscripts_dir = tmp_path / "ldscripts"
+    ldscripts_dir.mkdir()
+    project_dir = tmp_path / "project"
+    (project_dir / "src").mkdir(parents=True)
+
+    def _run(board_options=None, build_type="release"):
+        env = Environment(
+            tools=["gcc", "ar"],
+            BUILD_DIR=str(project_dir / ".pio" / "build" / "disco"),
+            PROJECT_DIR=str(project_dir),
+            PROJECT_SRC_DIR=str(project_dir / "src"),
+            PROJECT_INCLUDE_DIR=str(project_dir / "include"),
+            PIOENV="disco",
+        )
+        board = Board(BOARD, **(board_options or {}))
+        platform = Platform({
+            "framework-stm32cubef4": str(framework_dir),
+            "tool-ldscripts-ststm32": str(ldscripts_dir),
+        })
+        for name, method in {
+            "BoardConfig": lambda env: board,
+            "PioPlatform": lambda env: platform,
+            "GetProjectConfig": lambda env: ProjectConfig(str(project_dir)),
+            "GetProjectOption": lambda env, name, default=None: default,
+            "GetBuildType": lambda env: build_type,
+            "GetLibSourceDirs": lambda env: [],
+            "ProcessUnFlags": lambda env, flags: None,
+            "ConfigureDebugFlags": lambda env: None,
+            "VerboseAction": lambda env, act, actstr: Action(act, actstr),
+            "CollectBuildFiles": _collect_build_files,
+            "BuildLibrary": _build_library,
+        }.items():
+            env.AddMethod(method, name)
+
+        SCons.Defaults._default_env = env  # pylint: disable=protected-access
+        try:
+            return runpy.run_path(SCRIPT_PATH)
+        finally:
+            SCons.Defaults._default_env = None  # pylint: disable=protected-access
+
+    return _run
+
+
+@pytest.mark.parametrize("board_options", [
+    None,
+    # The HAL is built with its own flags
+    {"build.hal_profile": "speed"},
+])
+def test_hal_env_includes_generated_config(run_framework_script, board_options):
+    result = run_framework_script(board_options)
+    config_dir = result["CONFIG_DIR"]
+    hal_env = result["hal_env"]
+
+    assert os.path.isfile(os.path.join(config_dir, "stm32f4xx_hal_conf.h"))
+    assert config_dir in [hal_env.subst(d) for d in hal_env["CPPPATH"]]
+    assert hal_env["CPPPATH"][0] == config_dir
+
+
+def test_ll_drivers_without_config(run_framework_script):
+    result = run_framework_script({"build.stm32cube.drivers": "ll"})
+    assert not os.path.isfile(
+        os.path.join(result["CONFIG_DIR"], "stm32f4xx_hal_conf.h"))
+    assert result["CONFIG_DIR"] not in result["hal_env"]["CPPPATH"]
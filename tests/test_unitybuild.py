@@ -0,0 +1,84 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+
+import pytest
+from SCons.Environment import Environment
+
+from unitybuild import build_unity_objects
+
+
+def _collect_build_files(env, variant_dir, src_dir, src_filter=None):
+    del src_filter
+    env.VariantDir(variant_dir, src_dir, duplicate=False)
+    return [
+        env.File(os.path.join(variant_dir, name))
+        for name in sorted(os.listdir(src_dir))
+    ]
+
+
+def _get_symbols(obj):
+    output = subprocess.run(
+        ["nm", "--defined-only", obj.get_abspath()],
+        check=True, capture_output=True, text=True).stdout
+    return sorted(
+        line.split()[-1] for line in output.splitlines()
+        if line.split()[1] == "T")
+
+
+@pytest.fixture
+def build_objects(tmp_path):
+    """Builds unity objects of C files in one group and returns their
+    symbols per object"""
+
+    if not all(shutil.which(tool) for tool in ("gcc", "nm")):
+        pytest.skip("GCC is not installed")
+
+    def _build(files):
+        src_dir = tmp_path / "src"
+        src_dir.mkdir(exist_ok=True)
+        for name, content in files.items():
+            (src_dir / name).write_text(content)
+        # created by SCons before a target is built
+        (tmp_path / "build" / "Driver").mkdir(parents=True, exist_ok=True)
+        env = Environment(tools=["gcc"], CCFLAGS=["-O2"])
+        env.AddMethod(_collect_build_files, "CollectBuildFiles")
+        objects = build_unity_objects(
+            env, str(tmp_path / "build" / "Driver"), str(src_dir), None, 1)
+        # A single action builds all objects of a group
+        assert objects[0].get_executor()(objects[0]) == 0
+        return [_get_symbols(obj) for obj in objects]
+
+    return _build
+
+
+def test_group_is_compiled_once(build_objects):
+    assert build_objects({
+        "gpio.c": "int gpio_init(void) { return 0; }\n",
+        "uart.c": "int uart_init(void) { return 1; }\n",
+        "spi.c": "int spi_init(void) { return 2; }\n",
+    }) == [["gpio_init", "spi_init", "uart_init"], [], []]
+
+
+def test_failed_group_is_compiled_per_file(build_objects):
+    files = {
+        "gpio.c": "typedef int value_t;\nint gpio_init(void) { return 0; }\n",
+        "uart.c": "typedef long value_t;\nint uart_init(void) { return 1; }\n",
+    }
+    # Objects of a group are replaced one to one, no combined object
+    assert build_objects(files) == [["gpio_init"], ["uart_init"]]
+    assert build_objects(files) == [["gpio_init"], ["uart_init"]]
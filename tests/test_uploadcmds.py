@@ -0,0 +1,145 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import sys
+
+import pytest
+from SCons.Action import Action
+from SCons.Environment import Environment
+
+from uploadcmds import (get_blackmagic_flags, get_gdb_load_cmd,
+                        get_openocd_delta_cmd, get_openocd_flags,
+                        get_upload_device_flags)
+
+# Records the arguments it was called with instead of uploading
+STAND_IN_UPLOADER = """
+import json, sys
+with open(sys.argv[1], "w") as fp:
+    json.dump(sys.argv[2:], fp)
+"""
+
+OPENOCD_CONFIG = {"server": {"arguments": ["-f", "interface/stlink.cfg"]}}
+
+
+@pytest.fixture
+def run_upload_cmd(tmp_path):
+    """Runs $UPLOADCMD through SCons with a stand-in uploader and returns
+    the arguments the uploader has received"""
+
+    uploader = tmp_path / "uploader.py"
+    uploader.write_text(STAND_IN_UPLOADER)
+    argv_path = tmp_path / "argv.json"
+
+    def _run(flags, **kwargs):
+        env = Environment(tools=[], ENV={})
+        env.Replace(
+            UPLOADER='"%s" "%s" "%s"' % (sys.executable, uploader, argv_path),
+            UPLOADERFLAGS=flags,
+            UPLOADCMD="$UPLOADER $UPLOADERFLAGS",
+            **kwargs
+        )
+        source = env.File(str(tmp_path / "firmware.elf"))
+        # The command is substituted when it runs, as with VerboseAction
+        assert Action("$UPLOADCMD")([], [source], env) == 0
+        with open(argv_path) as fp:
+            return json.load(fp), str(source)
+
+    return _run
+
+
+@pytest.mark.parametrize("delta", [None, "", "/tmp/upload state/delta.hex"])
+def test_openocd_delta_cmd_is_single_argument(run_upload_cmd, delta):
+    def _delta_cmds(env, source):
+        return [get_openocd_delta_cmd(source, "0x08000000", delta)]
+
+    argv, source = run_upload_cmd(
+        get_openocd_flags(
+            OPENOCD_CONFIG, "", "${__openocd_delta_cmds(__env__, SOURCE)}"),
+        __openocd_delta_cmds=_delta_cmds,
+    )
+    assert argv == [
+        "-d1", "-f", "interface/stlink.cfg",
+        "-c", get_openocd_delta_cmd(source, "0x08000000", delta),
+    ]
+
+
+@pytest.mark.parametrize("delta", [None, "", "/tmp/upload state/delta.hex"])
+def test_gdb_load_cmd_is_single_argument(run_upload_cmd, delta):
+    def _load_cmd(env, source):
+        return [get_gdb_load_cmd(delta)]
+
+    argv, _ = run_upload_cmd(
+        get_blackmagic_flags(
+            "blackmagic", "/dev/ttyACM0", "${__gdb_load_cmd(__env__, SOURCE)}"),
+        __gdb_load_cmd=_load_cmd,
+    )
+    assert argv == get_blackmagic_flags(
+        "blackmagic", "/dev/ttyACM0", get_gdb_load_cmd(delta))
+    if delta == "":
+        assert "echo Firmware is up to date\\n" in argv
+
+
+@pytest.mark.parametrize("protocol, uploader, openocd, expected", [
+    ("jlink", "JLinkExe", False,
+     ["-SelectEmuBySN", "000683", "-device", "STM32F407VG"]),
+    ("dfu", '"/pkg/bin/dfu-util"', False,
+     ["-S", "000683", "-device", "STM32F407VG"]),
+    ("dfu", "maple_upload", False, ["-device", "STM32F407VG"]),
+    ("serial", "stm32flash", False, ["-device", "STM32F407VG"]),
+])
+def test_upload_device_flags(protocol, uploader, openocd, expected):
+    flags = ["-device", "STM32F407VG"]
+    assert get_upload_device_flags(
+        protocol, uploader, flags, "000683", openocd) == expected
+    assert flags == ["-device", "STM32F407VG"]
+
+
+def test_openocd_upload_device_flags():
+    flags = get_openocd_flags(OPENOCD_CONFIG, "", "program {$SOURCE} verify")
+    assert get_upload_device_flags(
+        "stlink", "openocd", flags, "0670FF", openocd=True) == [
+        "-d1", "-f", "interface/stlink.cfg",
+        "-c", "adapter serial 0670FF",
+        "-c", "program {$SOURCE} verify",
+    ]
+
+
+def test_upload_device_env_substitution():
+    def _configure_upload_port(env):
+        return env.subst("$UPLOAD_PORT")
+
+    env = Environment(tools=[], ENV={})
+    env.Replace(
+        __configure_upload_port=_configure_upload_port,
+        UPLOAD_PORT="/dev/ttyUSB0",
+        UPLOADER="stm32flash",
+        UPLOADERFLAGS=["-g", "0x08000000"],
+        UPLOADCMD='$UPLOADER $UPLOADERFLAGS "${__configure_upload_port(__env__)}"',
+    )
+    commands = []
+    for device in ("/dev/ttyUSB1", "/dev/ttyUSB2"):
+        # As in _get_upload_device_env() of the build script
+        device_env = env.Override({
+            "UPLOAD_PORT": device,
+            "UPLOADERFLAGS": get_upload_device_flags(
+                "serial", "stm32flash", env["UPLOADERFLAGS"], device),
+        })
+        commands.append([str(arg) for arg in device_env.subst_list("$UPLOADCMD")[0]])
+
+    assert commands == [
+        ["stm32flash", "-g", "0x08000000", '"/dev/ttyUSB1"'],
+        ["stm32flash", "-g", "0x08000000", '"/dev/ttyUSB2"'],
+    ]
+    assert env.subst("$UPLOAD_PORT") == "/dev/ttyUSB0"
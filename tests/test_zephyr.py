@@ -0,0 +1,107 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Records its arguments instead of fetching west modules
+STAND_IN_INSTALL_DEPS = """
+import json, os, sys
+runs_path = os.path.join(os.path.dirname(__file__), "runs.json")
+runs = []
+if os.path.isfile(runs_path):
+    with open(runs_path) as fp:
+        runs = json.load(fp)
+with open(runs_path, "w") as fp:
+    json.dump(runs + [sys.argv[1:]], fp)
+sys.exit(int(os.environ.get("INSTALL_DEPS_EXIT_CODE", "0")))
+"""
+
+
+@pytest.fixture
+def install_deps(tmp_path, monkeypatch, platform_module):
+    """Installs Zephyr dependencies for a project directory with a stand-in
+    install script and returns the runs of the script so far"""
+
+    from platformio.package.meta import (  # pylint: disable=import-outside-toplevel
+        PackageItem, PackageMetadata, PackageType)
+
+    monkeypatch.setenv("PLATFORMIO_CORE_DIR", str(tmp_path / "core"))
+
+    def _install(project_dir, pkg_dir, version="2.30700.0"):
+        scripts_dir = pkg_dir / "scripts" / "platformio"
+        scripts_dir.mkdir(parents=True, exist_ok=True)
+        (scripts_dir / "install-deps.py").write_text(STAND_IN_INSTALL_DEPS)
+        project_dir.mkdir(exist_ok=True)
+
+        # the platform uses the project of the current directory
+        monkeypatch.chdir(project_dir)
+        platform = platform_module.Ststm32Platform(
+            os.path.join(ROOT_DIR, "platform.json"))
+        platform._install_zephyr_deps(  # pylint: disable=protected-access
+            PackageItem(str(pkg_dir), PackageMetadata(
+                PackageType.TOOL, "framework-zephyr", version)))
+
+        runs_path = scripts_dir / "runs.json"
+        if not runs_path.is_file():
+            return []
+        with open(str(runs_path)) as fp:
+            return json.load(fp)
+
+    return _install
+
+
+def test_unchanged_deps_are_skipped(tmp_path, install_deps):
+    project_dir = tmp_path / "project"
+    pkg_dir = tmp_path / "framework-zephyr"
+    assert install_deps(project_dir, pkg_dir) == [["--platform", "ststm32"]]
+    assert (project_dir / ".pio" / "zephyr-deps.sha1").is_file()
+    assert not (pkg_dir / ".piodeps").exists()
+    assert len(install_deps(project_dir, pkg_dir)) == 1
+
+    # west.yml of the project
+    (project_dir / "west.yml").write_text("manifest: {}\n")
+    assert install_deps(project_dir, pkg_dir)[-1] == [
+        "--platform", "ststm32", "--manifest", str(project_dir / "west.yml")]
+    assert len(install_deps(project_dir, pkg_dir)) == 2
+
+    # framework version
+    assert len(install_deps(project_dir, pkg_dir, "2.30800.0")) == 3
+    assert len(install_deps(project_dir, pkg_dir, "2.30800.0")) == 3
+
+
+def test_deps_are_installed_per_project(tmp_path, install_deps):
+    pkg_dir = tmp_path / "framework-zephyr"
+    assert len(install_deps(tmp_path / "blinky", pkg_dir)) == 1
+    assert len(install_deps(tmp_path / "net", pkg_dir)) == 2
+    assert len(install_deps(tmp_path / "blinky", pkg_dir)) == 2
+
+    # another package directory
+    assert len(install_deps(tmp_path / "blinky", tmp_path / "zephyr")) == 1
+
+
+def test_failed_install_is_repeated(tmp_path, monkeypatch, install_deps):
+    project_dir = tmp_path / "project"
+    pkg_dir = tmp_path / "framework-zephyr"
+    monkeypatch.setenv("INSTALL_DEPS_EXIT_CODE", "1")
+    assert len(install_deps(project_dir, pkg_dir)) == 1
+    assert not (project_dir / ".pio" / "zephyr-deps.sha1").is_file()
+
+    monkeypatch.delenv("INSTALL_DEPS_EXIT_CODE")
+    assert len(install_deps(project_dir, pkg_dir)) == 2
+    assert len(install_deps(project_dir, pkg_dir)) == 2